@@ -14,14 +14,17 @@
 import pandas as pd
 import numpy as np
 import csv
+import json
+import gzip
 
 # core libraries
 from datetime import datetime, timedelta
+import traceback
 import imp
 import time
 
 # OS related
-from os import listdir, makedirs, remove, path
+from os import listdir, makedirs, remove, replace, path
 import shutil
 
 # parallel programming related
@@ -29,121 +32,281 @@ from multiprocessing import Pool
 import subprocess
 
 # utility functions
-from .util import log
+from .catalog import FileCatalog, StageKeyIndex, _catalogPath
+from .stage_schema import STAGE_PARTITIONS, applySchema, stageColumns
+from .util import log, StageWriter, StageUpsertWriter, _commitStagedFiles, _rawEventFileInterval
+from . import metrics
 
 ##################################################################
 #                        Helper Functions                        #
 ##################################################################
 
-# ToDo: writing functions to util: write out parquet (by date), read in parquet to pandas (from date interval)
-
-def _wrapOut_innerTables(in_df_orig, ext_col_nm, _prefix=''):
+def _flattenColumns(in_df_orig, in_dict_fields):
     """
-    Wrapping out the "tables" which are "packed" to a column (usual JSON solution) and add the original column 
-    name as a prefix (ar any added one).
+    Pulling out the declared nested fields of the JSON objects of a DataFrame (like the asset column of the 
+    raw events) to typed columns, in one pass over the rows. The path of a field is the column name and the 
+    keys within the object (like asset.collection.slug); a missing key or a missing (None / NaN) sub-object 
+    gives an empty value. The common parts of the paths are looked up once per row.
+
+    Inputs:
+     * in_df_orig: the DataFrame with the JSON objects (dictionaries) in its cells
+     * in_dict_fields: {output column name: (path, type)}, where the type is 'object' (values as they are) or 
+       'float' (converted to numbers, the non-numeric values are empty)
     """
+
+    # the tree of the paths: the inner objects (like asset.collection) are looked up from their parents (given
+    # by the column name or by the index of the parent node), once per row
+    _nodes = []
+    _node_refs = {}
+    _leaves = []
+    for _path, _ in in_dict_fields.values():
+        _keys = _path.split('.')
+        _ref = _keys[0]
+        for _i in range(1, len(_keys) - 1):
+            _prefix = '.'.join(_keys[:_i + 1])
+            if _prefix not in _node_refs:
+                _node_refs[_prefix] = len(_nodes)
+                _nodes.append((_ref, _keys[_i]))
+            _ref = _node_refs[_prefix]
+        _leaves.append((_ref, _keys[-1] if len(_keys) > 1 else None))
     
-    if len(_prefix) > 0:
-        _prefix_used = _prefix + '_'
+    _top_cols = list(set([_path.split('.')[0] for _path, _ in in_dict_fields.values()]))
+    _values = [[] for _ in _leaves]
+    for _row in zip(*[in_df_orig[_c] if _c in in_df_orig.columns else [None] * in_df_orig.shape[0] for _c in _top_cols]):
+        _objs = dict(zip(_top_cols, _row))
+        _node_objs = []
+        for _parent, _key in _nodes:
+            _obj = _objs[_parent] if isinstance(_parent, str) else _node_objs[_parent]
+            _node_objs.append(_obj.get(_key) if isinstance(_obj, dict) else None)
+        for _i, (_parent, _key) in enumerate(_leaves):
+            _obj = _objs[_parent] if isinstance(_parent, str) else _node_objs[_parent]
+            if _key is None:
+                _values[_i].append(_obj)
+            else:
+                _values[_i].append(_obj.get(_key) if isinstance(_obj, dict) else None)
+
+    out_df = pd.DataFrame(dict(zip(in_dict_fields.keys(), _values)), index=in_df_orig.index, 
+                          columns=list(in_dict_fields.keys()))
+    for _col, (_, _type) in in_dict_fields.items():
+        if _type == 'float':
+            out_df[_col] = pd.to_numeric(out_df[_col], errors='coerce').astype('float')
+
+    return out_df
+
+
+# the nested fields of the raw events used by the stage loader: {column: (path, type)}
+_EVENT_FIELDS = dict(
+    [('collection_' + _f, ('asset.collection.' + _f, 'object')) for _f in 
+     ['slug', 'name', 'created_date', 'description', 'external_url', 'twitter_username', 'instagram_username', 'wiki_url', 
+      'safelist_request_status', 'image_url', 'banner_image_url', 'is_nsfw', 'require_email', 'only_proxied_transfers', 
+      'is_subject_to_whitelist', 'hidden', 'featured', 'default_to_fiat', 'dev_buyer_fee_basis_points', 
+      'dev_seller_fee_basis_points', 'payout_address', 'opensea_buyer_fee_basis_points', 'opensea_seller_fee_basis_points', 
+      'discord_url']] + 
+    [('asset_' + _f, ('asset.' + _f, 'object')) for _f in 
+     ['id', 'token_id', 'name', 'permalink', 'description', 'token_metadata', 'is_nsfw', 'background_color', 'image_url', 
+      'image_original_url', 'animation_url', 'animation_original_url']] + 
+    [('assetdet_' + _f, ('asset.asset_contract.' + _f, 'object')) for _f in 
+     ['symbol', 'asset_contract_type', 'address', 'total_supply', 'payout_address', 'description', 'external_link']] + 
+    [('trx_det_timestamp', ('transaction.timestamp', 'object')), 
+     ('trx_det_hash', ('transaction.transaction_hash', 'object')), 
+     ('from_account_tr_address', ('transaction.from_account.address', 'object')), 
+     ('to_account_tr_address', ('transaction.to_account.address', 'object')), 
+     ('payment_token_symbol', ('payment_token.symbol', 'object')), 
+     ('payment_token_decimals', ('payment_token.decimals', 'float')), 
+     ('payment_token_usd_price', ('payment_token.usd_price', 'float')), 
+     ('payment_token_eth_price', ('payment_token.eth_price', 'float')), 
+     ('seller_address', ('seller.address', 'object')), 
+     ('from_account_address', ('from_account.address', 'object')), 
+     ('winner_address', ('winner_account.address', 'object')), 
+     ('to_account_address', ('to_account.address', 'object'))])
+
+
+# the columns of the raw event files used by the stage loader
+_RAW_EVENT_COLS = ['asset', 'asset_bundle', 'auction_type', 'quantity', 'total_price', 'payment_token', 'transaction', 
+                   'from_account', 'to_account', 'seller', 'winner_account']
+
+def _readRawEvents(path_in_file, columns=_RAW_EVENT_COLS):
+    """
+    Reading a raw event file (eventresponse_*, saved by the API loader as pickle, ndjson.gz or parquet) to 
+    a DataFrame with nested dictionaries in the cells (same as the original pickle files). Only the given 
+    columns are loaded (columns=None: all); the requested columns missing from the file are added as empty.
+
+    From parquet files only the needed columns are read, and from ndjson.gz files only the needed fields of 
+    the records are kept (line by line).
+    """
+
+    if path_in_file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        _schema_cols = pq.read_schema(path_in_file).names
+        _read_cols = None if columns is None else [_c for _c in columns if _c in _schema_cols]
+        out_df = pq.read_table(path_in_file, columns=_read_cols).to_pandas()
+    elif path_in_file.endswith('.ndjson.gz'):
+        with gzip.open(path_in_file, 'rb') as _f:
+            if columns is None:
+                out_df = pd.DataFrame([json.loads(_l) for _l in _f])
+            else:
+                out_df = pd.DataFrame([dict([(_c, _r.get(_c)) for _c in columns]) for _r in map(json.loads, _f)], 
+                                      columns=columns)
     else:
-        _prefix_used = ext_col_nm + '_'
+        out_df = pd.read_pickle(path_in_file)
+    
+    if columns is not None:
+        for _col in columns:
+            if _col not in list(out_df.columns):
+                out_df[_col] = None
+        out_df = out_df[columns]
 
-    out_df = in_df_orig[ext_col_nm].apply(pd.Series)
-    _rename_dict = dict([(_c, _prefix_used + _c) for _c in list(out_df.columns)])
+    return out_df
 
-    return out_df.rename(columns=_rename_dict)
 
+def _iterRawEvents(path_in_file, _chunk_events=None, columns=_RAW_EVENT_COLS):
+    """
+    Reading a raw event file in chunks of _chunk_events events (None: the full file in one chunk), giving
+    back the chunks one by one (same format as _readRawEvents). The parquet files are read by record batches
+    and the ndjson.gz files line by line, so only the current chunk is in the memory; the pickle files are
+    loaded fully, and cut to chunks.
+    """
 
-def _processOneFile(path_in_file_pkl, path_out_trx_folder_pq, path_out_token_folder_pq, 
-                    path_out_collection_folder_pq, _verbose=False):
+    if _chunk_events is None:
+        yield _readRawEvents(path_in_file, columns)
+        return
+
+    _chunks = 0
+    if path_in_file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        _pqfile = pq.ParquetFile(path_in_file)
+        _read_cols = [_c for _c in columns if _c in _pqfile.schema_arrow.names]
+        for _batch in _pqfile.iter_batches(batch_size=_chunk_events, columns=_read_cols):
+            out_df = _batch.to_pandas()
+            for _col in columns:
+                if _col not in _read_cols:
+                    out_df[_col] = None
+            _chunks = _chunks + 1
+            yield out_df[columns]
+    elif path_in_file.endswith('.ndjson.gz'):
+        with gzip.open(path_in_file, 'rb') as _f:
+            _rows = []
+            for _r in map(json.loads, _f):
+                _rows.append(dict([(_c, _r.get(_c)) for _c in columns]))
+                if len(_rows) >= _chunk_events:
+                    _chunks = _chunks + 1
+                    yield pd.DataFrame(_rows, columns=columns)
+                    _rows = []
+            if len(_rows) > 0:
+                _chunks = _chunks + 1
+                yield pd.DataFrame(_rows, columns=columns)
+    else:
+        pdf_events = _readRawEvents(path_in_file, columns)
+        for _i in range(0, pdf_events.shape[0], _chunk_events):
+            _chunks = _chunks + 1
+            yield pdf_events.iloc[_i:_i + _chunk_events].reset_index(drop=True)
+    
+    if _chunks == 0: # empty file
+        yield pd.DataFrame(columns=columns)
+
+
+def _allocateEven(in_assets, in_bundle_ids):
     """
-    Read and preprocess a given file from the "dump" area, and load it to the stage as daily partitioned parquet
-    files. It generates 3 files from each input: a transaction, a token and a collection file.
+    Price allocation of the bundles: every asset gets the same weight.
+    """
+    return np.ones(len(in_bundle_ids))
 
-    It handles the bundled transactions (filling a trx_value_usd_bundle column with the value and leave 
-    empty the trx_value_usd field - later on adding a weighted price by the latest sales price).
+def _allocateLastSale(in_assets, in_bundle_ids):
+    """
+    Price allocation of the bundles: the weights of the assets are their last sales prices (in USD). If any 
+    asset of a bundle has no known last sales price, the bundle is split evenly.
+    """
+    pdf_last_sale = _flattenColumns(pd.DataFrame({'asset':in_assets}), 
+                                    {'price':('asset.last_sale.total_price', 'float'), 
+                                     'decimals':('asset.last_sale.payment_token.decimals', 'float'),
+                                     'usd_price':('asset.last_sale.payment_token.usd_price', 'float')})
+    _weights = (pdf_last_sale.price / 10 ** pdf_last_sale.decimals * pdf_last_sale.usd_price).fillna(0).values
+    _missing_num = np.bincount(in_bundle_ids, weights=(_weights <= 0))
+    return np.where(_missing_num[in_bundle_ids] > 0, 1, _weights)
+
+# the price allocation functions of the bundles (function(assets, bundle ids) -> weights of the assets)
+PRICE_ALLOCATIONS = {'even':_allocateEven, 'last_sale':_allocateLastSale}
+
+def _explodeBundles(in_pdf_events, _price_allocation='even'):
+    """
+    Wrapping out the bundle events (asset_bundle column) to one row per bundle asset, in one indexed 
+    operation: the rows are repeated by the number of their assets, and the asset column of the bundle rows 
+    is filled from the asset lists. The non-bundle rows are kept as they are (asset_num=1).
+
+    The total_price_bundle column keeps the price of the full bundle, while the total_price is allocated to 
+    the assets by the _price_allocation: 'even' (same share for every asset), 'last_sale' (in the ratio of 
+    the last sales prices), or a function(assets, bundle ids) giving back the positive weights of the assets 
+    within their bundles (see PRICE_ALLOCATIONS).
     """
 
-    pdf_event_00 = pd.read_pickle(path_in_file_pkl)
-    _kc = list(pdf_event_00.columns) + ['asset_num', 'total_price_bundle']
+    out_df = in_pdf_events.copy()
+    out_df['asset_num'] = 1
+    out_df['total_price_bundle'] = out_df.total_price
+    _bundle_flg = (~out_df.asset_bundle.isnull()).values
+    if _bundle_flg.sum() == 0:
+        return out_df
+    
+    _bundle_assets = _flattenColumns(out_df[_bundle_flg], {'bundle_assets':('asset_bundle.assets', 'object')}).bundle_assets
+    _bundle_assets = [_a if isinstance(_a, list) else [] for _a in _bundle_assets]
+    _asset_num = np.ones(out_df.shape[0], dtype='int')
+    _asset_num[_bundle_flg] = [len(_a) for _a in _bundle_assets]
+
+    # repeating the rows, and filling the assets of the bundles
+    _row_idx = np.repeat(np.arange(out_df.shape[0]), _asset_num)
+    out_df = out_df.iloc[_row_idx].reset_index(drop=True)
+    out_df['asset_num'] = _asset_num[_row_idx]
+    _bundle_rows = _bundle_flg[_row_idx]
+    _assets = out_df.asset.values.copy()
+    _assets[_bundle_rows] = [_a for _list in _bundle_assets for _a in _list]
+    out_df['asset'] = _assets
+
+    # allocating the bundle price to the assets
+    if not callable(_price_allocation):
+        _price_allocation = PRICE_ALLOCATIONS[_price_allocation]
+    _bundle_ids = np.unique(_row_idx[_bundle_rows], return_inverse=True)[1]
+    _weights = _price_allocation(_assets[_bundle_rows], _bundle_ids)
+    out_df.loc[_bundle_rows, 'quantity'] = 1 # the original field matches with the asset_num
+    out_df.loc[_bundle_rows, 'total_price'] = (out_df.total_price.values[_bundle_rows] * _weights / 
+                                               np.bincount(_bundle_ids, weights=_weights)[_bundle_ids])
+
+    return out_df
+
+
+def _processEvents(pdf_event_00, _price_allocation='even'):
+    """
+    Preprocessing a batch of raw events (a full raw file, or a chunk of it) to the stage tables: gives back 
+    the trx table, and the partially aggregated token and collection tables (see _reduceTokens() and 
+    _reduceCollections(), the aggregation of the batches of a file is finished by these as well).
+
+    It handles the bundled transactions (filling a trx_value_usd_bundle column with the value of the full 
+    bundle, while the trx_value_usd field gets the share of the asset - see _explodeBundles()).
+    """
 
     # Handling some numeric values
     pdf_event_00['quantity'] = pdf_event_00['quantity'].fillna(0).astype('float')
     pdf_event_00['total_price'] = pdf_event_00['total_price'].fillna(0).astype('float')
 
-    # Handling the bundles (if any)
-    if pdf_event_00[(~pdf_event_00.asset_bundle.isnull())].shape[0] > 0:
-        pdf_event_nb = pdf_event_00[pdf_event_00.asset_bundle.isnull()].copy() # keep it as it is
-        pdf_event_nb['asset_num'] = 1
-        pdf_event_nb['total_price_bundle'] = pdf_event_nb.total_price
-        
-        # adding the bundle table
-        pdf_event_b = pdf_event_00[(~pdf_event_00.asset_bundle.isnull())].reset_index(drop=True)
-        pdf_bundle = _wrapOut_innerTables(pdf_event_b, 'asset_bundle', 'bundle')
-        pdf_bundle['asset_num'] = pdf_bundle.bundle_assets.apply(lambda x: len(x))
-        pdf_event_b = pd.concat([pdf_event_b, pdf_bundle[['bundle_assets', 'asset_num']]], axis=1)
-        pdf_event_b['total_price_bundle'] = pdf_event_b.total_price
-
-        # wrapping out the bundle part
-        pdf_event_b_20 = pd.DataFrame()
-        for _col in pdf_event_b.columns.values:
-            pdf_event_b_20[_col] = pdf_event_b[_col].repeat(pdf_event_b.asset_num)
-        pdf_event_b_20['asset'] = np.hstack(pdf_event_b.bundle_assets)
-        pdf_event_b_20['quantity'] = 1 # the original field matches with the asset_num
-        pdf_event_b_20['total_price'] = pdf_event_b_20.total_price / pdf_event_b_20.asset_num # it is an average, later might be changed
-
-        pdf_event_10 = pdf_event_nb[_kc].append(pdf_event_b_20[_kc]).reset_index(drop=True)
-    else:
-        pdf_event_10 = pdf_event_00.copy() # nothing to handle, just add the same columns
-        pdf_event_10['asset_num'] = 1
-        pdf_event_10['total_price_bundle'] = pdf_event_10.total_price
-
-    # Create partial tables
-    pdf_asset = _wrapOut_innerTables(pdf_event_10, 'asset').rename(
-        columns={'asset_asset_contract':'asset_contract'})
-    pdf_asset_ctr = _wrapOut_innerTables(pdf_asset, 'asset_contract', 'assetdet')
-    pdf_collection = _wrapOut_innerTables(pdf_asset, 'asset_collection', 'collection')
-
-    pdf_trxdetails = _wrapOut_innerTables(pdf_event_10, 'transaction', 'trx_det')
-    pdf_token = _wrapOut_innerTables(pdf_event_10, 'payment_token')
-
-    pdf_fromacc = _wrapOut_innerTables(pdf_event_10, 'from_account')
-    pdf_toacc = _wrapOut_innerTables(pdf_event_10, 'to_account')
-    pdf_seller = _wrapOut_innerTables(pdf_event_10, 'seller')
-    pdf_winner = _wrapOut_innerTables(pdf_event_10, 'winner_account', 'winner')
-    pdf_fromacc_tr = _wrapOut_innerTables(pdf_trxdetails, 'trx_det_from_account', 'from_account_tr')
-    pdf_toacc_tr = _wrapOut_innerTables(pdf_trxdetails, 'trx_det_to_account', 'to_account_tr')
-
-    # Handling sellers
-    pdf_seller_all = pd.concat([pdf_seller, pdf_fromacc, pdf_fromacc_tr], axis=1)
-    if ('seller_address' not in list(pdf_seller_all.columns)) and ('from_account_address' not in list(pdf_seller_all.columns)):
-        pdf_seller_all['seller_address'] = ''
-        pdf_seller_all['from_account_address'] = ''
-    if 'seller_address' not in list(pdf_seller_all.columns):
-        pdf_seller_all['seller_address'] = pdf_seller_all.from_account_address
-    if 'from_account_address' not in list(pdf_seller_all.columns):
-        pdf_seller_all['from_account_address'] = pdf_seller_all.seller_address
-    pdf_seller_all['seller_address'] = np.select([pdf_seller_all.seller_address.isnull()],
-                                                 [pdf_seller_all.from_account_address], 
-                                                 default=pdf_seller_all.seller_address)
-    pdf_seller_all = pdf_seller_all[['seller_address', 'from_account_tr_address']].copy()
-
-    # Handling buyers
-    pdf_buyer_all = pd.concat([pdf_winner, pdf_toacc, pdf_toacc_tr], axis=1)
-    if ('winner_address' not in list(pdf_seller_all.columns)) and ('to_account_address' not in list(pdf_seller_all.columns)):
-        pdf_seller_all['winner_address'] = ''
-        pdf_seller_all['to_account_address'] = ''
-    if 'winner_address' not in list(pdf_buyer_all.columns):
-        pdf_buyer_all['winner_address'] = pdf_buyer_all.to_account_address
-    if 'to_account_address' not in list(pdf_buyer_all.columns):
-        pdf_buyer_all['to_account_address'] = pdf_buyer_all.winner_address
-    pdf_buyer_all['buyer_address'] = np.select([pdf_buyer_all.winner_address.isnull()],
-                                               [pdf_buyer_all.to_account_address], 
-                                               default=pdf_buyer_all.winner_address)
-    pdf_buyer_all = pdf_buyer_all[['buyer_address', 'to_account_tr_address']].copy()
+    # Handling the bundles (if any): one row per bundle asset
+    with metrics.timed('stage_bundles'):
+        pdf_event_10 = _explodeBundles(pdf_event_00, _price_allocation)
+
+    # Flattening the used nested fields (assets, collections, transaction details, accounts)
+    pdf_event_10 = pdf_event_10.reset_index(drop=True)
+    with metrics.timed('stage_flatten'):
+        pdf_flat = _flattenColumns(pdf_event_10, _EVENT_FIELDS)
+
+    # Handling sellers / buyers (the seller / winner account if it is given, otherwise the from / to account)
+    pdf_seller_all = pdf_flat[['from_account_tr_address']].copy()
+    pdf_seller_all['seller_address'] = np.select([pdf_flat.seller_address.isnull()], [pdf_flat.from_account_address], 
+                                                 default=pdf_flat.seller_address)
+    pdf_buyer_all = pdf_flat[['to_account_tr_address']].copy()
+    pdf_buyer_all['buyer_address'] = np.select([pdf_flat.winner_address.isnull()], [pdf_flat.to_account_address], 
+                                               default=pdf_flat.winner_address)
 
     # Handling transaction amount, calculating transaction price
-    pdf_trx_amt = pd.concat([pdf_event_10[['total_price', 'total_price_bundle']], pdf_token], axis=1)
+    pdf_trx_amt = pd.concat([pdf_event_10[['total_price', 'total_price_bundle']], 
+                             pdf_flat[['payment_token_symbol', 'payment_token_decimals', 'payment_token_usd_price', 
+                                       'payment_token_eth_price']]], axis=1)
     pdf_trx_amt['wrong_flg'] = np.select([pdf_trx_amt.payment_token_decimals.isnull()], [1], default=0)
     pdf_trx_amt['payment_token_usd_price'] = pdf_trx_amt['payment_token_usd_price'].fillna(0).astype('float')
     pdf_trx_amt['payment_token_eth_price'] = pdf_trx_amt['payment_token_eth_price'].fillna(0).astype('float')
@@ -151,6 +314,8 @@ def _processOneFile(path_in_file_pkl, path_out_trx_folder_pq, path_out_token_fol
     pdf_trx_amt['total_price'] = pdf_trx_amt['total_price'].fillna(0).astype('float')
     pdf_trx_amt['total_price_bundle'] = pdf_trx_amt['total_price_bundle'].fillna(0).astype('float')
 
+    # (the token prices of the download time - the values at the trade time are added by the price index of 
+    # the NDS loader, see price_index)
     pdf_trx_amt['trx_value_crypto'] = pdf_trx_amt.total_price / 10 ** pdf_trx_amt.payment_token_decimals
     pdf_trx_amt['trx_value_usd'] = pdf_trx_amt.trx_value_crypto * pdf_trx_amt.payment_token_usd_price
     pdf_trx_amt['trx_value_eth'] = pdf_trx_amt.trx_value_crypto * pdf_trx_amt.payment_token_eth_price
@@ -170,142 +335,423 @@ def _processOneFile(path_in_file_pkl, path_out_trx_folder_pq, path_out_token_fol
     _kc_trx_asset_det = ['assetdet_symbol', 'assetdet_asset_contract_type', 'assetdet_address']
     _kc_trx_paym = ['trx_token_symbol', 'trx_value_crypto', 'trx_value_usd', 'trx_value_eth', 
                    'trx_value_crypto_bundle', 'trx_value_usd_bundle', 'trx_value_eth_bundle']
-    _kc_trx_det = ['trx_det_timestamp']
+    _kc_trx_det = ['trx_det_timestamp', 'trx_det_hash']
     _kc = (_kc_trx_coll + _kc_trx_asset + _kc_trx_asset_det + ['seller_address', 'from_account_tr_address', 'buyer_address', 'to_account_tr_address'] + 
            _kc_trx_det + _kc_trx + _kc_trx_paym)
 
-    _kc_coll = _kc_trx_coll + ['collection_created_date', 'collection_description', 'collection_external_url', 'collection_twitter_username',
-                               'collection_instagram_username', 'collection_wiki_url', 'collection_safelist_request_status', 'collection_image_url', 
-                               'collection_banner_image_url', 'collection_is_nsfw', 'collection_require_email', 'collection_only_proxied_transfers', 
-                               'collection_is_subject_to_whitelist', 'collection_hidden', 'collection_featured', 'collection_default_to_fiat', 
-                               'collection_dev_buyer_fee_basis_points', 'collection_dev_seller_fee_basis_points', 'collection_payout_address',
-                               'collection_opensea_buyer_fee_basis_points', 'collection_opensea_seller_fee_basis_points', 'collection_discord_url']
-
-    _kc_token = _kc_trx_coll + _kc_trx_asset + _kc_trx_asset_det + ['asset_description', 'assetdet_total_supply', 'asset_token_metadata', 'asset_is_nsfw', 'asset_background_color', 
-                                                                    'asset_image_url', 'asset_image_original_url', 'asset_animation_url', 'asset_animation_original_url', 
-                                                                    'assetdet_payout_address', 'assetdet_description', 'assetdet_external_link', 'trx_det_timestamp']
+    # the columns of the collection and the token tables are coming from their schema (see stage_schema)
+    _kc_coll = [_c for _c in stageColumns('collection') if _c != 'collection_category']
+    _kc_token = [_c for _c in stageColumns('token') if _c not in ['collection_category', 'asset_first_trx_dt']] + ['trx_det_timestamp']
 
     # Writing out the trx table as a partitioned parquet
     # Appending subtables, fixing data types, creating partitioning fields, writing out the table
-    pdf_trx_final = pd.concat([pdf_collection[_kc_trx_coll], pdf_asset[_kc_trx_asset], pdf_asset_ctr[_kc_trx_asset_det], 
-                               pdf_seller_all, pdf_buyer_all, pdf_event_10[_kc_trx], pdf_trxdetails[_kc_trx_det], 
-                               pdf_trx_amt[_kc_trx_paym]], axis=1)[_kc].reset_index(drop=True)
+    pdf_trx_final = pd.concat([pdf_flat[_kc_trx_coll + _kc_trx_asset + _kc_trx_asset_det + _kc_trx_det], pdf_seller_all, 
+                               pdf_buyer_all, pdf_event_10[_kc_trx], pdf_trx_amt[_kc_trx_paym]], axis=1)[_kc].reset_index(drop=True)
     _rename_dict = {'asset_num':'trx_asset_num', 'quantity':'trx_quantity', 'auction_type':'trx_auction_type', 'trx_det_timestamp':'trx_timestamp', 
+                    'trx_det_hash':'trx_hash', 
                     'assetdet_symbol':'asset_symbol', 'assetdet_asset_contract_type':'asset_contract_type', 'assetdet_address':'asset_token_address'}
     pdf_trx_final = pdf_trx_final.rename(columns=_rename_dict)
     pdf_trx_final['trx_timestamp'] = pd.to_datetime(pdf_trx_final['trx_timestamp'])
     pdf_trx_final['year'] = pdf_trx_final.trx_timestamp.dt.year
     pdf_trx_final['month'] = pdf_trx_final.trx_timestamp.dt.month
     pdf_trx_final['day'] = pdf_trx_final.trx_timestamp.dt.day
-    
-    if not path.exists(path_out_trx_folder_pq):
-        makedirs(path_out_trx_folder_pq)
-    pdf_trx_final.to_parquet(path_out_trx_folder_pq, partition_cols=['year', 'month', 'day'])
-    # the default is append ... the out-function will handle the overwrite case (with deleting files)
+
 
     # Saving the partial token table
-    pdf_asset_20 = pd.concat([pdf_collection[_kc_trx_coll], pdf_asset, pdf_asset_ctr, pdf_trxdetails[_kc_trx_det]], axis=1)[_kc_token].reset_index(drop=True)
+    pdf_asset_20 = pdf_flat[_kc_token].reset_index(drop=True)
     pdf_asset_20['asset_first_trx_dt'] = pd.to_datetime(pdf_asset_20['trx_det_timestamp']).dt.date
-    pdf_asset_20 = pdf_asset_20.drop(['trx_det_timestamp'], axis=1)
-    pdf_asset_20 = pdf_asset_20.sort_values(by='asset_first_trx_dt', ascending=False)
-    pdf_asset_20 = pdf_asset_20.groupby(['asset_id', 'collection_slug', 'asset_token_id']).last().reset_index()
-
-    pdf_asset_20['collection_category'] = 'all' # later on, we might find the good one
-    if not path.exists(path_out_token_folder_pq):
-        makedirs(path_out_token_folder_pq)
-    pdf_asset_20.to_parquet(path_out_token_folder_pq, partition_cols=['collection_category', 'collection_slug'])
+    pdf_asset_20 = _reduceTokens(pdf_asset_20.drop(['trx_det_timestamp'], axis=1), _final=False)
 
 
     # Saving the partial collection table
     # Appending subtables, aggregating table, fixing data types, creating partitioning fields, writing out the table
-    pdf_collection = pdf_collection[_kc_coll]
+    pdf_collection = pdf_flat[_kc_coll].copy()
     pdf_collection['collection_created_date'] = pd.to_datetime(pdf_collection['collection_created_date']).dt.date
-    pdf_collection = pdf_collection.groupby(['collection_slug', 'collection_name', 'collection_created_date']).first().reset_index()
-    pdf_collection['collection_category'] = 'all' # later on, we might find the good one
-    if not path.exists(path_out_collection_folder_pq):
-        makedirs(path_out_collection_folder_pq)
-    pdf_collection.to_parquet(path_out_collection_folder_pq, partition_cols=['collection_category'])
+    pdf_collection = _reduceCollections(pdf_collection)
 
-    pass
+    return pdf_trx_final, pdf_asset_20, pdf_collection
 
-def _processOneFile_threadWrapper(in_dict_params):
+
+# the key of the token table, and the aggregation keys of the collection table
+_TOKEN_KEYS = ['asset_id', 'collection_slug', 'asset_token_id']
+_COLLECTION_KEYS = ['collection_slug', 'collection_name', 'collection_created_date']
+
+def _reduceTokens(in_pdf_tokens, _final=True):
     """
-    Running the _processOneFile() function from an input dictionary - for parallel running.
+    Aggregating the token rows to one row per token: every column gets its last non-empty value, ordered by 
+    the first transaction date descending (the rows of the same date in their original order, the rows 
+    without a date at the end) - so mainly the values of the earliest transaction.
+
+    The aggregation can be done in batches: the batches are reduced to one row per token and date first 
+    (_final=False), and the appended (in the original order) partial results give the same final result 
+    as the full table.
     """
 
-    _processOneFile(**in_dict_params) # later on, some error handling might be needed here
+    pdf_tokens = in_pdf_tokens.dropna(subset=_TOKEN_KEYS)
+    if not _final:
+        return pdf_tokens.groupby(_TOKEN_KEYS + ['asset_first_trx_dt'], dropna=False, sort=False).last().reset_index()
+    pdf_tokens = pdf_tokens.sort_values(by='asset_first_trx_dt', ascending=False, kind='mergesort')
+    out_pdf = pdf_tokens.groupby(_TOKEN_KEYS).last().reset_index()
+    out_pdf['collection_category'] = 'all' # later on, we might find the good one
+    return out_pdf
 
-    pass
+def _reduceCollections(in_pdf_collections):
+    """
+    Aggregating the collection rows to one row per slug, name and creation date (the first non-empty value 
+    of every column). It gives the same result for the appended partial results of the batches.
+    """
 
+    out_pdf = in_pdf_collections.groupby(_COLLECTION_KEYS).first().reset_index()
+    out_pdf['collection_category'] = 'all' # later on, we might find the good one
+    return out_pdf
 
-def StageLoader(path_in_folder_list, path_out_trx_folder_pq, path_out_token_folder_pq, path_out_collection_folder_pq, 
-                path_io_meta_folder, _mode='append', _njobs=2, _verbose=False):
-    """
-    Pre-processing the files (with the prefix of eventresponse_) within the list of folder names given.
-    It uses the _processOneFile() function, running it parallel (on njobs=x CPUs).
 
-    In the append mode, it considers only those files, which has not been processed yet, while the 
-    overwrite mode deletes the existing content and processing all inputs (using a csv file in a _meta 
-    subfolder).
+# the estimated working memory of one raw event at the processing (the raw event with its nested objects, and 
+# the intermediate tables), used for the chunk size of the memory budget
+_EVENT_WORK_BYTES = 32 * 1024
+
+def _processOneFile(path_in_file_pkl, path_out_trx_folder_pq, path_out_token_folder_pq, 
+                    path_out_collection_folder_pq, _verbose=False, _price_allocation='even', _return_tables=False, 
+                    _chunk_events=None, _memory_mb=None):
     """
+    Read and preprocess a given file from the "dump" area, and load it to the stage as daily partitioned parquet
+    files. It generates 3 files from each input: a transaction, a token and a collection file. The input file 
+    can be any of the raw formats of the API loader (pickle, ndjson.gz, parquet), see _readRawEvents().
 
-    # Calculating which files to process
-    # - loading the list and creating a df
+    The events can be processed in chunks (_chunk_events events at once, or as many as fit into _memory_mb 
+    MB), so the intermediate tables of a dense file do not need the memory of the full file. The ndjson.gz 
+    and parquet files are read chunk by chunk as well. The result is the same as the result of the full file:
+    the token and collection tables are aggregated across the chunks.
 
-    _list_of_files = []
-    for _dirs in path_in_folder_list:
-        _list_of_files = _list_of_files + [_dirs + i for i in listdir(_dirs) if ((i.count('.pickle') > 0) and (i.count('eventresponse_') > 0))]
-    df_meta_toLoad = pd.DataFrame({'path_in_files':_list_of_files})
-    df_meta_toLoad['file_id'] = df_meta_toLoad.path_in_files.apply(lambda x: '_'.join(x.split('.pickle')[0].split('_')[-2:]))
+    With _return_tables=True, the tables are not written out, but given back (trx, token, collection), so 
+    the caller can buffer them across files (see StageWriter).
+    """
+
+    if (_chunk_events is None) and (_memory_mb is not None):
+        _chunk_events = max(1000, int(_memory_mb * 2 ** 20 / _EVENT_WORK_BYTES))
+
+    _list_trx, _list_token, _list_collection = [], [], []
+    _chunks = _iterRawEvents(path_in_file_pkl, _chunk_events)
+    while True:
+        # reading the next chunk (measured separately from the processing)
+        with metrics.timed('stage_read'):
+            pdf_event_00 = next(_chunks, None)
+        if pdf_event_00 is None:
+            break
+        metrics.count('stage_raw_events', pdf_event_00.shape[0])
+        with metrics.timed('stage_process_events'):
+            _trx, _token, _collection = _processEvents(pdf_event_00, _price_allocation)
+        _list_trx.append(_trx)
+        _list_token.append(_token)
+        _list_collection.append(_collection)
+        del pdf_event_00, _trx, _token, _collection
     
-    # - checking if the file is processed already - depending on the mode (if overwrite, preprocess anyway / delete folders)
-    if _mode == 'overwrite':
-        pdf_meta_final = df_meta_toLoad[['file_id']].copy()
-        _runList = _list_of_files
-        if path.exists(path_out_trx_folder_pq):
-            shutil.rmtree(path_out_trx_folder_pq)
-        if path.exists(path_out_token_folder_pq):
-            shutil.rmtree(path_out_token_folder_pq)
-        if path.exists(path_out_collection_folder_pq):
-            shutil.rmtree(path_out_collection_folder_pq)
+    with metrics.timed('stage_reduce'):
+        pdf_trx_final = pd.concat(_list_trx, axis=0, ignore_index=True)
+        pdf_asset_20 = _reduceTokens(pd.concat(_list_token, axis=0, ignore_index=True))
+        pdf_collection = _reduceCollections(pd.concat(_list_collection, axis=0, ignore_index=True))
+
+    # converting the tables to the schema of the stage tables (the category columns are encoded at the writing)
+    with metrics.timed('stage_apply_schema'):
+        pdf_trx_final = applySchema(pdf_trx_final, 'trx', _categories=False)
+        pdf_asset_20 = applySchema(pdf_asset_20, 'token', _categories=False)
+        pdf_collection = applySchema(pdf_collection, 'collection', _categories=False)
+
+    if _return_tables:
+        return pdf_trx_final, pdf_asset_20, pdf_collection
+    
+    # writing out the tables as partitioned parquet files (the default is append ... the StageLoader handles 
+    # the overwrite case with deleting files)
+    for _table, _writer in zip([pdf_trx_final, pdf_asset_20, pdf_collection], 
+                               _stageWriters(path_out_trx_folder_pq, path_out_token_folder_pq, path_out_collection_folder_pq)):
+        _writer.write(_table)
+        _writer.close()
+
+    pass
+
+def _processOneFile_threadWrapper(in_dict_params):
+    """
+    Running the _processOneFile() function from an input dictionary - for parallel running. An error of a 
+    file does not stop the run: gives back the input file, the status (loaded / failed), the result tables 
+    (or the traceback of the error), and the metrics of the worker since its last file.
+    """
+
+    try:
+        with metrics.timed('stage_file'):
+            _result = _processOneFile(**in_dict_params)
+        return in_dict_params['path_in_file_pkl'], 'loaded', _result, metrics.snapshot(_reset=True)
+    except Exception:
+        return in_dict_params['path_in_file_pkl'], 'failed', traceback.format_exc(), metrics.snapshot(_reset=True)
+
+
+def _stageWriters(path_out_trx_folder_pq, path_out_token_folder_pq, path_out_collection_folder_pq, 
+                  _flush_rows=1000000, _row_group_rows=250000, _upsert=False):
+    """
+    The buffered writers of the trx, token and collection tables of the stage (with their partitions). In 
+    the upsert mode, the token and the collection tables keep one row per key (see StageUpsertWriter): the 
+    token with the latest asset_first_trx_dt, and the first stored collection.
+    """
+
+    _trx_writer = StageWriter(path_out_trx_folder_pq, STAGE_PARTITIONS['trx'], _flush_rows, _row_group_rows, _table='trx')
+    if not _upsert:
+        return [_trx_writer, 
+                StageWriter(path_out_token_folder_pq, STAGE_PARTITIONS['token'], _flush_rows, _row_group_rows, _table='token'), 
+                StageWriter(path_out_collection_folder_pq, STAGE_PARTITIONS['collection'], _flush_rows, _row_group_rows, 
+                            _table='collection')]
     
-    else: # mode append
-        if path.exists(path_io_meta_folder + '01_stage_loader.csv'):
-            pdf_oldmeta = pd.read_csv(path_io_meta_folder + '01_stage_loader.csv')
-            pdf_oldmeta['exist_flg'] = 1
-            pdf_meta_final = pd.merge(pdf_oldmeta, df_meta_toLoad, how='outer', on=['file_id']).fillna({'exist_flg':0})
-            _runList = list(pdf_meta_final[(pdf_meta_final.exist_flg <= 0) & 
-                                           (~pdf_meta_final.path_in_files.isnull())].path_in_files.unique())
-            pdf_meta_final = pdf_meta_final[['file_id']]
-        else:
-            pdf_meta_final = df_meta_toLoad[['file_id']].copy()
-            _runList = _list_of_files
+    return [_trx_writer, 
+            StageUpsertWriter(path_out_token_folder_pq, STAGE_PARTITIONS['token'], 
+                              ['asset_id', 'collection_slug', 'asset_token_id'], 'asset_first_trx_dt', 
+                              StageKeyIndex(path_out_token_folder_pq), _flush_rows, _row_group_rows, _table='token'), 
+            StageUpsertWriter(path_out_collection_folder_pq, STAGE_PARTITIONS['collection'], ['collection_slug'], None, 
+                              StageKeyIndex(path_out_collection_folder_pq), _flush_rows, _row_group_rows, _table='collection')]
+
+
+def _recordLoadedFiles(in_list_files, _file_catalogs, path_io_meta_folder):
+    """
+    Recording the processed files as loaded: in their catalogs and in the meta file (01_stage_loader.csv of 
+    the _meta folder).
+    """
+
+    for _catalog in set([_file_catalogs[_f] for _f in in_list_files]):
+        _catalog.setStageStatus([_f for _f in in_list_files if _file_catalogs[_f] is _catalog], 'loaded')
     
-    # Preprocessing files from the list
-    # - create the list of input dictionaries
-    _rundictlist = []
-    for _file in _runList:
-        _rundictlist = _rundictlist + [{'path_in_file_pkl':_file, 'path_out_trx_folder_pq':path_out_trx_folder_pq, 
-                                        'path_out_token_folder_pq':path_out_token_folder_pq, 'path_out_collection_folder_pq':path_out_collection_folder_pq, 
-                                        '_verbose':_verbose}]
-
-    # - run the preprocessing on multi threads
-    with Pool(_njobs) as p:
-        p.map(_processOneFile_threadWrapper, _rundictlist)
-    p.close()
+    if len(in_list_files) > 0:
+        _new_meta_flg = not path.exists(path_io_meta_folder + '01_stage_loader.csv')
+        with open(path_io_meta_folder + '01_stage_loader.csv', 'a') as _f:
+            if _new_meta_flg:
+                _f.write('file_id\n')
+            for _file in in_list_files:
+                _f.write('_'.join([str(i) for i in _rawEventFileInterval(_file)]) + '\n')
+
+    pass
+
+
+def _commitStageFiles(_writers, _pending_files, _file_catalogs, path_io_meta_folder):
+    """
+    Writing out the buffered tables (to temporary files), and committing them together with the files of the
+    buffer: the list of the written files and the input files are saved to a journal (_stage_commit.json of 
+    the _meta folder) first, then the written files are renamed to their final names, the input files are 
+    recorded as loaded, and the journal is deleted. An interrupted commit is finished from the journal at 
+    the next run (see _recoverStageCommit()), so the stage never gets the output of a file twice (or a 
+    truncated file).
+    """
+
+    with metrics.timed('stage_flush'):
+        for _writer in _writers:
+            _writer.flush(_commit=False)
     
-    # writing out the new meta file
-    if not path.exists(path_io_meta_folder):
-        makedirs(path_io_meta_folder)
-    pdf_meta_final.to_csv(path_io_meta_folder + '01_stage_loader.csv', index=False)
+    _journal = path_io_meta_folder + '_stage_commit.json'
+    with open(_journal + '.tmp', 'w') as _f:
+        json.dump({'staged_files':[_sf for _writer in _writers for _sf in _writer.staged_files], 
+                   'replaced_files':[_rf for _writer in _writers for _rf in _writer.replaced_files], 
+                   'input_files':_pending_files}, _f)
+    replace(_journal + '.tmp', _journal)
+
+    with metrics.timed('stage_commit'):
+        for _writer in _writers:
+            _writer.commit()
+        _recordLoadedFiles(_pending_files, _file_catalogs, path_io_meta_folder)
+        remove(_journal)
+
+    pass
+
+
+def _recoverStageCommit(path_io_meta_folder):
+    """
+    Finishing the interrupted commit of the last StageLoader run (if its journal exists): renaming the rest 
+    of its written files, and recording its input files as loaded.
+    """
+
+    _journal = path_io_meta_folder + '_stage_commit.json'
+    if not path.exists(_journal):
+        return 0
     
+    with open(_journal) as _f:
+        _jdict = json.load(_f)
+    _commitStagedFiles(_jdict['staged_files'], _jdict.get('replaced_files', []))
+    _catalogs = dict([(_p, FileCatalog(_p)) for _p in set([_catalogPath(path.dirname(_f)) for _f in _jdict['input_files']])])
+    _recordLoadedFiles(_jdict['input_files'], dict([(_f, _catalogs[_catalogPath(path.dirname(_f))]) for _f in _jdict['input_files']]), 
+                       path_io_meta_folder)
+    for _catalog in _catalogs.values():
+        _catalog.close()
+    remove(_journal)
+    log('The interrupted commit of the last run is finished ({} files)'.format(len(_jdict['input_files'])))
+
+    return len(_jdict['input_files'])
+
+
+def _quarantineStageFile(path_in_file, _traceback, _catalog, path_io_meta_folder):
+    """
+    Recording a failed file: its state in the catalog (with the traceback), and the traceback to the 
+    quarantine subfolder of the _meta folder (<file name>.txt).
+    """
+
+    _catalog.setStageStatus([path_in_file], 'failed', _traceback)
+    if not path.exists(path_io_meta_folder + 'quarantine/'):
+        makedirs(path_io_meta_folder + 'quarantine/')
+    with open(path_io_meta_folder + 'quarantine/' + path.basename(path_in_file) + '.txt', 'w') as _f:
+        _f.write(_traceback)
+
     pass
 
 
+def StageLoader(path_in_folder_list, path_out_trx_folder_pq, path_out_token_folder_pq, path_out_collection_folder_pq, 
+                path_io_meta_folder, _mode='append', _njobs=2, _verbose=False, _price_allocation='even', 
+                _flush_rows=1000000, _row_group_rows=250000, _log_sec=60, _upsert=False, _memory_mb=None, 
+                _metrics_dir=None, _prometheus_file=None):
+    """
+    Pre-processing the raw event files (with the prefix of eventresponse_, in any of the raw formats) within 
+    the list of folder names given.
+    It uses the _processOneFile() function, running it parallel (on njobs=x CPUs). The largest files are 
+    started first, and the idle workers are pulling the next file (so one big file does not hold back the 
+    others at the end of the run).
+
+    The raw files and their processing state are coming from the file catalog of the main dump directory
+    (catalog.FileCatalog, the parent folder of the session folders). In the append mode, it considers only 
+    those files, which has not been processed yet (or failed earlier), while the overwrite mode deletes the 
+    existing content and processing all inputs. The list of the processed files is written to a csv file in 
+    the _meta subfolder as well (the list of the runs before the catalog is imported to the catalog only 
+    once, at its first use, see FileCatalog.isImported()). The files are recorded as loaded as soon as their output is written out 
+    (at every flush of the buffered tables), so an interrupted run continues from there.
+
+    An error of a file does not stop the run: the file is recorded as failed in the catalog, and its 
+    traceback is saved to the quarantine subfolder of the _meta folder.
+
+    The price of the bundles is allocated to their assets by the _price_allocation ('even', 'last_sale', 
+    see _explodeBundles()). The output of the files is buffered, and every partition gets one new file 
+    per _flush_rows rows (with row groups of _row_group_rows rows), see the StageWriter of the util. The 
+    small files of the earlier loads can be merged with the CompactStage() function of the util.
+
+    The workers only transform the files, all the writing is done by the main process (single writer, so 
+    the workers never write the same partition folder at the same time). Every flush is committed as one 
+    unit: the parquet files are written to temporary names, and renamed only after the list of them is 
+    saved to a journal (see _commitStageFiles()).
+
+    With _upsert=True, the token and the collection tables keep only one current row per key (the token 
+    with the latest asset_first_trx_dt, the first stored collection), merging the new rows into their 
+    partitions by a key index, instead of appending a partial table per file (see StageUpsertWriter of the 
+    util). Reloading a file does not change these tables then. The mode should be the same at every run 
+    of a stage folder (a table appended earlier is deduplicated only in its rewritten partitions).
+
+    With _memory_mb, every worker processes its raw file in chunks fitting into about _memory_mb MB (see
+    _processOneFile()), so the dense files do not run out of memory with several workers.
+
+    The metrics of the run (the read, processing and writing times, the number of events, files and 
+    written rows, collected from the workers) are saved as a report to the _metrics_dir folder, and/or as a 
+    Prometheus textfile to the _prometheus_file (see metrics.SaveMetricsReport()).
+
+    If _verbose, the progress is logged in every _log_sec seconds.
+    """
 
-# ToDo: in the NDS loader, handle the "duplicated" transactions (where 1st item is the sales and the
-# 2nd is some internal transfer - from accounts are different in transaction column / from account)
-# Example: https://opensea.io/assets/0xdd0d63220265927b29646cb7d4684d5fa6df4cb8/57
-# Also, correct the related trx addresses (buyer/seller)
+    _runstart = time.time()
+    metrics.reset()
 
-# ToDo: check if the ETH-USD time series is correct
\ No newline at end of file
+    # Calculating which files to process
+    # - the catalogs of the input folders (after finishing the interrupted commit of the last run)
+    _catalogs = {}
+    for _dirs in path_in_folder_list:
+        _catalogs.setdefault(_catalogPath(_dirs), []).append(_dirs)
+    if not path.exists(path_io_meta_folder):
+        makedirs(path_io_meta_folder)
+    if _mode == 'overwrite':
+        for _f in ['01_stage_loader.csv', '_stage_commit.json']:
+            if path.exists(path_io_meta_folder + _f):
+                remove(path_io_meta_folder + _f)
+    else:
+        _recoverStageCommit(path_io_meta_folder)
+    _path_oldmeta = path.abspath(path_io_meta_folder + '01_stage_loader.csv')
+    
+    # - checking if the file is processed already - depending on the mode (if overwrite, preprocess anyway / delete folders)
+    _file_catalogs = {}
+    _opened_catalogs = []
+    _runList = []
+    try:
+        for _path_catalog, _dirs_list in _catalogs.items():
+            _catalog = FileCatalog(_path_catalog)
+            _opened_catalogs = _opened_catalogs + [_catalog]
+            if _mode == 'overwrite':
+                _catalog.resetStageStatus(_dirs_list)
+            pdf_files = _catalog.listFiles(_dirs_list, _kind='raw_event')
+
+            # - the files processed before the catalog (listed by their interval in the meta file) are imported
+            #   only once, later the state of the catalog is used (so a new file of the same interval is loaded)
+            if not _catalog.isImported(_path_oldmeta):
+                if path.exists(_path_oldmeta):
+                    pdf_oldmeta = pd.read_csv(_path_oldmeta, dtype='object')
+                    _file_ids = pdf_files.period_start.astype('str') + '_' + pdf_files.period_end.astype('str')
+                    _old_flg = (pdf_files.stage_status != 'loaded') & _file_ids.isin(pdf_oldmeta.file_id)
+                    _catalog.setStageStatus(pdf_files[_old_flg].path, 'loaded')
+                    pdf_files.loc[_old_flg, 'stage_status'] = 'loaded'
+                _catalog.setImported(_path_oldmeta)
+            pdf_files = pdf_files[pdf_files.stage_status != 'loaded']
+            
+            # - skipping the broken files (partially written, or changed since the registration)
+            _broken_flg = np.array([(not path.exists(_f)) or (path.getsize(_f) != _nbytes) 
+                                    for _f, _nbytes in zip(pdf_files.path, pdf_files.nbytes)], dtype='bool')
+            if _broken_flg.sum() > 0:
+                _catalog.setStageStatus(pdf_files[_broken_flg].path, 'failed', 'size_mismatch')
+                log('Skipping {} broken raw files (see the verify() function of the catalog)'.format(_broken_flg.sum()))
+            _runList = _runList + list(zip(pdf_files[~_broken_flg].path, pdf_files[~_broken_flg].nbytes))
+            _file_catalogs.update([(_f, _catalog) for _f in pdf_files.path])
+        
+        if _mode == 'overwrite':
+            if path.exists(path_out_trx_folder_pq):
+                shutil.rmtree(path_out_trx_folder_pq)
+            if path.exists(path_out_token_folder_pq):
+                shutil.rmtree(path_out_token_folder_pq)
+            if path.exists(path_out_collection_folder_pq):
+                shutil.rmtree(path_out_collection_folder_pq)
+    
+        # Preprocessing files from the list
+        # - create the list of input dictionaries (largest files first)
+        _rundictlist = [{'path_in_file_pkl':_file, 'path_out_trx_folder_pq':path_out_trx_folder_pq, 
+                         'path_out_token_folder_pq':path_out_token_folder_pq, 'path_out_collection_folder_pq':path_out_collection_folder_pq, 
+                         '_verbose':_verbose, '_price_allocation':_price_allocation, '_return_tables':True, 
+                         '_memory_mb':_memory_mb} 
+                        for _file, _ in sorted(_runList, key=lambda x: -x[1])]
+        if _verbose:
+            log('Processing {} raw files ({:.1f} MB)'.format(len(_runList), sum([_r[1] for _r in _runList]) / 2**20))
+
+        # - run the preprocessing on multi threads, the tables are buffered and written out by the main process
+        #   (coalescing the output of several files to one file per partition)
+        _writers = _stageWriters(path_out_trx_folder_pq, path_out_token_folder_pq, path_out_collection_folder_pq, 
+                                 None, _row_group_rows, _upsert)
+        _pending_files = []
+        _done_num, _failed_num, _row_num = 0, 0, 0
+        _last_log = time.time()
+        with Pool(_njobs, initializer=metrics.reset) as p:
+            for _file, _status, _result, _metrics in p.imap_unordered(_processOneFile_threadWrapper, _rundictlist, chunksize=1):
+                metrics.merge(_metrics)
+                metrics.count('stage_files', status=_status)
+                if _status == 'loaded':
+                    for _table, _writer in zip(_result, _writers):
+                        _writer.write(_table)
+                    _pending_files = _pending_files + [_file]
+                    _row_num = _row_num + _result[0].shape[0]
+                else:
+                    _quarantineStageFile(_file, _result, _file_catalogs[_file], path_io_meta_folder)
+                    _failed_num = _failed_num + 1
+                    log('Error at processing {} (see the quarantine folder)'.format(_file))
+                _done_num = _done_num + 1
+            
+                if sum([_w.buffer_rows for _w in _writers]) >= _flush_rows:
+                    _commitStageFiles(_writers, _pending_files, _file_catalogs, path_io_meta_folder)
+                    _pending_files = []
+                if _verbose and (time.time() - _last_log >= _log_sec):
+                    log('Processed {} of {} files ({} failed), {} transactions'.format(_done_num, len(_rundictlist), _failed_num, _row_num))
+                    _last_log = time.time()
+        p.close()
+        _commitStageFiles(_writers, _pending_files, _file_catalogs, path_io_meta_folder)
+        for _writer in _writers:
+            _writer.close()
+    finally:
+        for _catalog in _opened_catalogs:
+            _catalog.close()
+
+    if _verbose:
+        log('Stage loading finished: {} files processed ({} failed), {} transactions'.format(_done_num, _failed_num, _row_num))
+    if (_metrics_dir is not None) or (_prometheus_file is not None):
+        metrics.SaveMetricsReport('stage_loader', _metrics_dir, _run_start=_runstart, _prometheus_file=_prometheus_file)
+    
+    pass
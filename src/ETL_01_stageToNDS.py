@@ -0,0 +1,379 @@
+##################################################################
+#       ETL: Stage to the Normalized Data Store (NDS)            #
+##################################################################
+#                                                                #
+# Questions to marton.szel@lynxanalytics.com                     #
+# Version: 2022-01-31                                            #
+##################################################################
+
+##################################################################
+#                        Import libraries                        #
+##################################################################
+
+# data processing related
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+
+# core libraries
+import time
+
+# OS related
+from os import listdir, makedirs, remove, replace, path
+import shutil
+
+# loading some own libraries
+from .catalog import StageKeyIndex
+from .price_index import PriceIndex, EnrichTrxValues
+from .stage_schema import STAGE_PARTITIONS, applySchema
+from .util import log, StageWriter, _commitStagedFiles, _partitionDir, _PARTITION_NULL
+from . import metrics
+
+
+##################################################################
+#                  NDS Transactions: Event Keys                  #
+##################################################################
+
+# the columns identifying an event: the transaction hash and the asset, and for the sales (the rows with a
+# value) the seller, the value and the quantity too - the events of the API have no log position, and a
+# transaction can sell an ERC-1155 asset more times (the internal transfers of a sale have no value, they
+# are merged to the sale, see _dedupEvents()). For the events without a transaction hash: the time, the
+# asset, the accounts and the value
+_EVENT_KEY_COLS = ['trx_hash', 'asset_token_address', 'asset_token_id']
+_EVENT_SALE_KEY_COLS = ['seller_address', 'trx_value_crypto', 'trx_quantity']
+_EVENT_FALLBACK_KEY_COLS = ['trx_timestamp', 'asset_id', 'seller_address', 'buyer_address', 'trx_value_crypto']
+
+def _keyText(in_pdf, in_list_cols):
+    """
+    The values of the given columns joined to one text per row (the empty values are 'None' / 'nan' / 'NaT',
+    so the rows read with the same schema give the same text).
+    """
+    out_series = pd.Series([''] * in_pdf.shape[0], index=in_pdf.index, dtype='object')
+    for _col in in_list_cols:
+        out_series = out_series + '|' + in_pdf[_col].astype('str')
+    return out_series
+
+def _saleRows(in_pdf):
+    """
+    Flagging the sales among the stage trx rows: the rows with a transaction hash and a positive value (the
+    others are the internal transfers of a transaction, or the events identified by the fallback columns).
+    """
+    return (in_pdf['trx_hash'].notnull() & (in_pdf['trx_value_crypto'].astype('float').fillna(0) > 0)).values
+
+def _eventKeys(in_pdf, _sale_cols=True):
+    """
+    The hashed keys of the events (stage trx rows): 32 hex characters of the BLAKE2b hash of the transaction
+    hash and the asset (with the seller, the value and the quantity of the sales), or of the fallback columns
+    if there is no transaction hash.
+    Inputs:
+     * _sale_cols=True: if False, the sales get the key of the transaction hash and the asset only (the key
+       of the internal transfers of the same asset in the transaction)
+    """
+
+    _text = np.where(in_pdf['trx_hash'].notnull().values, 'h' + _keyText(in_pdf, _EVENT_KEY_COLS),
+                     'f' + _keyText(in_pdf, _EVENT_FALLBACK_KEY_COLS))
+    if _sale_cols:
+        _text = np.where(_saleRows(in_pdf), _text + '|s' + _keyText(in_pdf, _EVENT_SALE_KEY_COLS), _text)
+    return [hashlib.blake2b(_t.encode('utf-8'), digest_size=16).hexdigest() for _t in _text]
+
+
+##################################################################
+#              NDS Transactions: Cleansing the Events            #
+##################################################################
+
+def _assetMoveEnds(in_sellers, in_buyers):
+    """
+    The first and the last owner of an asset moved by the rows of one event (seller -> buyer moves, like a
+    sale to a marketplace contract and its transfer to the real buyer): the seller who is nobody's buyer,
+    and the buyer who is nobody's seller. None for a side, if it is not unique (or there are no moves).
+    """
+
+    _moves = [(_s, _b) for _s, _b in zip(in_sellers, in_buyers) if pd.notnull(_s) and pd.notnull(_b) and (_s != _b)]
+    _sellers = set([_m[0] for _m in _moves])
+    _buyers = set([_m[1] for _m in _moves])
+    _first = list(_sellers - _buyers)
+    _last = list(_buyers - _sellers)
+    return _first[0] if len(_first) == 1 else None, _last[0] if len(_last) == 1 else None
+
+def _dedupEvents(in_pdf):
+    """
+    Keeping one row per event key in a batch of stage trx rows. The duplicates of an event (downloaded again
+    with an overlapping interval, or a sale followed by an internal transfer of the same asset in the same
+    transaction) are merged to the row of the sale: the internal transfers (the rows without a value) get the
+    key of the sale of the asset with the highest value in their transaction (the first of them in the
+    original order), while the sales of an asset with different sellers / values / quantities (ERC-1155
+    assets) are kept as separate events. The number of the merged rows goes to the trx_duplicate_num column.
+
+    The seller / buyer of a merged event is corrected by the moves of the asset in its rows (see
+    _assetMoveEnds(): the sale to an intermediary and the transfer to the buyer give the real buyer). The
+    corrected rows are flagged in the trx_address_fix column (1: buyer, 2: seller, 3: both, 0: none).
+    """
+
+    pdf_events = in_pdf.copy()
+    pdf_events['trx_event_key'] = _eventKeys(pdf_events)
+    pdf_events = pdf_events.sort_values(by='trx_value_crypto', ascending=False, kind='mergesort', na_position='last')
+
+    # the internal transfers go to the (highest value) sale of the asset in their transaction
+    _asset_keys = pd.Series(_eventKeys(pdf_events, _sale_cols=False), index=pdf_events.index)
+    _sale_flg = _saleRows(pdf_events)
+    _sale_keys = pdf_events['trx_event_key'][_sale_flg].groupby(_asset_keys[_sale_flg].values, sort=False).first()
+    _transfer_flg = pdf_events['trx_hash'].notnull().values & (~_sale_flg)
+    pdf_events.loc[_transfer_flg, 'trx_event_key'] = \
+        _asset_keys[_transfer_flg].map(_sale_keys).fillna(pdf_events['trx_event_key'][_transfer_flg]).values
+    _rows = pdf_events.groupby('trx_event_key', sort=False).size()
+    out_pdf = pdf_events.drop_duplicates(subset=['trx_event_key'], keep='first').sort_index()
+    out_pdf['trx_duplicate_num'] = out_pdf['trx_event_key'].map(_rows).values - 1
+
+    # the addresses of the merged events (only the keys with more rows are checked)
+    pdf_dups = pdf_events[pdf_events.trx_event_key.isin(_rows.index[_rows > 1])]
+    _ends = dict([(_key, _assetMoveEnds(_pdf.seller_address.astype('object').tolist(),
+                                        _pdf.buyer_address.astype('object').tolist()))
+                  for _key, _pdf in pdf_dups.groupby('trx_event_key', sort=False)])
+    _seller = out_pdf['seller_address'].astype('object')
+    _buyer = out_pdf['buyer_address'].astype('object')
+    _seller_new = out_pdf['trx_event_key'].map(dict([(_k, _v[0]) for _k, _v in _ends.items()])).astype('object')
+    _buyer_new = out_pdf['trx_event_key'].map(dict([(_k, _v[1]) for _k, _v in _ends.items()])).astype('object')
+    _seller_fix = (_seller_new.notnull() & (_seller.isnull() | (_seller != _seller_new))).values
+    _buyer_fix = (_buyer_new.notnull() & (_buyer.isnull() | (_buyer != _buyer_new))).values
+    out_pdf['seller_address'] = np.where(_seller_fix, _seller_new, _seller)
+    out_pdf['buyer_address'] = np.where(_buyer_fix, _buyer_new, _buyer)
+    out_pdf['trx_address_fix'] = _buyer_fix.astype('int') + 2 * _seller_fix.astype('int')
+    return out_pdf
+
+def _correctAddresses(in_pdf):
+    """
+    Filling the missing seller / buyer addresses from the transaction sub-object: the account sending the
+    transaction (from_account_tr_address) is the buyer of a sale, or the seller accepting an offer - so it
+    fills the missing side, if it is not the other party already. The filled sides are added to the flags
+    of the trx_address_fix column (see _dedupEvents()).
+    """
+
+    out_pdf = in_pdf.copy()
+    _sender = out_pdf['from_account_tr_address'].astype('object')
+    _seller = out_pdf['seller_address'].astype('object')
+    _buyer = out_pdf['buyer_address'].astype('object')
+
+    _buyer_fix = (_buyer.isnull() & _sender.notnull() & (_sender != _seller)).values
+    _seller_fix = (_seller.isnull() & _sender.notnull() & (_sender != _buyer) & (~_buyer_fix)).values
+    out_pdf['buyer_address'] = np.where(_buyer_fix, _sender, _buyer)
+    out_pdf['seller_address'] = np.where(_seller_fix, _sender, _seller)
+    _fix = out_pdf['trx_address_fix'].values if 'trx_address_fix' in out_pdf.columns else 0
+    out_pdf['trx_address_fix'] = _fix | (_buyer_fix.astype('int') + 2 * _seller_fix.astype('int'))
+    return out_pdf
+
+
+##################################################################
+#                 NDS Transactions: Incremental Load             #
+##################################################################
+
+def _stagePartitionFiles(path_stage_trx_folder):
+    """
+    The parquet files of the stage trx table by partition: {(year, month, day): [file paths]} (None for the
+    empty partition values). The temporary files, journals and key indexes (starting with _ or .) are skipped.
+    """
+
+    out_dict = {}
+    _dirs = [path_stage_trx_folder]
+    while len(_dirs) > 0:
+        _dir = _dirs.pop()
+        _entries = sorted(listdir(_dir))
+        _dirs = _dirs + [_dir + _e + '/' for _e in _entries if path.isdir(_dir + _e) and ('=' in _e)]
+        _files = [_dir + _e for _e in _entries if _e.endswith('.parquet') and (not _e.startswith(('_', '.')))]
+        if len(_files) > 0:
+            _values = dict([_d.split('=', 1) for _d in _dir[len(path_stage_trx_folder):].strip('/').split('/')])
+            out_dict[tuple([None if _values.get(_col, _PARTITION_NULL) == _PARTITION_NULL else int(_values[_col])
+                            for _col in STAGE_PARTITIONS['trx']])] = _files
+    return out_dict
+
+def _readStageFiles(in_list_files, in_values):
+    """
+    Reading stage trx files of a partition with the schema of the stage trx table (the partition columns are
+    coming from the folder names).
+    """
+    import pyarrow.parquet as pq
+
+    pdf_out = pd.concat([pq.read_table(_f).to_pandas() for _f in in_list_files], axis=0, ignore_index=True)
+    for _col, _value in zip(STAGE_PARTITIONS['trx'], in_values):
+        pdf_out[_col] = _value
+    return applySchema(pdf_out, 'trx', _categories=False)
+
+
+def _recordLoadedStageFiles(in_list_files, path_in_trx_folder, path_io_meta_folder):
+    """
+    Recording the loaded stage files (relative to the stage trx folder) in the meta file (02_nds_loader.csv
+    of the _meta folder).
+    """
+
+    if len(in_list_files) > 0:
+        _new_meta_flg = not path.exists(path_io_meta_folder + '02_nds_loader.csv')
+        with open(path_io_meta_folder + '02_nds_loader.csv', 'a') as _f:
+            if _new_meta_flg:
+                _f.write('stage_file\n')
+            for _file in in_list_files:
+                _f.write(_file[len(path_in_trx_folder):] + '\n')
+
+    pass
+
+
+def _commitNDSFiles(_writer, _key_index, _pending_keys, _pending_files, path_in_trx_folder, path_io_meta_folder):
+    """
+    Writing out the buffered NDS rows (to temporary files), and committing them: the list of the written
+    files and the input files are saved to a journal (_nds_commit.json of the _meta folder), then the
+    written files are renamed, the new event keys are stored in the key index, the input files are recorded
+    as loaded, and the journal is deleted. An interrupted commit is finished from the journal at the next
+    run (see _recoverNDSCommit()).
+    """
+
+    with metrics.timed('nds_flush'):
+        _writer.flush(_commit=False)
+
+    _journal = path_io_meta_folder + '_nds_commit.json'
+    with open(_journal + '.tmp', 'w') as _f:
+        json.dump({'staged_files':_writer.staged_files, 'input_files':_pending_files}, _f)
+    replace(_journal + '.tmp', _journal)
+
+    _writer.commit()
+    _key_index.update(_pending_keys)
+    _recordLoadedStageFiles(_pending_files, path_in_trx_folder, path_io_meta_folder)
+    remove(_journal)
+
+    pass
+
+
+def _recoverNDSCommit(_key_index, path_out_nds_trx_folder, path_in_trx_folder, path_io_meta_folder):
+    """
+    Finishing the interrupted commit of the last NDSTrxLoader run (if its journal exists): renaming the rest
+    of its written files, storing their event keys in the key index (read back from the files), and
+    recording its input files as loaded.
+    """
+    import pyarrow.parquet as pq
+
+    _journal = path_io_meta_folder + '_nds_commit.json'
+    if not path.exists(_journal):
+        return 0
+
+    with open(_journal) as _f:
+        _jdict = json.load(_f)
+    _commitStagedFiles(_jdict['staged_files'])
+    for _, _final in _jdict['staged_files']:
+        _partition = path.dirname(_final)[len(path_out_nds_trx_folder):] + '/'
+        _key_index.update(dict([(_k, _partition) for _k in pq.read_table(_final, columns=['trx_event_key']).column(0).to_pylist()]))
+    _recordLoadedStageFiles(_jdict['input_files'], path_in_trx_folder, path_io_meta_folder)
+    remove(_journal)
+    log('The interrupted commit of the last run is finished ({} files)'.format(len(_jdict['input_files'])))
+
+    return len(_jdict['input_files'])
+
+
+def NDSTrxLoader(path_in_trx_folder_pq, path_out_nds_trx_folder_pq, path_io_meta_folder, _mode='append',
+                 _flush_rows=1000000, _row_group_rows=250000, _verbose=False, _log_sec=60, _metrics_dir=None,
+                 _prometheus_file=None, _price_index=None, _price_tolerance='1D'):
+    """
+    Loading the transactions of the stage (the year / month / day partitions of the trx table) to the NDS
+    transaction table (same partitions, see the nds_trx schema of the stage_schema), incrementally: only
+    the stage files which are not loaded yet are read (the loaded ones are listed in the 02_nds_loader.csv
+    of the _meta folder), so the history is not scanned again.
+
+    Every event gets a hashed key (the transaction hash, the asset, and the seller / value / quantity of the
+    sales, see _eventKeys()), and the keys of the loaded events are kept in a key index (_keys.sqlite in the
+    NDS trx folder, see catalog.StageKeyIndex). So the new rows are deduplicated in one pass: within the new
+    files of a partition (the duplicates of an event, like a sale followed by an internal transfer in the
+    same transaction, are merged, see _dedupEvents()), and against the loaded events (the events downloaded
+    again with an overlapping interval, or the files rewritten by the compaction of the stage, are skipped
+    by the index). The seller / buyer addresses of the merged events are corrected by their transfers, and
+    the missing ones are filled from the transaction sub-object at the same time (see _correctAddresses()).
+
+    The rows are buffered, and every flush (of _flush_rows rows) is committed as one unit with the key index
+    and the list of the loaded files (see _commitNDSFiles()), so an interrupted run continues from there.
+
+    Inputs:
+     * path_in_trx_folder_pq: the root folder of the stage trx table
+     * path_out_nds_trx_folder_pq: the root folder of the NDS transaction table
+     * path_io_meta_folder: the _meta folder of the NDS loader
+     * _mode='append': 'append' loads the new stage files, 'overwrite' deletes the NDS table (with its key
+       index) and loads all stage files
+     * _flush_rows=1000000, _row_group_rows=250000: the rows of a flush, and of a row group of the files
+     * _verbose=False, _log_sec=60: logging the progress in every _log_sec seconds
+     * _metrics_dir=None, _prometheus_file=None: saving the metrics of the run (see metrics.SaveMetricsReport())
+     * _price_index=None: the folder of a price index (see price_index.PriceIndex): the transactions get their
+       USD / ETH values at the trade time (the _hist columns, see price_index.EnrichTrxValues(), with prices
+       not older than _price_tolerance). None: the _hist columns are empty.
+
+    Gives back the number of the loaded stage files and the number of the new NDS transactions.
+    """
+
+    _runstart = time.time()
+    metrics.reset()
+
+    if not path.exists(path_io_meta_folder):
+        makedirs(path_io_meta_folder)
+    if _mode == 'overwrite':
+        if path.exists(path_out_nds_trx_folder_pq):
+            shutil.rmtree(path_out_nds_trx_folder_pq)
+        for _f in ['02_nds_loader.csv', '_nds_commit.json']:
+            if path.exists(path_io_meta_folder + _f):
+                remove(path_io_meta_folder + _f)
+    _key_index = StageKeyIndex(path_out_nds_trx_folder_pq)
+    _recoverNDSCommit(_key_index, path_out_nds_trx_folder_pq, path_in_trx_folder_pq, path_io_meta_folder)
+
+    # the new stage files by partition (in date order)
+    _loaded = set()
+    if path.exists(path_io_meta_folder + '02_nds_loader.csv'):
+        _loaded = set(pd.read_csv(path_io_meta_folder + '02_nds_loader.csv', dtype='object').stage_file)
+    _runList = []
+    for _values, _files in _stagePartitionFiles(path_in_trx_folder_pq).items():
+        _files = [_f for _f in _files if _f[len(path_in_trx_folder_pq):] not in _loaded]
+        if len(_files) > 0:
+            _runList = _runList + [(_values, _files)]
+    _runList = sorted(_runList, key=lambda x: [-1 if _v is None else _v for _v in x[0]])
+    if _verbose:
+        log('Loading {} new stage files of {} partitions'.format(sum([len(_r[1]) for _r in _runList]), len(_runList)))
+
+    if _price_index is not None:
+        _price_index = PriceIndex(_price_index)
+    _writer = StageWriter(path_out_nds_trx_folder_pq, STAGE_PARTITIONS['nds_trx'], None, _row_group_rows, _table='nds_trx')
+    _pending_keys, _pending_files = {}, []
+    _file_num, _row_num = 0, 0
+    _last_log = time.time()
+    for _i, (_values, _files) in enumerate(_runList):
+        with metrics.timed('nds_read'):
+            pdf_trx = _readStageFiles(_files, _values)
+        metrics.count('nds_stage_rows', pdf_trx.shape[0])
+
+        # one row per event, dropping the events loaded before
+        with metrics.timed('nds_cleanse'):
+            pdf_trx = _correctAddresses(_dedupEvents(pdf_trx))
+        with metrics.timed('nds_index_lookup'):
+            _stored = _key_index.lookup(list(pdf_trx.trx_event_key))
+        _new_flg = np.array([(_k not in _stored) and (_k not in _pending_keys) for _k in pdf_trx.trx_event_key], dtype='bool')
+        metrics.count('nds_duplicate_rows', int(pdf_trx.trx_duplicate_num.sum()) + int((~_new_flg).sum()))
+        pdf_trx = pdf_trx[_new_flg]
+        metrics.count('nds_address_fixes', int((pdf_trx.trx_address_fix > 0).sum()))
+        if _price_index is not None:
+            with metrics.timed('nds_price_enrichment'):
+                pdf_trx = EnrichTrxValues(pdf_trx, _price_index, _price_tolerance)
+
+        _writer.write(pdf_trx)
+        _partition = _partitionDir(STAGE_PARTITIONS['nds_trx'], _values)
+        _pending_keys.update([(_k, _partition) for _k in pdf_trx.trx_event_key])
+        _pending_files = _pending_files + _files
+        _file_num = _file_num + len(_files)
+        _row_num = _row_num + pdf_trx.shape[0]
+
+        if _writer.buffer_rows >= _flush_rows:
+            _commitNDSFiles(_writer, _key_index, _pending_keys, _pending_files, path_in_trx_folder_pq, path_io_meta_folder)
+            _pending_keys, _pending_files = {}, []
+        if _verbose and (time.time() - _last_log >= _log_sec):
+            log('Loaded {} of {} partitions, {} new transactions'.format(_i + 1, len(_runList), _row_num))
+            _last_log = time.time()
+    _commitNDSFiles(_writer, _key_index, _pending_keys, _pending_files, path_in_trx_folder_pq, path_io_meta_folder)
+    _key_index.close()
+    metrics.count('nds_new_rows', _row_num)
+
+    if _verbose:
+        log('NDS loading finished: {} stage files loaded, {} new transactions'.format(_file_num, _row_num))
+    if (_metrics_dir is not None) or (_prometheus_file is not None):
+        metrics.SaveMetricsReport('nds_trx_loader', _metrics_dir, _run_start=_runstart, _prometheus_file=_prometheus_file)
+
+    return _file_num, _row_num
@@ -0,0 +1,239 @@
+##################################################################
+#              API: OpenSea client (shared HTTP layer)           #
+##################################################################
+#                                                                #
+# Questions to marton.szel@lynxanalytics.com                     #
+# Version: 2022-01-31                                            #
+##################################################################
+
+##################################################################
+#                        Import libraries                        #
+##################################################################
+
+# core libraries
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import threading
+import random
+import time
+
+# OS related
+from os import environ
+
+# downloading related
+from . import metrics
+import requests
+from requests.adapters import HTTPAdapter
+
+
+##################################################################
+#                      Retry / Backoff Policy                    #
+##################################################################
+
+def _parseRetryAfter(in_value):
+    """
+    Parsing the value of a Retry-After header (seconds, or an HTTP date) to seconds. Gives back None, if 
+    the header is missing or cannot be parsed.
+    """
+
+    if in_value is None:
+        return None
+    try:
+        return max(0.0, float(in_value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(in_value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Deciding which failed requests are retried and how long to wait before the next attempt:
+     * connection errors, timeouts, 408, 425, 429 and the 5xx responses are retried (temporary problems), 
+       the other 4xx responses are not (the request itself is wrong, a retry would give the same answer)
+     * the waiting time is the Retry-After header of the response if it is given (429/503), otherwise
+       jittered exponential backoff ("full jitter": random between 0 and base * 2^attempt, capped)
+     * 429 and 503 are throttling: the request rate of the key should be lowered
+
+    Inputs:
+     * _max_retries=6: the maximum number of retries of one request
+     * _base_delay=1: the base of the exponential backoff in seconds
+     * _max_delay=120: the maximum waiting time in seconds (also caps the Retry-After)
+    """
+
+    def __init__(self, _max_retries=6, _base_delay=1, _max_delay=120):
+        self.max_retries = _max_retries
+        self.base_delay = _base_delay
+        self.max_delay = _max_delay
+
+    def isRetryable(self, status_code):
+        """
+        Checking if a failed request is worth retrying (status_code=None: connection error or timeout).
+        """
+        return (status_code is None) or (status_code in [408, 425, 429]) or (status_code >= 500)
+
+    def isThrottled(self, status_code):
+        """
+        Checking if the response means that the key is called too often.
+        """
+        return status_code in [429, 503]
+
+    def delay(self, attempt, retry_after=None):
+        """
+        The waiting time in seconds before the given (0-based) retry.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+##################################################################
+#                         OpenSea Client                         #
+##################################################################
+
+OPENSEA_API_URL = 'https://api.opensea.io/api/v1/'
+
+def _apiURL():
+    """
+    The base URL of the API: the OPENSEA_API_URL environment variable if it is set (like the local mock API
+    of the benchmarks, see bench.py), otherwise the OpenSea API.
+    """
+    return environ.get('OPENSEA_API_URL', OPENSEA_API_URL)
+
+
+def _wireBytes(_response, _default):
+    """
+    The number of the bytes received for a response (before the decompression): counted by the
+    underlying urllib3 response, or the Content-Length header (the _default, if neither is known).
+    """
+    try:
+        return int(_response.raw.tell())
+    except (AttributeError, TypeError, ValueError):
+        pass
+    try:
+        return int(_response.headers.get('Content-Length'))
+    except (AttributeError, TypeError, ValueError):
+        return _default
+
+
+class OpenSeaClient:
+    """
+    Reusable OpenSea API client of one API key. It keeps a requests session with a pool of keep-alive
+    connections (so the TCP+TLS handshake is not repeated at every page), and uses explicit connect/read
+    timeouts. The responses come compressed (by the default Accept-Encoding of requests: gzip/deflate, and
+    brotli/zstd if the decoder packages are installed), so the received bytes are counted on the wire. All the loaders (events, later assets and collections) should call the API through it.
+
+    Inputs:
+     * API_key: the API key used by the client
+     * _connect_timeout=5: the connect timeout in seconds
+     * _read_timeout=60: the read timeout in seconds (maximum waiting time between two received bytes)
+     * _pool_size=10: the maximum number of pooled connections (should be at least the number of threads
+       using the client at the same time)
+    """
+
+    def __init__(self, API_key, _connect_timeout=5, _read_timeout=60, _pool_size=10):
+        self.API_key = API_key
+        self.key_label = '...' + API_key[-4:] # the key in the metrics (never the full key)
+        self.timeout = (_connect_timeout, _read_timeout)
+        self.session = requests.Session()
+        _adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size)
+        self.session.mount('https://', _adapter)
+        self.session.mount('http://', _adapter)
+        self.session.headers.update({'Accept': 'application/json', 'X-API-KEY': API_key})
+
+    def get(self, url, params=None):
+        """
+        Calling the given URL (GET), and giving back the response object.
+        """
+        return self.session.get(url, params=params, timeout=self.timeout)
+
+    def getJSON(self, url, params=None):
+        """
+        Calling the given URL (GET), and giving back the status code and the decoded JSON answer (None, if
+        the status code is not 200 or the answer is not a JSON).
+        """
+        _response = self.get(url, params=params)
+        if _response.status_code != 200:
+            return _response.status_code, None
+        try:
+            return _response.status_code, _response.json()
+        except ValueError:
+            return _response.status_code, None
+
+    def getJSONRetry(self, url, params=None, _policy=None, _bucket=None):
+        """
+        Calling the given URL (GET) with retries, following the retry policy (RetryPolicy() if None). Every 
+        attempt waits for the rate limiter of the key first (if a _bucket is given), and the throttling 
+        responses lower the rate of the bucket (while the successful ones restore it step by step).
+
+        Gives back the status code of the last attempt (None: connection error/timeout), the decoded JSON 
+        answer (None, if not successful), and the number of retries. The requests (by status), the received
+        bytes, the retries and the waiting times (rate limiter, backoff) are counted in the metrics of the
+        key.
+        """
+        if _policy is None:
+            _policy = RetryPolicy()
+        
+        _attempt = 0
+        while True:
+            if _bucket is not None:
+                with metrics.timed('api_rate_limit_wait', key=self.key_label):
+                    _bucket.acquire()
+            _retry_after = None
+            try:
+                with metrics.timed('api_request', key=self.key_label):
+                    _response = self.get(url, params=params)
+                _status = _response.status_code
+                # the received (compressed) bytes, and the decompressed size of the answer
+                _content = _response.content
+                metrics.count('api_response_bytes', _wireBytes(_response, len(_content)), key=self.key_label)
+                metrics.count('api_response_bytes_decoded', len(_content), key=self.key_label)
+                if _status == 200:
+                    try:
+                        with metrics.timed('api_json_decode', key=self.key_label):
+                            _answer = _response.json()
+                    except ValueError:
+                        _status, _answer = None, None # broken answer, handled as a connection error
+                else:
+                    _retry_after = _parseRetryAfter(_response.headers.get('Retry-After'))
+            except (requests.ConnectionError, requests.Timeout):
+                _status = None
+            metrics.count('api_requests', key=self.key_label, status=_status)
+            
+            if _status == 200:
+                if _bucket is not None:
+                    _bucket.recover()
+                return _status, _answer, _attempt
+            
+            if (_bucket is not None) and _policy.isThrottled(_status):
+                _bucket.throttle()
+            if (not _policy.isRetryable(_status)) or (_attempt >= _policy.max_retries):
+                return _status, None, _attempt
+            _delay = _policy.delay(_attempt, _retry_after)
+            metrics.count('api_retries', key=self.key_label)
+            metrics.addTime('api_backoff_sleep', _delay, key=self.key_label)
+            time.sleep(_delay)
+            _attempt = _attempt + 1
+
+    def close(self):
+        """
+        Closing the pooled connections.
+        """
+        self.session.close()
+
+
+_CLIENTS = {} # the clients of the process (by API key)
+_CLIENTS_LOCK = threading.Lock()
+
+def _getClient(API_key, _pool_size=10):
+    """
+    Giving back the client of the API key in the current process (creating it at the first call), so the
+    threads using the same key share its connection pool.
+    """
+
+    with _CLIENTS_LOCK:
+        if API_key not in _CLIENTS:
+            _CLIENTS[API_key] = OpenSeaClient(API_key, _pool_size=_pool_size)
+        return _CLIENTS[API_key]
@@ -14,31 +14,348 @@
 import pandas as pd
 import numpy as np
 import json
+import gzip
 
 # core libraries
 from datetime import datetime, timedelta
 import time
+from itertools import islice
+from io import BytesIO
 
 # OS related
-from os import listdir, makedirs, remove, path
+from os import listdir, makedirs, remove, replace, path, getpid, kill
 
 # parallel programming related
-from multiprocessing import Pool
+from multiprocessing import Pool, Manager
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
-
-# downloading related
-import requests
+import threading
+import queue
 
 # loading some own libraries
-from .util import log, _periodFilter
+from .api_client import OpenSeaClient, RetryPolicy, _apiURL, _getClient
+from .catalog import FileCatalog, CATALOG_FILE, _catalogPath
+from .util import log, IntervalSet, _periodFilter, _rawEventFileExists, RAW_EVENT_FORMATS
+from . import metrics
+
+
+##################################################################
+#                         Rate Limiting                          #
+##################################################################
+
+class _TokenBucket:
+    """
+    Thread-safe token bucket for limiting the request rate of one API key. The threads sharing the same key
+    share one bucket, so the key's rate limit holds no matter how many cursor chains are running on it.
+
+    The bucket works with reservations: acquire() takes a token (the counter can go below zero, which means 
+    the token is borrowed from the future), and sleeps until the reserved token becomes available.
+
+    When the API starts throttling the key, throttle() halves the rate (down to _min_rate), and every 
+    successful request gives back a small part of it with recover() - up to the original rate.
+
+    Inputs:
+     * rate: the number of requests allowed per second (the refill speed)
+     * capacity=1: the maximum number of tokens (the size of a burst)
+     * _min_rate=0.05: the lowest rate the throttling can set
+    """
+
+    def __init__(self, rate, capacity=1, _min_rate=0.05):
+        self.rate = float(rate)
+        self.max_rate = float(rate)
+        self.min_rate = min(float(_min_rate), float(rate))
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Taking one token, and waiting until it is available. Gives back the waiting time in seconds.
+        """
+        with self._lock:
+            _now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (_now - self._last) * self.rate)
+            self._last = _now
+            self._tokens = self._tokens - 1
+            _wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if _wait > 0:
+            time.sleep(_wait)
+        return _wait
+
+    def throttle(self, _factor=0.5):
+        """
+        Lowering the rate of the key (multiplicative decrease), after a throttling response.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * _factor)
+        pass
+
+    def recover(self, _step=0.02):
+        """
+        Raising back the rate of the key (additive increase) after a successful request.
+        """
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + _step * self.max_rate)
+        pass
 
 
 ##################################################################
 #                        Transactions DL                         #
 ##################################################################
 
+def _eventTimestamps(in_list_events):
+    """
+    Giving back the transaction times of a list of raw events (the asset_events records of the API) in unix 
+    timestamps, as a numpy array (NaN where the transaction or its timestamp is missing). 
+    
+    It reads only the timestamp field of the records and parses all of them at once (without creating a 
+    DataFrame from the nested dictionaries).
+    """
+
+    _ts = [(_e.get('transaction') or {}).get('timestamp') for _e in in_list_events]
+    try:
+        _ts = np.array(_ts, dtype='datetime64[us]')
+    except ValueError: # not ISO format strings
+        _ts = pd.to_datetime(pd.Series(_ts, dtype='object')).values.astype('datetime64[us]')
+    
+    out_ts = _ts.astype('int64') / 1e6
+    out_ts[np.isnat(_ts)] = np.nan
+    return out_ts
+
+
+def _halveInterval(in_interval):
+    """
+    Splitting a [start, end) interval (unix timestamps) to two halves at a whole second. Intervals shorter 
+    than 2 seconds are not split.
+    """
+
+    _start_dt, _end_dt = int(in_interval[0]), int(in_interval[1])
+    if _end_dt - _start_dt < 2:
+        return [[_start_dt, _end_dt]] if _end_dt > _start_dt else []
+    _mid_dt = _start_dt + (_end_dt - _start_dt) // 2
+    return [[_start_dt, _mid_dt], [_mid_dt, _end_dt]]
+
+
+def _checkpointPrefix(path_dumpdir, _start_dt, _end_dt):
+    """
+    Giving back the path prefix of the checkpoint files of an interval (in the checkpoints subfolder).
+    """
+
+    return path_dumpdir + 'checkpoints/eventresponse_{}_{}'.format(int(_start_dt), int(_end_dt))
+
+
+def _saveCheckpoint(path_ckpt_prefix, in_dict_state):
+    """
+    Saving the state of the cursor chain (last cursor, number of pages, last event time, the size of the 
+    part file) to a json file. The json is replaced atomically, so a crash leaves the earlier (consistent) 
+    checkpoint behind.
+    """
+
+    with open(path_ckpt_prefix + '.json.tmp', 'w') as _f:
+        json.dump(in_dict_state, _f)
+    replace(path_ckpt_prefix + '.json.tmp', path_ckpt_prefix + '.json')
+    pass
+
+
+def _loadCheckpoint(path_ckpt_prefix):
+    """
+    Loading the state of an interrupted cursor chain (None, if there is no checkpoint).
+    """
+
+    if not path.exists(path_ckpt_prefix + '.json'):
+        return None
+    with open(path_ckpt_prefix + '.json') as _f:
+        return json.load(_f)
+
+
+def _readNDJSONChunks(path_file, _chunk_lines=10000, _schema=None):
+    """
+    Reading a newline delimited JSON file to Arrow tables of _chunk_lines records (with the given schema, or
+    the inferred one of the chunk), so neither the file nor an Arrow block has to fit at once (an Arrow JSON
+    block is limited to 2GB).
+    """
+    import pyarrow.json as pajson
+
+    _parse_options = None if _schema is None else pajson.ParseOptions(explicit_schema=_schema)
+    with open(path_file, 'rb') as _f:
+        while True:
+            _chunk = b''.join(islice(_f, _chunk_lines))
+            if len(_chunk) == 0:
+                break
+            yield pajson.read_json(BytesIO(_chunk), read_options=pajson.ReadOptions(block_size=len(_chunk) + 1),
+                                   parse_options=_parse_options)
+
+
+class _EventPageSink:
+    """
+    Streaming writer of the downloaded pages: the raw asset_events records of every page are appended to a
+    newline delimited JSON part file (in the checkpoints subfolder) as they arrive, so the memory use of a 
+    download thread does not depend on the size of the interval. When the interval is finished, the output
+    file is created from the part file - written to a temp file and renamed, so a finished output file is 
+    never partial.
+
+    Inputs:
+     * path_part: the path of the part file
+     * _offset=0: the size of the part file to continue from (at a restart from a checkpoint, the pages 
+       written after the checkpoint are cut). 0 means starting a new part file.
+    """
+
+    def __init__(self, path_part, _offset=0):
+        self.path_part = path_part
+        # the threads of one session share the folder, so creating it must not fail if an other thread was faster
+        makedirs(path.dirname(path_part), exist_ok=True)
+        with open(path_part, 'ab') as _f:
+            _f.truncate(_offset)
+        self.offset = _offset
+
+    def write(self, in_list_records):
+        """
+        Appending the records of a page to the part file.
+        """
+        if len(in_list_records) > 0:
+            with open(self.path_part, 'ab') as _f:
+                _f.write(''.join([json.dumps(_r) + '\n' for _r in in_list_records]).encode('utf-8'))
+                self.offset = _f.tell()
+        pass
+
+    def iterLines(self, _min_dt=None, _chunk_lines=10000):
+        """
+        Reading back the part file in chunks of raw JSON lines (only the events not earlier than _min_dt, if 
+        it is given), so the part file is never loaded at once.
+        """
+        with open(self.path_part, 'rb') as _f:
+            while True:
+                _lines = list(islice(_f, _chunk_lines))
+                if len(_lines) == 0:
+                    break
+                if _min_dt is not None:
+                    _ts = _eventTimestamps([json.loads(_l) for _l in _lines])
+                    _lines = [_l for _l, _t in zip(_lines, _ts) if _t >= _min_dt]
+                yield _lines
+
+    def finish(self, path_out_prefix, _min_dt=None, _out_format='pickle'):
+        """
+        Writing out the downloaded events (only the events not earlier than _min_dt, if it is given) to the
+        output file (path_out_prefix + '.' + _out_format), and deleting the part file. Gives back the 
+        number of records written and the path of the output file.
+
+        The output formats:
+         * pickle: DataFrame of the records (the cells are nested dictionaries) - the original format. The
+           whole interval is loaded to the DataFrame, so it is the only format where the memory use grows
+           with the size of the interval.
+         * ndjson.gz: gzip compressed newline delimited JSON (the raw records, streamed from the part file)
+         * parquet: Arrow/Parquet file with struct columns (zstd compressed), so the readers can load only
+           the columns they need. If the records cannot be converted (e.g. an inconsistent nested schema), 
+           the events are saved as ndjson.gz.
+        """
+        _nrows = 0
+        path_out = path_out_prefix + '.' + _out_format
+        if _out_format == 'pickle':
+            out_df = pd.DataFrame([json.loads(_l) for _lines in self.iterLines(_min_dt) for _l in _lines])
+            out_df.to_pickle(path_out + '.tmp', compression=None)
+            _nrows = out_df.shape[0]
+        elif _out_format == 'ndjson.gz':
+            with gzip.open(path_out + '.tmp', 'wb') as _f:
+                for _lines in self.iterLines(_min_dt):
+                    _f.write(b''.join(_lines))
+                    _nrows = _nrows + len(_lines)
+        elif _out_format == 'parquet':
+            import pyarrow.parquet as pq
+            import pyarrow as pa
+            # the filtered records are collected to a second part file, which is read in chunks twice: first
+            # the schemas of the chunks are unified (a field can be empty in a chunk and nested in another), then
+            # the chunks are converted with the common schema and appended to the parquet file
+            with open(self.path_part + '.flt', 'wb') as _f:
+                for _lines in self.iterLines(_min_dt):
+                    _f.write(b''.join(_lines))
+                    _nrows = _nrows + len(_lines)
+            try:
+                if _nrows > 0:
+                    _schema = pa.unify_schemas([_t.schema for _t in _readNDJSONChunks(self.path_part + '.flt')],
+                                               promote_options='permissive')
+                    with pq.ParquetWriter(path_out + '.tmp', _schema, compression='zstd') as _writer:
+                        for _table in _readNDJSONChunks(self.path_part + '.flt', _schema=_schema):
+                            _writer.write_table(_table)
+                else:
+                    pq.write_table(pa.table({}), path_out + '.tmp', compression='zstd')
+                remove(self.path_part + '.flt')
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as _e:
+                log('Warning: the events cannot be saved as parquet ({}), saving them as ndjson.gz'.format(str(_e)[:200]))
+                remove(self.path_part + '.flt')
+                if path.exists(path_out + '.tmp'):
+                    remove(path_out + '.tmp')
+                return self.finish(path_out_prefix, _min_dt, 'ndjson.gz')
+        else:
+            raise ValueError('Unknown raw output format: {} (should be one of {})'.format(_out_format, RAW_EVENT_FORMATS))
+        
+        replace(path_out + '.tmp', path_out)
+        remove(self.path_part)
+        return _nrows, path_out
+
+
+def _removeCheckpoint(path_ckpt_prefix):
+    """
+    Deleting the checkpoint files of an interval (after its output is written).
+    """
+
+    _dir = path.dirname(path_ckpt_prefix)
+    if path.exists(_dir):
+        for _f in listdir(_dir):
+            if _f.startswith(path.basename(path_ckpt_prefix) + '.'):
+                remove(path.join(_dir, _f))
+    pass
+
+
+def _checkpointIntervals(path_dumpdir):
+    """
+    The intervals of the checkpoint files of a session folder (checkpoints/eventresponse_<start>_<end>.*): 
+    {(start, end): True if the interval has a saved checkpoint state (.json), False if only a part file}.
+    """
+
+    out_dict = {}
+    if path.exists(path_dumpdir + 'checkpoints/'):
+        for _f in listdir(path_dumpdir + 'checkpoints/'):
+            _parts = _f.split('.', 1)[0].split('_')
+            if _f.startswith('eventresponse_') and (len(_parts) == 3) and _parts[1].isdigit() and _parts[2].isdigit():
+                _interval = (int(_parts[1]), int(_parts[2]))
+                out_dict[_interval] = out_dict.get(_interval, False) or _f.endswith('.json')
+    return out_dict
+
+
+def _resumableIntervals(path_dumpdir, _intervals):
+    """
+    Separating the planned intervals (the parts not covered by the catalog yet) to the intervals of the saved
+    checkpoints and the rest: an interval with a checkpoint keeps its bounds, so it is continued from its last
+    cursor, however the rest is split or merged (like by the density of the adaptive mode). The checkpoint 
+    files which are fully covered by the catalog (the interval is downloaded since then) are deleted.
+
+    Gives back the list of the checkpoint intervals and the list of the rest of the planned intervals.
+    """
+
+    _planned = IntervalSet(_intervals)
+    with FileCatalog(_catalogPath(path_dumpdir)) as _catalog:
+        _coverage = _catalog.coverage(path_dumpdir)
+    _resumed = IntervalSet()
+    out_ckpt_intervals = []
+    for (_start, _end), _state_flg in sorted(_checkpointIntervals(path_dumpdir).items()):
+        if _coverage.covers(_start, _end):
+            _removeCheckpoint(_checkpointPrefix(path_dumpdir, _start, _end))
+            metrics.count('dl_checkpoints', outcome='removed')
+        elif _state_flg and _planned.covers(_start, _end) and (_resumed.missing(_start, _end) == [[_start, _end]]):
+            out_ckpt_intervals = out_ckpt_intervals + [[_start, _end]]
+            _resumed.add(_start, _end)
+            metrics.count('dl_checkpoints', outcome='resumed')
+    out_intervals = [_part for _interval in _intervals for _part in _resumed.missing(_interval[0], _interval[1])]
+
+    return out_ckpt_intervals, out_intervals
+
+
 def _timeInterval_eventDL_oneThread(API_key, filter_dict, time_interval, path_dumpdir, batchsize=300, 
-                                    time_interval_unixts=[], _verbose=False, _timeout_limit=0, _existchk=True):
+                                    time_interval_unixts=[], _verbose=False, _timeout_limit=0, _existchk=True,
+                                    _bucket=None, _max_pages=0, _checkpoint_pages=0, _out_format='pickle', _client=None, 
+                                    _retry_policy=None):
     """
     Downloading the Event Table within the given time range, using the added filters from the 
     given dictionary (should be same as the API).
@@ -52,8 +369,30 @@ def _timeInterval_eventDL_oneThread(API_key, filter_dict, time_interval, path_du
      * time_interval_unixts: the time inteval can be added in unix timestamps. 
        It'll overwrite the time_interval input!
      * _existchk=True: it is not loading the file if it is already available
+     * _bucket=None: a _TokenBucket shared by the threads using the same API key (no rate limit if None)
+     * _max_pages=0: the maximum length of the cursor chain (0=infinite). If the chain gets longer (or the 
+       timeout limit is reached), the downloaded part of the interval is saved, and the rest is given back
+       (split in half) for rescheduling - instead of dropping the whole interval as a timeout error.
+     * _checkpoint_pages=0: saving a checkpoint (the last "next" cursor + the size of the streamed part file)
+       after every _checkpoint_pages pages (0=no checkpoints). A restarted download of the same interval 
+       continues from the last cursor of the checkpoint (also after an error / crash).
+
+     * _out_format='pickle': the format of the output file ('pickle', 'ndjson.gz' or 'parquet', see the 
+       _EventPageSink.finish() function)
+     * _client=None: the OpenSeaClient used for the requests (None: the shared client of the API key in the
+       process, so the connections are reused across the intervals)
+     * _retry_policy=None: the RetryPolicy of the failed requests (None: the default policy). The temporary
+       errors (timeouts, 429, 5xx) are retried with backoff (honouring Retry-After), and the throttling 
+       responses lower the rate of the key's bucket. The interval ends with an error only if a request 
+       fails permanently (4xx) or runs out of retries - and it can be continued from its checkpoint.
+
+    The pages are streamed to a part file (see _EventPageSink), and the output is created from it at the end.
+
+    Gives back the list of intervals still to be downloaded (empty, if the whole interval is done).
     """
     
+    _todo_intervals = []
+
     # dictionary of saving the errors
     _err_dict = {'event_name':[], 'event_input_url':[], 'event_response_dict':[]}
 
@@ -73,16 +412,14 @@ def _timeInterval_eventDL_oneThread(API_key, filter_dict, time_interval, path_du
         _end_dt = pd.to_datetime(time_interval[1]).timestamp()
         _start_dt = pd.to_datetime(time_interval[0]).timestamp()
     
-    if (path.exists(path_dumpdir + 'eventresponse_{}_{}.pickle'.format(int(_start_dt), int(_end_dt)))) and (_existchk):
+    if _rawEventFileExists(path_dumpdir, _start_dt, _end_dt) and (_existchk):
         if _verbose:
             log("File already exists...")
     else:
 
         # Downloading and Writing Out the file if does not exist
 
-        _out_df_list = []
-
-        _base_URL = 'https://api.opensea.io/api/v1/events?'
+        _base_URL = _apiURL() + 'events?'
 
         # adding the filters (creating the base URL)
         for _filter in filter_dict.keys():
@@ -92,40 +429,61 @@ def _timeInterval_eventDL_oneThread(API_key, filter_dict, time_interval, path_du
         _base_URL = _base_URL + 'occurred_before={}&limit={}'.format(int(_end_dt), batchsize)
         _url = _base_URL
         
-        # creating a header
-        headers = {"Accept": "application/json", "X-API-KEY": API_key}
+        # the client of the key (pooled keep-alive connections, compressed responses, timeouts)
+        if _client is None:
+            _client = _getClient(API_key)
 
         _keepRunning = True
-        _emptycnt = 0 # counting the empty responses
+        _pagecnt = 0  # counting the pages with events
+        _mindt = None # the last (earliest) event time arrived
+        _split_dt = None
+        _reschedule = False # split before any event time arrived: the whole interval is rescheduled
+
+        # continuing from the last checkpoint (if any, and if its part file is complete)
+        _ckpt_prefix = _checkpointPrefix(path_dumpdir, _start_dt, _end_dt)
+        _ckpt_state = _loadCheckpoint(_ckpt_prefix)
+        if (_ckpt_state is not None) and (path.exists(_ckpt_prefix + '.ndjson.part')) and (
+            path.getsize(_ckpt_prefix + '.ndjson.part') >= _ckpt_state['offset']):
+            _url = _base_URL + '&cursor={}'.format(_ckpt_state['cursor'])
+            _pagecnt = _ckpt_state['pages']
+            _mindt = _ckpt_state['mindt']
+            if _verbose:
+                log('Continuing the {} - {} interval from page {}'.format(msg_interval[0], msg_interval[1], _pagecnt))
+        else:
+            _ckpt_state = {'cursor':None, 'pages':0, 'mindt':None, 'offset':0}
+        _ckpt_pagecnt = _pagecnt
+        _sink = _EventPageSink(_ckpt_prefix + '.ndjson.part', _ckpt_state['offset'])
         
         # the cycle of data requests
         while _keepRunning:
 
-            # request the data
-            _response = requests.request("GET", _url, headers=headers)
-            if _response.status_code == 200:
-                _answer = json.loads(_response.content.decode('utf-8'))
+            # request the data (retrying the temporary errors, waiting for the key's rate limit)
+            _status, _answer, _ = _client.getJSONRetry(_url, _policy=_retry_policy, _bucket=_bucket)
+            if (_status == 200) and (_answer is not None):
+                metrics.count('dl_pages')
                 # check if data is arrived (and not empty)
                 if 'asset_events' in list(_answer.keys()):
                     if (_answer['asset_events'] != []) and (_answer['asset_events'] != None):
-                        _tmp_df = pd.DataFrame(_answer['asset_events'])
                         # cleansing events with missing trx time (those are anyway non-sucessful)
-                        _tmp_df = _tmp_df[(~_tmp_df.transaction.apply(pd.Series).timestamp.isnull())]
-
-                        # checking the min time in the DataFrame (for stopping the cycle)
-                        # also, cutting out the part of the DataFrame which is not in the asked time interval
-                        _mindt = pd.to_datetime(_tmp_df.iloc[-1].transaction['timestamp']).timestamp()
-                        if _mindt < _start_dt:
-                            _keepRunning = False
-                            print(_tmp_df[(_tmp_df.transaction.apply(pd.Series).timestamp.isnull())].head())
-                            _tmp_df = _tmp_df[_tmp_df.transaction.apply(pd.Series).timestamp.apply(lambda x: pd.to_datetime(x).timestamp()) >= _start_dt]
+                        _ts = _eventTimestamps(_answer['asset_events'])
+                        _keep = ~np.isnan(_ts)
+
+                        # checking the min time of the page (for stopping the cycle)
+                        # also, cutting out the part of the page which is not in the asked time interval
+                        if _keep.any():
+                            _mindt = _ts[_keep][-1]
+                            _pagecnt = _pagecnt + 1
+                            if _mindt < _start_dt:
+                                _keepRunning = False
+                                _keep = _keep & (_ts >= _start_dt)
+                        _records = [_e for _e, _k in zip(_answer['asset_events'], _keep) if _k]
                     else:
-                        _tmp_df = pd.DataFrame()
+                        _records = []
                         _err_dict['event_name'] = _err_dict['event_name'] + ['Empty Asset Event Table']
                         _err_dict['event_input_url'] = _err_dict['event_input_url'] + [_url]
                         _err_dict['event_response_dict'] = _err_dict['event_response_dict'] + [_answer]
                 else:
-                    _tmp_df = pd.DataFrame()
+                    _records = []
                     log('Warning: within the {} - {} interval there were no response dataset. The answer dictionary was the following: {}. Used base URL: {}'.format(
                         msg_interval[0], msg_interval[1], str(_answer), _base_URL))
                     _err_dict['event_name'] = _err_dict['event_name'] + ['Response w/o Asset Event Table']
@@ -136,25 +494,52 @@ def _timeInterval_eventDL_oneThread(API_key, filter_dict, time_interval, path_du
                 if 'next' in list(_answer.keys()):
                     if _answer['next'] != None:
                         _url = _base_URL + '&cursor={}'.format(_answer['next'])
+                        _ckpt_state['cursor'] = _answer['next']
                     else:
                         _keepRunning = False
                 else:
                     _keepRunning = False
             
             else:
-                _tmp_df = pd.DataFrame()
-                _emptycnt = _emptycnt + 1
-                time.sleep(1)
-                if _emptycnt > 3:
-                    _err_dict['event_name'] = _err_dict['event_name'] + ['Empty response over 5 times']
-                    _err_dict['event_input_url'] = _err_dict['event_input_url'] + [_url]
-                    _err_dict['event_response_dict'] = _err_dict['event_response_dict'] + ['Status code: {}'.format(_response.status_code)]
-                    _keepRunning = False
+                # the request failed permanently (client error), or it ran out of retries
+                _records = []
+                _keepRunning = False
+                if (_status is not None) and (400 <= _status < 500) and (_status not in [408, 425, 429]):
+                    _err_dict['event_name'] = _err_dict['event_name'] + ['Client error response']
+                else:
+                    _err_dict['event_name'] = _err_dict['event_name'] + ['Request failed after retries']
+                _err_dict['event_input_url'] = _err_dict['event_input_url'] + [_url]
+                _err_dict['event_response_dict'] = _err_dict['event_response_dict'] + ['Status code: {}'.format(_status)]
             
-            _out_df_list = _out_df_list + [_tmp_df]
+            # streaming the raw records of the kept events to the part file
+            _sink.write(_records)
+            metrics.count('dl_events', len(_records))
+
+            # saving a checkpoint
+            if _keepRunning and (_checkpoint_pages > 0) and (_pagecnt - _ckpt_pagecnt >= _checkpoint_pages):
+                _ckpt_state = dict(_ckpt_state, pages=_pagecnt, mindt=_mindt, offset=_sink.offset)
+                _saveCheckpoint(_ckpt_prefix, _ckpt_state)
+                _ckpt_pagecnt = _pagecnt
+
+            # checking the length of the cursor chain (intervals shorter than 2 seconds are not split)
+            _chain_limit = (_max_pages > 0) and (_pagecnt >= _max_pages) and (_end_dt - _start_dt > 1)
+            _chain_timeout = (_timeout_limit > 0) and (time.time() - _runstart > _timeout_limit)
+            if _keepRunning and (_chain_limit or (_chain_timeout and _max_pages > 0 and 
+                                                  ((_mindt is not None) or (_end_dt - _start_dt > 1)))):
+                _keepRunning = False
+                if _mindt is None:
+                    # nothing is downloaded which could be saved: the whole interval goes back in two halves
+                    _reschedule = True
+                    log('Warning: no event time arrived within the {} - {} interval before the split, it is '
+                        'rescheduled'.format(msg_interval[0], msg_interval[1]))
+                else:
+                    _split_dt = np.floor(_mindt) + 1 # the last second might be partial
+                    if _verbose:
+                        log('Splitting the {} - {} interval at {} ({} pages downloaded)'.format(
+                            msg_interval[0], msg_interval[1], int(_split_dt), _pagecnt))
             
             # checking for timeout event
-            if (_timeout_limit > 0) and (time.time() - _runstart > _timeout_limit):
+            elif _chain_timeout:
                 _keepRunning = False
                 log('Error: within the {} - {} interval time out event occurred. Used base URL: {}. Use higher limit, or smaller interval'.format(
                     msg_interval[0], msg_interval[1], _base_URL))
@@ -164,30 +549,51 @@ def _timeInterval_eventDL_oneThread(API_key, filter_dict, time_interval, path_du
         
         # Handling the errors if any is collected
         if len(_err_dict['event_name']) > 0:
-            if not path.exists(path_dumpdir + 'errors/'):
-                makedirs(path_dumpdir + 'errors/')
+            makedirs(path_dumpdir + 'errors/', exist_ok=True)
             pd.DataFrame(_err_dict).to_pickle(path_dumpdir + 'errors/runtimeerror_{}_{}.pickle'.format(int(_start_dt), int(_end_dt)))
+            metrics.count('dl_intervals', outcome='error')
             if _verbose:
                 log('Errors occured at file from {} to {}.'.format(msg_interval[0], msg_interval[1]))
+        elif _reschedule:
+            # nothing is written or registered (the interval is not covered yet)
+            _todo_intervals = _halveInterval([_start_dt, _end_dt])
+            metrics.count('dl_intervals', outcome='rescheduled')
+            _removeCheckpoint(_ckpt_prefix)
         else:
-        # appending and writing out the results to the dumping directory
-            out_df = pd.concat(_out_df_list, axis=0).reset_index(drop=True)
-            if not path.exists(path_dumpdir):
-                makedirs(path_dumpdir)
-            out_df.to_pickle(path_dumpdir + 'eventresponse_{}_{}.pickle'.format(int(_start_dt), int(_end_dt)))
+        # writing out the results from the part file to the dumping directory
+            _out_start_dt = _start_dt
+            if _split_dt is not None:
+                # keeping only the fully downloaded part, and giving back the rest for rescheduling
+                _out_start_dt = min(_split_dt, _end_dt)
+                _todo_intervals = _halveInterval([_start_dt, _out_start_dt])
 
-            if _verbose:
-                log('Downloading finished from {} to {} with creating {} records'.format(msg_interval[0], msg_interval[1], out_df.shape[0]))
+            metrics.count('dl_intervals', outcome='done' if _split_dt is None else 'split')
+            if _out_start_dt < _end_dt:
+                with metrics.timed('dl_write_output'):
+                    _nrows, _path_out = _sink.finish(path_dumpdir + 'eventresponse_{}_{}'.format(int(_out_start_dt), int(_end_dt)), 
+                                             _min_dt=_out_start_dt if _split_dt is not None else None, _out_format=_out_format)
+                with FileCatalog(_catalogPath(path_dumpdir)) as _catalog:
+                    _catalog.registerFile(_path_out, _nrows)
+                _logIntervalDensity(path_dumpdir, _out_start_dt, _end_dt, _nrows)
 
-    pass
+                if _verbose:
+                    log('Downloading finished from {} to {} with creating {} records'.format(int(_out_start_dt), msg_interval[1], _nrows))
+            _removeCheckpoint(_ckpt_prefix)
+
+    return _todo_intervals
 
 
 def _timeInterval_eventDL_oneThreadWrapper(in_dict_params):
     """
-    Running the _timeInterval_eventDL_oneThread() function from an input dictionary.
+    Running the _timeInterval_eventDL_oneThread() function from an input dictionary. Gives back the intervals
+    to be rescheduled (an interval ended with a runtime error is not rescheduled).
     """
 
     API_key = in_dict_params['API_key']
+    _bucket = in_dict_params.get('_bucket')
+    if API_key is None:
+        API_key = _WORKER_API_KEY # the key (and its rate limiter) owned by the pool worker
+        _bucket = _WORKER_BUCKET
     filter_dict = in_dict_params['filter_dict']
     time_interval = in_dict_params['time_interval']
     path_dumpdir = in_dict_params['path_dumpdir']
@@ -196,19 +602,25 @@ def _timeInterval_eventDL_oneThreadWrapper(in_dict_params):
     _verbose = in_dict_params['_verbose']
     _timeout_limit = in_dict_params['_timeout_limit']
     _existchk=in_dict_params['_existchk']
+    _max_pages = in_dict_params.get('_max_pages', 0)
+    _checkpoint_pages = in_dict_params.get('_checkpoint_pages', 0)
+    _out_format = in_dict_params.get('_out_format', 'pickle')
+    _client = in_dict_params.get('_client')
+    _retry_policy = in_dict_params.get('_retry_policy')
     
     # _timeInterval_eventDL_oneThread(API_key=API_key, filter_dict=filter_dict, time_interval=time_interval, 
     #                                     path_dumpdir=path_dumpdir, batchsize=batchsize, time_interval_unixts=time_interval_unixts,
     #                                     _verbose=_verbose, _timeout_limit=_timeout_limit, _existchk=_existchk)
     
     try:
-        _timeInterval_eventDL_oneThread(API_key=API_key, filter_dict=filter_dict, time_interval=time_interval, 
+        return _timeInterval_eventDL_oneThread(API_key=API_key, filter_dict=filter_dict, time_interval=time_interval, 
                                         path_dumpdir=path_dumpdir, batchsize=batchsize, time_interval_unixts=time_interval_unixts,
-                                        _verbose=_verbose, _timeout_limit=_timeout_limit, _existchk=_existchk)
+                                        _verbose=_verbose, _timeout_limit=_timeout_limit, _existchk=_existchk,
+                                        _bucket=_bucket, _max_pages=_max_pages, _checkpoint_pages=_checkpoint_pages, 
+                                        _out_format=_out_format, _client=_client, _retry_policy=_retry_policy)
     except:
         _err_dict = {'event_name':['Other Runtime Error'], 'event_input_url':['NA'], 'event_response_dict':['NA']}
-        if not path.exists(path_dumpdir + 'errors/'):
-            makedirs(path_dumpdir + 'errors/')
+        makedirs(path_dumpdir + 'errors/', exist_ok=True)
         if len(time_interval_unixts) > 0:
             _end_dt = time_interval_unixts[1]
             _start_dt = time_interval_unixts[0]
@@ -217,22 +629,259 @@ def _timeInterval_eventDL_oneThreadWrapper(in_dict_params):
             _start_dt = pd.to_datetime(time_interval[0]).timestamp()
         pd.DataFrame(_err_dict).to_pickle(path_dumpdir + 'errors/runtimeerror_{}_{}.pickle'.format(int(_start_dt), int(_end_dt)))
     
+    return []
+
+
+_WORKER_API_KEY = None # the API key of a TimeIntervalEventDL() pool worker (set by _initKeyWorker)
+_WORKER_BUCKET = None  # the rate limiter of the worker's API key
+
+def _processAlive(_pid):
+    """
+    Checking if a process (of this machine) is still running.
+    """
+    try:
+        kill(_pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _initKeyWorker(in_key_owners, in_lock, _requests_per_sec=2):
+    """
+    Initializing a pool worker of TimeIntervalEventDL(): the worker takes one API key (a key without a 
+    running owner worker, from the shared {key: owner pid} dictionary), and uses it for all the intervals it 
+    is pulling from the pool's (shared) task queue. So a worker started by the pool in the place of a dead 
+    one gets the key of the dead worker (if every key is owned, the first key is shared, never waiting).
+    """
+
+    global _WORKER_API_KEY, _WORKER_BUCKET
+    metrics.reset() # not counting the metrics inherited from the parent process again
+    with in_lock:
+        _free = [_key for _key, _pid in in_key_owners.items() if (_pid is None) or (not _processAlive(_pid))]
+        _WORKER_API_KEY = _free[0] if len(_free) > 0 else list(in_key_owners.keys())[0]
+        in_key_owners[_WORKER_API_KEY] = getpid()
+    _WORKER_BUCKET = _TokenBucket(rate=_requests_per_sec)
     pass
 
 
-def _listrunner_timeInterval_eventDL(list_of_in_dict_params):
+def _checkAPIKeys(list_of_API_keys):
     """
-    Running Events in a Loop (Serial). As one key can initiate one thread at the time, their requests should
-    run serial.
+    Checking that there is at least one API key to download with (ValueError otherwise).
+    """
+    if len(list_of_API_keys) == 0:
+        raise ValueError('At least one API key is needed for the download, got an empty key list')
+    pass
+
+
+def _planEventIntervals(time_interval, time_batch_sec, path_out_dumpdir):
     """
+    Calculating the output folder of a download session and the list of time intervals (in unix timestamps)
+    which should be downloaded: cutting the time_interval to time_batch_sec long pieces, and filtering out
+    those parts which are already covered by the files in the output folder.
+    """
+
+    # converting dates, calculates the pathnames
+    _start_dt = pd.to_datetime(time_interval[0]).timestamp()
+    _end_dt = pd.to_datetime(time_interval[1]).timestamp()
+    _start_yyyymmdd_hhmmss = time_interval[0].replace(' ', '_').replace('-', '').replace(':', '')
+    _end_yyyymmdd_hhmmss = time_interval[1].replace(' ', '_').replace('-', '').replace(':', '')
+    _outhpath = path_out_dumpdir + 'events_{}_{}/'.format(_start_yyyymmdd_hhmmss, _end_yyyymmdd_hhmmss)
+    
+    # calculate the number of time intervals
+    _intervals = []
+    _ct = _start_dt
+    while _ct < _end_dt:
+        _intervals = _intervals + [[_ct, _ct + time_batch_sec]]
+        _ct = _ct + time_batch_sec
+        
+    # calculating the necessary intervals to download (cutting out the raw files registered in the catalog)
+    if not path.exists(path_out_dumpdir):
+        makedirs(path_out_dumpdir)
+    with FileCatalog(path_out_dumpdir + CATALOG_FILE) as _catalog:
+        _intervals = _periodFilter(_intervals, _catalog.coverage(_outhpath))
+
+    return _outhpath, _intervals
+
+
+def _logIntervalDensity(path_dumpdir, _start_dt, _end_dt, _nrows):
+    """
+    Appending the number of downloaded events of an interval to the _density.csv file of the dump folder.
+    These records are the base of the cost estimation of the later downloads.
+    """
+
+    with open(path_dumpdir + '_density.csv', 'a') as _f:
+        _f.write('{},{},{}\n'.format(int(_start_dt), int(_end_dt), int(_nrows)))
+    pass
+
+
+def _densityProfile(path_out_dumpdir):
+    """
+    Collecting the observed event densities (events / sec) from all the download sessions of the main dump
+    directory (reading the _density.csv files of the events_* subfolders). Gives back a DataFrame sorted by
+    the middle of the intervals (empty, if there is no earlier download).
+    """
+
+    _cols = ['period_start', 'period_end', 'event_num']
+    _read_pdfs = [pd.DataFrame(columns=_cols)]
+    if path.exists(path_out_dumpdir):
+        for _dir in listdir(path_out_dumpdir):
+            if _dir.startswith('events_') and path.exists(path_out_dumpdir + _dir + '/_density.csv'):
+                _read_pdfs = _read_pdfs + [pd.read_csv(path_out_dumpdir + _dir + '/_density.csv', names=_cols)]
+    
+    out_df = pd.concat(_read_pdfs, axis=0).astype('float').drop_duplicates(subset=['period_start', 'period_end'], keep='last')
+    out_df = out_df[out_df.period_end > out_df.period_start]
+    out_df['period_mid'] = (out_df.period_start + out_df.period_end) / 2
+    out_df['density'] = out_df.event_num / (out_df.period_end - out_df.period_start)
+
+    return out_df.sort_values(by='period_mid').reset_index(drop=True)
+
+
+def _estimateIntervalCost(_intervals, pdf_density, _neighbours=2):
+    """
+    Estimating the number of events in each interval: the length of the interval multiplied by the average 
+    density of the nearest (_neighbours on both sides) earlier downloaded intervals. Without any earlier
+    download, the cost is simply the length of the interval.
+    """
+
+    _intervals = np.array(_intervals, dtype='float').reshape(-1, 2)
+    _lengths = _intervals[:, 1] - _intervals[:, 0]
+    if pdf_density.shape[0] == 0:
+        return _lengths
+
+    _mids = pdf_density.period_mid.values
+    _csum = np.concatenate([[0], np.cumsum(pdf_density.density.values)])
+    _pos = np.searchsorted(_mids, (_intervals[:, 0] + _intervals[:, 1]) / 2)
+    _lo = np.clip(_pos - _neighbours, 0, len(_mids))
+    _hi = np.clip(_pos + _neighbours, 0, len(_mids))
+    _density = (_csum[_hi] - _csum[_lo]) / np.maximum(_hi - _lo, 1)
+
+    return _lengths * _density
+
+
+def _adaptIntervals(_intervals, pdf_density, _target_events):
+    """
+    Adapting the planned intervals to the observed event density: the intervals with more estimated events
+    than _target_events are split to equal parts, while the neighbouring (touching) sparse intervals are 
+    merged, as long as the merged interval is estimated below the _target_events. Without any earlier
+    download (no density info), the intervals are given back as they are.
+    """
+
+    if (pdf_density.shape[0] == 0) or (len(_intervals) == 0):
+        return _intervals
+
+    # splitting the dense intervals
+    _split_intervals = []
+    for _interval, _events in zip(_intervals, _estimateIntervalCost(_intervals, pdf_density)):
+        _parts = int(min(np.ceil(_events / _target_events), _interval[1] - _interval[0]))
+        if _parts > 1:
+            _bounds = np.linspace(_interval[0], _interval[1], _parts + 1).round().astype('int64')
+            _split_intervals = _split_intervals + [[_bounds[i], _bounds[i + 1]] for i in range(_parts)]
+        else:
+            _split_intervals = _split_intervals + [[_interval[0], _interval[1]]]
+    _split_intervals.sort()
+
+    # merging the sparse neighbours
+    _events = _estimateIntervalCost(_split_intervals, pdf_density)
+    out_intervals = [_split_intervals[0]]
+    _merged_events = _events[0]
+    for _interval, _ev in zip(_split_intervals[1:], _events[1:]):
+        if (out_intervals[-1][1] == _interval[0]) and (_merged_events + _ev <= _target_events):
+            out_intervals[-1] = [out_intervals[-1][0], _interval[1]]
+            _merged_events = _merged_events + _ev
+        else:
+            out_intervals = out_intervals + [_interval]
+            _merged_events = _ev
+
+    return out_intervals
+
+
+def _costOrderedRunList(_intervals, pdf_density, filter_dict, path_dumpdir, batchsize, _verbose, 
+                        _timeout_limit, _existchk, _max_pages=0, _checkpoint_pages=0, _out_format='pickle'):
+    """
+    Creating the input dictionaries of the download threads, ordered by the estimated cost of the intervals 
+    (the most expensive first). The API key is not set (API_key=None), the worker pulling the interval adds
+    its own key.
+    """
+
+    _costs = _estimateIntervalCost(_intervals, pdf_density)
+    _order = np.argsort(-_costs, kind='stable')
+
+    return [{'API_key':None, 'filter_dict':filter_dict, 'time_interval':[], 'path_dumpdir':path_dumpdir, 
+             'batchsize':batchsize, 'time_interval_unixts':_intervals[i], '_verbose':_verbose, 
+             '_timeout_limit':_timeout_limit, '_existchk':_existchk, '_max_pages':_max_pages, 
+             '_checkpoint_pages':_checkpoint_pages, '_out_format':_out_format} for i in _order]
+
+
+def _planEventRunList(time_interval, time_batch_sec, path_out_dumpdir, filter_dict, batchsize, _verbose, 
+                      _timeout_limit, _existchk, _adaptive, _max_pages, _checkpoint_pages, _out_format):
+    """
+    Planning a download session (common part of TimeIntervalEventDL and ThreadedTimeIntervalEventDL): gives back
+    the output folder, the cost ordered list of the thread inputs, and the density profile.
+    """
+
+    _outhpath, _intervals = _planEventIntervals(time_interval, time_batch_sec, path_out_dumpdir)
+    pdf_density = _densityProfile(path_out_dumpdir)
+    # the interrupted intervals are planned with the bounds of their checkpoints (continued from their cursor)
+    _ckpt_intervals, _intervals = _resumableIntervals(_outhpath, _intervals)
+    if _adaptive:
+        if _max_pages <= 0:
+            raise ValueError('The adaptive mode needs a page limit (_max_pages > 0), got {}'.format(_max_pages))
+        # planning for the half of the page limit, leaving space for the estimation errors
+        _intervals = _adaptIntervals(_intervals, pdf_density, batchsize * _max_pages / 2)
+    else:
+        _max_pages = 0
+    _intervals = sorted(_ckpt_intervals + [list(_i) for _i in _intervals])
+    _rundictlist = _costOrderedRunList(_intervals, pdf_density, filter_dict, _outhpath, batchsize, _verbose, 
+                                       _timeout_limit, _existchk, _max_pages, _checkpoint_pages, _out_format)
+
+    return _outhpath, _rundictlist, pdf_density
+
+
+def _rescheduledRunDicts(in_dict_params):
+    """
+    Running the _timeInterval_eventDL_oneThreadWrapper() function, and giving back the input dictionaries of
+    the intervals to be rescheduled (the split parts of the interval), and the metrics of the worker since
+    its last task.
+    """
+
+    _todo = [dict(in_dict_params, time_interval_unixts=_interval) 
+             for _interval in _timeInterval_eventDL_oneThreadWrapper(in_dict_params)]
+    return _todo, metrics.snapshot(_reset=True)
+
+
+def _poolEventDL(list_of_API_keys, _rundictlist, pdf_density, _requests_per_sec=2):
+    """
+    Downloading the list of input dictionaries (API_key=None) on a process pool: every worker owns one API 
+    key, and the idle workers pull the next interval from the shared task queue (chunksize=1), so the dense 
+    intervals do not block the other keys. The split intervals are downloaded in the next round (ordered by
+    their estimated cost). The metrics of the workers are merged to the metrics of the main process.
+    """
+
+    _checkAPIKeys(list_of_API_keys)
+    _njobs = max(1, min(len(list_of_API_keys), len(_rundictlist)))
+    with Manager() as _manager:
+        _key_owners = _manager.dict([(_key, None) for _key in list_of_API_keys[:_njobs]])
+        _key_lock = _manager.Lock()
+    
+        with Pool(_njobs, initializer=_initKeyWorker, initargs=(_key_owners, _key_lock, _requests_per_sec)) as p:
+            while len(_rundictlist) > 0:
+                _todo_rundicts = []
+                for _todo, _metrics in p.imap_unordered(_rescheduledRunDicts, _rundictlist, chunksize=1):
+                    _todo_rundicts = _todo_rundicts + _todo
+                    metrics.merge(_metrics)
+                _costs = _estimateIntervalCost([_d['time_interval_unixts'] for _d in _todo_rundicts], pdf_density)
+                _rundictlist = [_todo_rundicts[i] for i in np.argsort(-_costs, kind='stable')]
+        p.close()
 
-    for in_dict_params in list_of_in_dict_params:
-        _timeInterval_eventDL_oneThreadWrapper(in_dict_params)
     pass
 
 
 def TimeIntervalEventDL(list_of_API_keys, filter_dict, time_interval, time_batch_sec, path_out_dumpdir, 
-                        batchsize=300, _timeout_limit=0, _verbose=False, _existchk=True):
+                        batchsize=300, _timeout_limit=0, _verbose=False, _existchk=True, _adaptive=False, 
+                        _max_pages=100, _checkpoint_pages=20, _out_format='ndjson.gz', _requests_per_sec=2, 
+                        _metrics_dir=None, _prometheus_file=None):
     """
     Downloading events within a date period, using multiple API keys (parallel computing). It can handle 
     added filters from the given dictionary (keys should be same as the API's inputs).
@@ -248,59 +897,269 @@ def TimeIntervalEventDL(list_of_API_keys, filter_dict, time_interval, time_batch
      * batchsize=300: the chunks we're downloding one time (default is opensea API allowed max)
      * _timeout_limit=0: maximum time in seconds we're allowing a thread running (with one date period). 
        0=infinite.
+     * _adaptive=False: if True, the time_batch_sec is only the starting grid: the intervals are split or 
+       merged by the event density learnt from the earlier downloads, and the intervals with longer cursor 
+       chains than _max_pages (or reaching the timeout limit) are saved partially, and their rest is 
+       rescheduled in two halves (so no interval is dropped or downloaded again from scratch). The intervals
+       interrupted at an earlier run keep the bounds of their checkpoints (see _resumableIntervals()).
+     * _max_pages=100: the maximum length of a cursor chain (in pages) in the adaptive mode (should be 
+       positive, a ValueError is raised otherwise).
+     * _checkpoint_pages=20: saving a checkpoint after every _checkpoint_pages pages, so an interrupted 
+       interval is continued from its last cursor at the next run (0=no checkpoints).
+     * _out_format='ndjson.gz': the format of the raw event files: 'ndjson.gz' (compressed raw JSON lines),
+       'parquet' (struct columns, the ETL can read only the needed fields) or 'pickle' (DataFrame, the 
+       original format). The ndjson.gz and the parquet files are written from the part file in chunks, 
+       while a pickle file is created from one DataFrame of the whole interval - so with the pickle format
+       the memory use of a worker grows with the number of events of its interval.
+     * _requests_per_sec=2: the maximum request rate of one API key (lowered automatically, if the API 
+       starts throttling the key)
+     * _metrics_dir=None: the folder of the run reports (the requests, pages, bytes, retries and waiting
+       times per key, collected from all workers, see metrics.SaveMetricsReport()). None: no report.
+     * _prometheus_file=None: the path of a Prometheus textfile to write the metrics of the run to
+
+    The intervals are not assigned to the keys in advance: they are ordered by their estimated cost (from
+    the event counts of the earlier downloads nearby), and the idle keys are pulling the next one.
     """
 
-    # converting dates, calculates the pathnames
-    _start_dt = pd.to_datetime(time_interval[0]).timestamp()
-    _end_dt = pd.to_datetime(time_interval[1]).timestamp()
-    _start_yyyymmdd_hhmmss = time_interval[0].replace(' ', '_').replace('-', '').replace(':', '')
-    _end_yyyymmdd_hhmmss = time_interval[1].replace(' ', '_').replace('-', '').replace(':', '')
-    _outhpath = path_out_dumpdir + 'events_{}_{}/'.format(_start_yyyymmdd_hhmmss, _end_yyyymmdd_hhmmss)
+    _checkAPIKeys(list_of_API_keys)
+    _runstart = time.time()
+    metrics.reset()
+
+    # planning the download: create inputs for the threads (most expensive intervals first)
+    _outhpath, _rundictlist, pdf_density = _planEventRunList(time_interval, time_batch_sec, path_out_dumpdir, 
+                                                             filter_dict, batchsize, _verbose, _timeout_limit, 
+                                                             _existchk, _adaptive, _max_pages, _checkpoint_pages, 
+                                                             _out_format)
+    _poolEventDL(list_of_API_keys, _rundictlist, pdf_density, _requests_per_sec)
+
+    # the error records of the intervals which are downloaded since then (at this or at an earlier failed
+    # run) are not needed anymore
+    _cleanupErrorRecords(_outhpath)
+
+    if (_metrics_dir is not None) or (_prometheus_file is not None):
+        metrics.SaveMetricsReport('event_dl', _metrics_dir, _run_start=_runstart, _prometheus_file=_prometheus_file)
+
+    pass
+
+
+##################################################################
+#                  Transactions DL: Error Repair                 #
+##################################################################
+
+# the error kinds of the failed intervals (by the event names of the error records)
+_ERROR_KINDS = {'Timeout Event':'timeout', 
+                'Empty Asset Event Table':'empty_response', 'Response w/o Asset Event Table':'empty_response', 
+                'Empty response over 5 times':'status_code', 'Request failed after retries':'status_code', 
+                'Client error response':'status_code', 
+                'Other Runtime Error':'runtime'}
+
+def _collectErrorRecords(path_out_dumpdir):
+    """
+    Collecting the error records (errors/runtimeerror_<start>_<end>.pickle files) of all download sessions
+    in the main dump directory (events_* subfolders). Gives back a DataFrame with the error file, the 
+    session folder, the interval, the kind of the error (timeout, empty_response, status_code, runtime) and
+    the last status code (if any).
+    """
+
+    _rows = []
+    if path.exists(path_out_dumpdir):
+        for _dir in listdir(path_out_dumpdir):
+            _errdir = path_out_dumpdir + _dir + '/errors/'
+            if (not _dir.startswith('events_')) or (not path.exists(_errdir)):
+                continue
+            for _f in listdir(_errdir):
+                if not (_f.startswith('runtimeerror_') and _f.endswith('.pickle')):
+                    continue
+                _err_df = pd.read_pickle(_errdir + _f)
+                _kinds = [_ERROR_KINDS.get(_e, 'runtime') for _e in _err_df.event_name]
+                _kind = [_k for _k in ['runtime', 'status_code', 'timeout', 'empty_response'] if _k in _kinds][0]
+                _codes = [str(_r).split('Status code: ')[-1] for _r in _err_df.event_response_dict 
+                          if str(_r).startswith('Status code: ')]
+                _rows = _rows + [{'path_error_file':_errdir + _f, 'path_dumpdir':path_out_dumpdir + _dir + '/', 
+                                  'period_start':int(_f.split('.')[0].split('_')[1]), 
+                                  'period_end':int(_f.split('.')[0].split('_')[2]), 
+                                  'error_kind':_kind, 'status_code':_codes[-1] if len(_codes) > 0 else None}]
     
-    # calculate the number of time intervals
-    _intervals = []
-    _ct = _start_dt
-    while _ct < _end_dt:
-        _intervals = _intervals + [[_ct, _ct + time_batch_sec]]
-        _ct = _ct + time_batch_sec
-        
-    # collecting existing intervals
-    _existing_intervals = []
-    if path.exists(_outhpath):
-        _filepathes = listdir(_outhpath)
-        _filepathes = [_f for _f in _filepathes if _f.endswith('.pickle')]
-        if len(_filepathes) > 0:
-            _existing_intervals = [[int(_f.split('.')[0].split('_')[1]), 
-                                    int(_f.split('.')[0].split('_')[2])] for _f in _filepathes]
+    return pd.DataFrame(_rows, columns=['path_error_file', 'path_dumpdir', 'period_start', 'period_end', 
+                                        'error_kind', 'status_code'])
+
+
+def _cleanupErrorRecords(path_dumpdir):
+    """
+    Deleting the error records of a download session folder, whose intervals are fully covered by raw event 
+    files (downloaded again since then). Gives back the number of deleted records.
+    """
+
+    _errdir = path_dumpdir + 'errors/'
+    if not path.exists(_errdir):
+        return 0
     
-    # calculating the necessary intervals to download
-    _intervals = _periodFilter(_intervals, _existing_intervals)
-
-    # planning the download: create inputs for the threads
-    _rundict = {}
-    _njobs = len(list_of_API_keys)
-    for _keys in range(_njobs):
-        _rundict.update({_keys:[]})
-        
-    i = 0
-    for _interval in _intervals:
-        _key = i % _njobs           # deciding which list we are adding the input
-        _rundict[_key] = _rundict[_key] + [{'API_key':list_of_API_keys[_key], 'filter_dict':filter_dict, 'time_interval':[], 
-                                            'path_dumpdir':_outhpath, 'batchsize':batchsize,
-                                            'time_interval_unixts':_interval, '_verbose':_verbose, 
-                                            '_timeout_limit':_timeout_limit, '_existchk':_existchk}]
-        i = i + 1
+    _err_files = [_f for _f in listdir(_errdir) if _f.startswith('runtimeerror_') and _f.endswith('.pickle')]
+    _err_intervals = [(int(_f.split('.')[0].split('_')[1]), int(_f.split('.')[0].split('_')[2])) for _f in _err_files]
+    if len(_err_files) == 0:
+        return 0
+    
+    with FileCatalog(_catalogPath(path_dumpdir)) as _catalog:
+        _coverage = _catalog.coverage(path_dumpdir)
+    _removed = 0
+    for _f, _interval in zip(_err_files, _err_intervals):
+        if _coverage.covers(_interval[0], _interval[1]):
+            remove(_errdir + _f)
+            _removed = _removed + 1
+
+    return _removed
+
+
+def RepairEventDL(list_of_API_keys, filter_dict, path_out_dumpdir, batchsize=300, _error_kinds=None, 
+                  _split_kinds=['timeout', 'empty_response'], _timeout_limit=0, _verbose=False, _max_pages=100, 
+                  _checkpoint_pages=20, _out_format='ndjson.gz', _requests_per_sec=2):
+    """
+    Repairing the failed intervals of the download sessions in the main dump directory: collecting the error
+    records (errors/ subfolders), re-planning only the missing parts of those intervals, downloading them
+    again, and deleting the error records which are covered by raw files after the download.
+
+    Inputs:
+     * list_of_API_keys: list of the API keys
+     * filter_dict: the filter dictionary of the original download sessions (like {'event_type':'successful'})
+     * path_out_dumpdir: the main dump directory (same as at the TimeIntervalEventDL)
+     * _error_kinds=None: the list of the error kinds to repair (timeout, empty_response, status_code, 
+       runtime). None: all of them.
+     * _split_kinds=['timeout', 'empty_response']: the error kinds, where the interval is split in half 
+       before the download (those usually come from too dense intervals). The split intervals are also 
+       downloaded in the adaptive way (with the _max_pages limit), so they are split further if needed.
+     * the rest of the inputs are the same as at the TimeIntervalEventDL
+
+    Gives back the summary of the repair (number of error records / repaired records by error kind).
+    """
+
+    pdf_errors = _collectErrorRecords(path_out_dumpdir)
+    if _error_kinds is not None:
+        pdf_errors = pdf_errors[pdf_errors.error_kind.isin(_error_kinds)]
+    if _verbose:
+        log('Found {} error records to repair: {}'.format(pdf_errors.shape[0], dict(pdf_errors.error_kind.value_counts())))
+    
+    # re-planning the missing parts of the failed intervals (folder by folder)
+    _rundictlist = []
+    for _dumpdir, pdf_dir_errors in pdf_errors.groupby('path_dumpdir'):
+        with FileCatalog(_catalogPath(_dumpdir)) as _catalog:
+            _coverage = _catalog.coverage(_dumpdir)
+        for _split_flg, pdf_kind_errors in pdf_dir_errors.groupby(pdf_dir_errors.error_kind.isin(_split_kinds)):
+            _intervals = _periodFilter(list(zip(pdf_kind_errors.period_start, pdf_kind_errors.period_end)), 
+                                       _coverage)
+            if _split_flg:
+                _intervals = [_i for _interval in _intervals for _i in _halveInterval(_interval)]
+            _rundictlist = _rundictlist + _costOrderedRunList(_intervals, _densityProfile(path_out_dumpdir), filter_dict, 
+                                                              _dumpdir, batchsize, _verbose, _timeout_limit, False, 
+                                                              _max_pages if _split_flg else 0, _checkpoint_pages, _out_format)
     
-    # converting back the dictionary to a list
-    list_of_rundict = []
-    for _key in _rundict.keys():
-        list_of_rundict = list_of_rundict + [_rundict[_key]]
+    if len(_rundictlist) > 0:
+        _poolEventDL(list_of_API_keys, _rundictlist, _densityProfile(path_out_dumpdir), _requests_per_sec)
     
-    # Download the data based on the running dictionary
-    with Pool(_njobs) as p:
-        p.map(_listrunner_timeInterval_eventDL, list_of_rundict)
-    p.close()
+    # deleting the error records of the repaired intervals
+    for _dumpdir in pdf_errors.path_dumpdir.unique():
+        _cleanupErrorRecords(_dumpdir)
+    pdf_errors['repaired_flg'] = pdf_errors.path_error_file.apply(lambda x: 0 if path.exists(x) else 1)
+    out_df = pdf_errors.groupby('error_kind').agg(error_num=('path_error_file', 'count'), 
+                                                  repaired_num=('repaired_flg', 'sum')).reset_index()
+    if _verbose:
+        log('Repair finished: {} of {} error records are repaired'.format(out_df.repaired_num.sum(), out_df.error_num.sum()))
+
+    return out_df
+
+
+##################################################################
+#                  Transactions DL (threaded)                    #
+##################################################################
+
+def _threadChainRunner(in_queue, API_key, _bucket, _client):
+    """
+    One cursor chain of an API key (running on its own thread): taking the next interval from the shared
+    queue, and downloading it with the given key (the requests are blocking, so the chain waits for the
+    network while the other chains are running). The split intervals are put back to the queue. It runs
+    until it gets None from the queue.
+    """
+
+    while True:
+        in_dict_params = in_queue.get()
+        try:
+            if in_dict_params is None:
+                return
+            _todo_intervals = _timeInterval_eventDL_oneThreadWrapper(dict(in_dict_params, API_key=API_key, 
+                                                                          _bucket=_bucket, _client=_client))
+            for _interval in _todo_intervals:
+                in_queue.put(dict(in_dict_params, time_interval_unixts=_interval))
+        finally:
+            in_queue.task_done()
+
+
+def _threadedEventDL(list_of_API_keys, _rundictlist, _chains_per_key, _requests_per_sec):
+    """
+    Downloading the list of input dictionaries (ordered by cost) from one shared queue, with _chains_per_key 
+    cursor chains (threads) per key. Every key has its own token bucket and client (connection pool).
+    """
 
+    _nchains = max(1, min(len(_rundictlist), _chains_per_key))
+    _queue = queue.Queue()
+    for in_dict_params in _rundictlist:
+        _queue.put(in_dict_params)
+    
+    _clients = []
+    with ThreadPoolExecutor(max_workers=len(list_of_API_keys) * _nchains) as _executor:
+        for API_key in list_of_API_keys:
+            _bucket = _TokenBucket(rate=_requests_per_sec)
+            _client = OpenSeaClient(API_key, _pool_size=_nchains)
+            _clients = _clients + [_client]
+            for _ in range(_nchains):
+                _executor.submit(_threadChainRunner, _queue, API_key, _bucket, _client)
+        
+        # waiting until all intervals (with the rescheduled ones) are done, then stopping the chains
+        _queue.join()
+        for _ in range(len(list_of_API_keys) * _nchains):
+            _queue.put(None)
+    
+    for _client in _clients:
+        _client.close()
     pass
 
 
+def ThreadedTimeIntervalEventDL(list_of_API_keys, filter_dict, time_interval, time_batch_sec, path_out_dumpdir, 
+                                batchsize=300, _timeout_limit=0, _verbose=False, _existchk=True, _adaptive=False, 
+                                _max_pages=100, _checkpoint_pages=20, _out_format='ndjson.gz', _chains_per_key=4, 
+                                _requests_per_sec=2, _metrics_dir=None, _prometheus_file=None):
+    """
+    Downloading events within a date period, same as TimeIntervalEventDL() (same inputs, same output files),
+    but from one process: instead of forking one worker per API key, a thread pool keeps several cursor 
+    chains in flight per key (blocking requests, one thread per chain), and a token bucket per key keeps the
+    request rate within the API limit. The chains of all keys pull the intervals from one queue (ordered by
+    the estimated cost).
+
+    The backfills are bound by the network round-trips, so more chains per key give more throughput, while
+    the key's bucket makes sure that the key is not called more often than allowed.
+
+    Inputs (besides the ones of TimeIntervalEventDL):
+     * _chains_per_key=4: the number of intervals downloaded at the same time with one API key
+     * _requests_per_sec=2: the maximum request rate of one API key
+
+    The metrics of the run (_metrics_dir, _prometheus_file) are collected from the chains directly, as all of
+    them are running in this process.
+    """
+
+    _checkAPIKeys(list_of_API_keys)
+    _runstart = time.time()
+    metrics.reset()
+    _outhpath, _rundictlist, _ = _planEventRunList(time_interval, time_batch_sec, path_out_dumpdir, filter_dict, 
+                                                   batchsize, _verbose, _timeout_limit, _existchk, _adaptive, 
+                                                   _max_pages, _checkpoint_pages, _out_format)
+    
+    if _verbose:
+        log('Downloading {} intervals with {} keys ({} chains per key)...'.format(
+            len(_rundictlist), len(list_of_API_keys), _chains_per_key))
+    
+    _threadedEventDL(list_of_API_keys, _rundictlist, _chains_per_key, _requests_per_sec)
+    _cleanupErrorRecords(_outhpath)
+
+    if (_metrics_dir is not None) or (_prometheus_file is not None):
+        metrics.SaveMetricsReport('threaded_event_dl', _metrics_dir, _run_start=_runstart, 
+                                  _prometheus_file=_prometheus_file)
+
+    pass
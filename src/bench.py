@@ -0,0 +1,515 @@
+##################################################################
+#      Benchmarks: downloader and stage ETL without the API      #
+##################################################################
+#                                                                #
+# Questions to marton.szel@lynxanalytics.com                     #
+# Version: 2022-01-31                                            #
+##################################################################
+
+##################################################################
+#                        Import libraries                        #
+##################################################################
+
+# data processing related
+import pandas as pd
+import numpy as np
+import json
+import gzip
+
+# core libraries
+from datetime import datetime
+import resource
+import random
+import shutil
+import tempfile
+import time
+import traceback
+
+# OS related
+from os import environ, makedirs, path
+
+# parallel programming related
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from multiprocessing import Pool, get_context
+import threading
+
+# loading some own libraries
+from .util import log, readStageTable
+
+
+##################################################################
+#                   Synthetic Event Generator                    #
+##################################################################
+
+class SyntheticEvents:
+    """
+    Deterministic generator of raw OpenSea events (asset_events records of the events API, with the fields
+    used by the loaders): the k-th event of the [start_ts, end_ts) period is always the same (generated from
+    the seed and k), so the mock API can serve any page without keeping the events in the memory.
+
+    Inputs:
+     * start_ts, end_ts: the period of the events (unix timestamps)
+     * _events_per_sec=1.0: the density of the events (evenly distributed in the period)
+     * _bundle_share=0.05: the share of the bundle sales (with 2-5 assets)
+     * _missing_payment_share=0.02: the share of the events without payment token
+     * _missing_seller_share=0.1: the share of the events without seller / winner account (the transaction
+       accounts are used then by the ETL)
+     * _collections=20: the number of the collections
+     * _assets_per_collection=500: the number of the assets of a collection
+     * _seed=0: the seed of the generator
+    """
+
+    def __init__(self, start_ts, end_ts, _events_per_sec=1.0, _bundle_share=0.05, _missing_payment_share=0.02,
+                 _missing_seller_share=0.1, _collections=20, _assets_per_collection=500, _seed=0):
+        self.start_ts = int(start_ts)
+        self.end_ts = int(end_ts)
+        self.events_per_sec = _events_per_sec
+        self.bundle_share = _bundle_share
+        self.missing_payment_share = _missing_payment_share
+        self.missing_seller_share = _missing_seller_share
+        self.collections = _collections
+        self.assets_per_collection = _assets_per_collection
+        self.seed = _seed
+
+    def __len__(self):
+        return int(np.ceil((self.end_ts - self.start_ts) * self.events_per_sec))
+
+    def _timestamp(self, k):
+        return int(self.start_ts + k / self.events_per_sec)
+
+    def _countBefore(self, _ts):
+        """
+        The number of the events earlier than _ts.
+        """
+        return int(min(len(self), max(0, np.ceil((_ts - self.start_ts) * self.events_per_sec))))
+
+    def _asset(self, _rng):
+        """
+        A random asset (with its contract and collection) drawn by the random generator of an event.
+        """
+        _coll = _rng.randrange(self.collections)
+        _num = _rng.randrange(self.assets_per_collection)
+        _id = _coll * self.assets_per_collection + _num
+        return {'id':_id, 'token_id':str(_num), 'name':'Asset {}'.format(_id),
+                'permalink':'https://opensea.io/assets/0x{:040x}/{}'.format(_coll, _num),
+                'description':'Synthetic asset', 'token_metadata':None, 'is_nsfw':False, 'background_color':None,
+                'image_url':'https://example.com/{}.png'.format(_id), 'image_original_url':None,
+                'animation_url':None, 'animation_original_url':None,
+                'asset_contract':{'symbol':'SYN{}'.format(_coll), 'asset_contract_type':'non-fungible',
+                                  'address':'0x{:040x}'.format(_coll), 'total_supply':str(self.assets_per_collection),
+                                  'payout_address':None, 'description':None, 'external_link':None},
+                'collection':{'slug':'synthetic-{}'.format(_coll), 'name':'Synthetic {}'.format(_coll),
+                              'created_date':'2020-01-01T00:00:00.000000', 'description':None, 'external_url':None,
+                              'twitter_username':None, 'instagram_username':None, 'wiki_url':None,
+                              'safelist_request_status':'not_requested', 'image_url':None, 'banner_image_url':None,
+                              'is_nsfw':False, 'require_email':False, 'only_proxied_transfers':False,
+                              'is_subject_to_whitelist':False, 'hidden':False, 'featured':False, 'default_to_fiat':False,
+                              'dev_buyer_fee_basis_points':'0', 'dev_seller_fee_basis_points':'500',
+                              'payout_address':None, 'opensea_buyer_fee_basis_points':'0',
+                              'opensea_seller_fee_basis_points':'250', 'discord_url':None},
+                'last_sale':None}
+
+    def event(self, k):
+        """
+        The k-th event (k=0: the earliest one).
+        """
+        _rng = random.Random(self.seed * 1000003 + k)
+        _ts = self._timestamp(k)
+        _bundle = _rng.random() < self.bundle_share
+        _assets = [self._asset(_rng) for _ in range(_rng.randint(2, 5) if _bundle else 1)]
+        _payment = None
+        if _rng.random() >= self.missing_payment_share:
+            _payment = _rng.choice([{'symbol':'ETH', 'decimals':18, 'usd_price':'3000.0', 'eth_price':'1.0'},
+                                    {'symbol':'WETH', 'decimals':18, 'usd_price':'3000.0', 'eth_price':'1.0'},
+                                    {'symbol':'USDC', 'decimals':6, 'usd_price':'1.0', 'eth_price':'0.00033'}])
+        _no_seller = _rng.random() < self.missing_seller_share
+        _seller = {'address':'0x{:040x}'.format(_rng.randrange(10 ** 6)), 'user':None}
+        _winner = {'address':'0x{:040x}'.format(_rng.randrange(10 ** 6)), 'user':None}
+        return {'id':self.seed * 10 ** 9 + k, 'event_type':'successful',
+                'created_date':datetime.utcfromtimestamp(_ts).isoformat(),
+                'asset':None if _bundle else _assets[0],
+                'asset_bundle':{'name':'Bundle {}'.format(k), 'assets':_assets} if _bundle else None,
+                'auction_type':_rng.choice([None, 'dutch', 'english']), 'quantity':'1',
+                'total_price':str(_rng.randrange(1, 10 ** 4) * 10 ** 15), 'payment_token':_payment,
+                'transaction':{'timestamp':datetime.utcfromtimestamp(_ts).isoformat(),
+                               'transaction_hash':'0x{:064x}'.format(self.seed * 10 ** 9 + k),
+                               'from_account':_seller, 'to_account':_winner},
+                'from_account':_seller, 'to_account':_winner,
+                'seller':None if _no_seller else _seller, 'winner_account':None if _no_seller else _winner}
+
+    def page(self, occurred_before, _offset=0, _limit=300):
+        """
+        A page of the events API: the events earlier than occurred_before, the latest first, skipping the
+        first _offset events.
+        """
+        _last = self._countBefore(occurred_before) - 1 - _offset
+        return [self.event(k) for k in range(_last, max(-1, _last - _limit), -1)]
+
+    def events(self, _start_ts=None, _end_ts=None):
+        """
+        All the events of the [_start_ts, _end_ts) period (the full period by default), the latest first.
+        """
+        _first = self._countBefore(self.start_ts if _start_ts is None else _start_ts)
+        _last = self._countBefore(self.end_ts if _end_ts is None else _end_ts) - 1
+        return [self.event(k) for k in range(_last, _first - 1, -1)]
+
+
+def _writeRawFiles(in_events, path_folder, _file_sec=3600, _out_format='pickle'):
+    """
+    Writing the synthetic events to raw event files (eventresponse_<start>_<end>.<format>, same as the
+    downloader), one file per _file_sec seconds. Gives back the number of the events.
+    """
+
+    if not path.exists(path_folder):
+        makedirs(path_folder)
+
+    _events = 0
+    for _start in range(in_events.start_ts, in_events.end_ts, _file_sec):
+        _end = min(_start + _file_sec, in_events.end_ts)
+        _list_events = in_events.events(_start, _end)
+        _events = _events + len(_list_events)
+        _filename = path_folder + 'eventresponse_{}_{}.{}'.format(_start, _end, _out_format)
+        if _out_format == 'ndjson.gz':
+            with gzip.open(_filename, 'wt') as _f:
+                for _e in _list_events:
+                    _f.write(json.dumps(_e) + '\n')
+        else:
+            pd.DataFrame(_list_events).to_pickle(_filename)
+    return _events
+
+
+##################################################################
+#                         Local Mock API                         #
+##################################################################
+
+class _MockEventHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the /api/v1/events endpoint of the mock API (occurred_before, limit and cursor parameters).
+    """
+
+    def do_GET(self):
+        _server = self.server
+        _url = urlparse(self.path)
+        _params = parse_qs(_url.query)
+        if _server.latency > 0:
+            time.sleep(_server.latency)
+
+        if _url.path.rstrip('/') != '/api/v1/events':
+            self._answer(404, {'detail':'Not found'})
+            return
+        # deterministic throttling: the first and then every Nth request of every key (N = 1 / share)
+        _key = self.headers.get('X-API-KEY', '')
+        with _server.lock:
+            _num = _server.key_requests.get(_key, 0)
+            _server.key_requests[_key] = _num + 1
+            _throttled = (_server.throttle_every > 0) and (_num % _server.throttle_every == 0)
+            if _throttled:
+                _server.stats['throttled'] = _server.stats['throttled'] + 1
+        if _throttled:
+            self._answer(429, {'detail':'Request was throttled.'}, {'Retry-After':'0'})
+            return
+
+        _before = int(_params.get('occurred_before', [_server.events.end_ts])[0])
+        _limit = min(300, int(_params.get('limit', [20])[0]))
+        _offset = int(_params.get('cursor', [0])[0])
+        _page = _server.events.page(_before, _offset, _limit)
+        with _server.lock:
+            _server.stats['pages'] = _server.stats['pages'] + 1
+            _server.stats['events'] = _server.stats['events'] + len(_page)
+        _more = _offset + _limit < _server.events._countBefore(_before)
+        self._answer(200, {'next':str(_offset + _limit) if _more else None, 'previous':None,
+                           'asset_events':_page})
+
+    def _answer(self, _status, in_dict_body, _headers={}):
+        _body = json.dumps(in_dict_body).encode()
+        _gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if _gzip:
+            _body = gzip.compress(_body, compresslevel=1)
+        self.send_response(_status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(_body)))
+        if _gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        for _key, _value in _headers.items():
+            self.send_header(_key, _value)
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockOpenSeaAPI:
+    """
+    Local stand-in of the OpenSea events API (http://127.0.0.1:<port>/api/v1/events), serving the events of a
+    SyntheticEvents generator, with injectable latency and throttling (429 answers). While it is running (as a
+    context manager), the OPENSEA_API_URL environment variable points to it, so the downloaders (and their
+    worker processes started meanwhile) call the mock API.
+
+    Inputs:
+     * in_events: the SyntheticEvents generator
+     * _latency=0: the delay of every answer in seconds
+     * _throttle_share=0: the share of the requests answered by 429 (with Retry-After: 0); the first and
+       then every (1 / share)th request of every API key is throttled, so the runs are repeatable
+     * _port=0: the port of the server (0: a free port)
+    """
+
+    def __init__(self, in_events, _latency=0, _throttle_share=0, _port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', _port), _MockEventHandler)
+        self.server.daemon_threads = True
+        self.server.events = in_events
+        self.server.latency = _latency
+        self.server.throttle_share = _throttle_share
+        self.server.lock = threading.Lock()
+        self.server.throttle_every = int(round(1 / _throttle_share)) if _throttle_share > 0 else 0
+        self.server.key_requests = {}
+        self.server.stats = {'pages':0, 'events':0, 'throttled':0}
+        self.url = 'http://127.0.0.1:{}/api/v1/'.format(self.server.server_address[1])
+        self._thread = None
+        self._old_url = None
+
+    @property
+    def stats(self):
+        return dict(self.server.stats)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        self._old_url = environ.get('OPENSEA_API_URL')
+        environ['OPENSEA_API_URL'] = self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._old_url is None:
+            environ.pop('OPENSEA_API_URL', None)
+        else:
+            environ['OPENSEA_API_URL'] = self._old_url
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+##################################################################
+#                           Benchmarks                           #
+##################################################################
+
+# the start of the synthetic periods of the benchmarks (2021-06-01 00:00:00 UTC)
+_BENCH_START_TS = 1622505600
+
+def _peakRSSMB(_who=resource.RUSAGE_SELF):
+    """
+    The peak resident memory (MB) of the process (or of its finished child processes).
+    """
+    return resource.getrusage(_who).ru_maxrss / 1024
+
+
+def BenchDownloader(path_workdir=None, _hours=2, _events_per_sec=1.0, _time_batch_sec=1800, _n_keys=2,
+                    _latency=0.01, _throttle_share=0.0, _threaded=False, _out_format='pickle', _verbose=False):
+    """
+    Downloading the synthetic events of a period from the local mock API with the downloader
+    (TimeIntervalEventDL, or ThreadedTimeIntervalEventDL if _threaded=True), without rate limit. Gives back the
+    result dictionary (pages/s, events/s, the number of the downloaded / expected events, ...).
+
+    Inputs:
+     * path_workdir=None: the dump folder of the download (None: a temporary folder, deleted at the end)
+     * _hours=2, _events_per_sec=1.0: the length and the event density of the downloaded period
+     * _time_batch_sec=1800: the interval length of the downloader
+     * _n_keys=2: the number of the (fake) API keys
+     * _latency=0.01, _throttle_share=0.0: the latency and the share of the 429 answers of the mock API
+     * _threaded=False, _out_format='pickle': the downloader function and its output format
+    """
+    from .api_dl import ThreadedTimeIntervalEventDL, TimeIntervalEventDL
+    from .catalog import FileCatalog, CATALOG_FILE
+
+    _tmp_flg = path_workdir is None
+    if _tmp_flg:
+        path_workdir = tempfile.mkdtemp(prefix='nft_bench_') + '/'
+    # the generated events start an hour earlier (the earliest interval stops at an earlier event, as in the API)
+    _events = SyntheticEvents(_BENCH_START_TS - 3600, _BENCH_START_TS + _hours * 3600, _events_per_sec)
+    _interval = [datetime.utcfromtimestamp(_BENCH_START_TS).strftime('%Y-%m-%d %H:%M:%S'),
+                 datetime.utcfromtimestamp(_events.end_ts).strftime('%Y-%m-%d %H:%M:%S')]
+    _keys = ['bench_key_{}'.format(_i) for _i in range(_n_keys)]
+
+    with MockOpenSeaAPI(_events, _latency, _throttle_share) as _api:
+        _runstart = time.time()
+        if _threaded:
+            ThreadedTimeIntervalEventDL(_keys, {}, _interval, _time_batch_sec, path_workdir, _verbose=_verbose,
+                                        _existchk=False, _out_format=_out_format, _requests_per_sec=10 ** 6)
+        else:
+            TimeIntervalEventDL(_keys, {}, _interval, _time_batch_sec, path_workdir, _verbose=_verbose,
+                                _existchk=False, _out_format=_out_format, _requests_per_sec=10 ** 6)
+        _elapsed = time.time() - _runstart
+        _stats = _api.stats
+    if (_throttle_share > 0) and (_stats['throttled'] == 0):
+        raise RuntimeError('The throttled benchmark got no 429 answers (throttle share: {})'.format(_throttle_share))
+
+    with FileCatalog(path_workdir + CATALOG_FILE) as _catalog:
+        _downloaded = int(pd.read_sql_query('SELECT SUM(nrows) AS n FROM files', _catalog.conn).n.fillna(0).iloc[0])
+    if _tmp_flg:
+        shutil.rmtree(path_workdir, ignore_errors=True)
+
+    return {'benchmark':'downloader_threaded' if _threaded else 'downloader', 'elapsed_sec':_elapsed,
+            'pages':_stats['pages'], 'pages_per_sec':_stats['pages'] / _elapsed,
+            'events_per_sec':_stats['events'] / _elapsed, 'throttled':_stats['throttled'],
+            'throttle_share':_throttle_share,
+            'events_expected':len(_events) - _events._countBefore(_BENCH_START_TS), 'events_downloaded':_downloaded, 'keys':_n_keys, 'latency':_latency}
+
+
+def _benchOneFileWorker(in_dict_params):
+    """
+    Running _processOneFile() in a fresh worker process, measuring its time and peak memory.
+    """
+    from .ETL_00_rawToStage_new import _processOneFile
+
+    _rss_start = _peakRSSMB()
+    _runstart = time.time()
+    _tables = _processOneFile(in_dict_params['path_in_file'], None, None, None, _return_tables=True,
+                              _chunk_events=in_dict_params['_chunk_events'])
+    return time.time() - _runstart, _tables[0].shape[0], _rss_start, _peakRSSMB()
+
+
+def BenchProcessOneFile(path_workdir=None, _events=20000, _chunk_events=None, _out_format='pickle'):
+    """
+    Processing one synthetic raw file of _events events by the _processOneFile() function of the stage ETL
+    (in chunks of _chunk_events events, if given) in a fresh process. Gives back the result dictionary
+    (events/s, trx rows/s, the peak memory of the process and its growth during the processing).
+    """
+
+    _tmp_flg = path_workdir is None
+    if _tmp_flg:
+        path_workdir = tempfile.mkdtemp(prefix='nft_bench_') + '/'
+    _gen = SyntheticEvents(_BENCH_START_TS, _BENCH_START_TS + 3600, _events / 3600)
+    _n = _writeRawFiles(_gen, path_workdir + 'events_bench/', 3600, _out_format)
+    _file = path_workdir + 'events_bench/eventresponse_{}_{}.{}'.format(_gen.start_ts, _gen.end_ts, _out_format)
+
+    with Pool(1) as _pool:
+        _elapsed, _rows, _rss_start, _rss_peak = _pool.apply(
+            _benchOneFileWorker, ({'path_in_file':_file, '_chunk_events':_chunk_events},))
+    if _tmp_flg:
+        shutil.rmtree(path_workdir, ignore_errors=True)
+
+    return {'benchmark':'process_one_file', 'elapsed_sec':_elapsed, 'events':_n, 'events_per_sec':_n / _elapsed,
+            'trx_rows':_rows, 'rows_per_sec':_rows / _elapsed, 'peak_rss_mb':_rss_peak,
+            'rss_growth_mb':_rss_peak - _rss_start, 'chunk_events':_chunk_events, 'format':_out_format}
+
+
+def _isolatedWorker(in_func, in_args, out_queue):
+    """
+    Running a function in the process of _runIsolated(), and putting its result (or its traceback) to the
+    queue.
+    """
+    try:
+        out_queue.put((True, in_func(*in_args)))
+    except BaseException:
+        out_queue.put((False, traceback.format_exc()))
+
+
+def _runIsolated(in_func, *args):
+    """
+    Running a function in a fresh (spawned, non-daemonic) Python process, so the peak memory measured there
+    (of the process and of its pool workers) is not mixed up with the earlier benchmarks of the run, and it
+    can start its own process pool. Gives back the result of the function (a RuntimeError with the
+    traceback, if it failed).
+    """
+
+    _ctx = get_context('spawn')
+    _queue = _ctx.Queue()
+    _proc = _ctx.Process(target=_isolatedWorker, args=(in_func, args, _queue))
+    _proc.start()
+    _ok, out_result = _queue.get()
+    _proc.join()
+    if not _ok:
+        raise RuntimeError('The isolated benchmark failed:\n' + out_result)
+    return out_result
+
+
+def _benchStageLoaderRun(in_list_args, in_dict_kwargs):
+    """
+    Running the StageLoader (in the fresh process of _runIsolated()), measuring its time and the peak memory
+    of the main and the worker processes.
+    """
+    from .ETL_00_rawToStage_new import StageLoader
+
+    _runstart = time.time()
+    StageLoader(*in_list_args, **in_dict_kwargs)
+    return time.time() - _runstart, _peakRSSMB(), _peakRSSMB(resource.RUSAGE_CHILDREN)
+
+
+def BenchStageLoader(path_workdir=None, _files=8, _events_per_file=5000, _njobs=2, _memory_mb=None,
+                     _out_format='pickle', _verbose=False):
+    """
+    Loading _files synthetic raw files (_events_per_file events each) to the stage by the StageLoader. Gives
+    back the result dictionary (events/s, trx rows/s, the peak memory of the main and the worker processes).
+    The StageLoader runs in a fresh process (see _runIsolated()), so the peak memory is its own.
+    """
+
+    _tmp_flg = path_workdir is None
+    if _tmp_flg:
+        path_workdir = tempfile.mkdtemp(prefix='nft_bench_') + '/'
+    _gen = SyntheticEvents(_BENCH_START_TS, _BENCH_START_TS + _files * 3600, _events_per_file / 3600)
+    _n = _writeRawFiles(_gen, path_workdir + 'events_bench/', 3600, _out_format)
+    _stage = path_workdir + 'stage/'
+
+    _elapsed, _rss_main, _rss_workers = _runIsolated(
+        _benchStageLoaderRun, [[path_workdir + 'events_bench/'], _stage + 'trx/', _stage + 'token/',
+                               _stage + 'collection/', _stage + '_meta/'],
+        {'_mode':'overwrite', '_njobs':_njobs, '_verbose':_verbose, '_memory_mb':_memory_mb})
+    _rows = readStageTable(_stage + 'trx/', 'trx', columns=['year']).shape[0]
+    if _tmp_flg:
+        shutil.rmtree(path_workdir, ignore_errors=True)
+
+    return {'benchmark':'stage_loader', 'elapsed_sec':_elapsed, 'events':_n, 'events_per_sec':_n / _elapsed,
+            'trx_rows':_rows, 'rows_per_sec':_rows / _elapsed, 'peak_rss_main_mb':_rss_main,
+            'peak_rss_workers_mb':_rss_workers, 'njobs':_njobs, 'memory_mb':_memory_mb}
+
+
+def RunBenchmarks(path_report=None, _quick=False, _verbose=True):
+    """
+    Running the downloader and the stage ETL benchmarks with fixed inputs (smaller ones, if _quick=True), so
+    the results of two versions of the code are comparable. If path_report is given, the results are
+    compared to the last run saved there (the change of the speed metrics is logged), and appended to it
+    (JSON list of the runs).
+
+    Gives back the results as a DataFrame.
+    """
+
+    _scale = 0.25 if _quick else 1
+    _results = [BenchDownloader(_hours=2, _events_per_sec=2 * _scale),
+                BenchDownloader(_hours=2, _events_per_sec=2 * _scale, _throttle_share=0.1),
+                BenchDownloader(_hours=2, _events_per_sec=2 * _scale, _threaded=True),
+                BenchProcessOneFile(_events=int(20000 * _scale)),
+                BenchProcessOneFile(_events=int(20000 * _scale), _chunk_events=2000),
+                BenchStageLoader(_files=8, _events_per_file=int(5000 * _scale))]
+    _results[1]['benchmark'] = 'downloader_throttled'
+    _results[4]['benchmark'] = 'process_one_file_chunked'
+    pdf_results = pd.DataFrame(_results).set_index('benchmark')
+
+    if path_report is not None:
+        _runs = []
+        if path.exists(path_report):
+            with open(path_report) as _f:
+                _runs = json.load(_f)
+        if (len(_runs) > 0) and _verbose:
+            pdf_last = pd.DataFrame(_runs[-1]['results']).set_index('benchmark')
+            for _metric in ['pages_per_sec', 'rows_per_sec', 'peak_rss_mb']:
+                for _bench in pdf_results.index.intersection(pdf_last.index):
+                    if (_metric in pdf_last.columns) and pd.notnull(pdf_results.loc[_bench, _metric]) and (
+                        pd.notnull(pdf_last.loc[_bench, _metric])):
+                        log('{} {}: {:.1f} (last run: {:.1f}, {:+.1%})'.format(
+                            _bench, _metric, pdf_results.loc[_bench, _metric], pdf_last.loc[_bench, _metric],
+                            pdf_results.loc[_bench, _metric] / pdf_last.loc[_bench, _metric] - 1))
+        _runs = _runs + [{'time':time.strftime('%Y-%m-%d %H:%M:%S'), 'quick':_quick,
+                          'results':json.loads(pdf_results.reset_index().to_json(orient='records'))}]
+        with open(path_report, 'w') as _f:
+            json.dump(_runs, _f, indent=1)
+
+    if _verbose:
+        log('Benchmark results:\n' + pdf_results.to_string())
+
+    return pdf_results
@@ -0,0 +1,323 @@
+##################################################################
+#           Catalog: manifest of the raw / stage files           #
+##################################################################
+#                                                                #
+# Questions to marton.szel@lynxanalytics.com                     #
+# Version: 2022-01-31                                            #
+##################################################################
+
+##################################################################
+#                        Import libraries                        #
+##################################################################
+
+# loading ETL related libraries
+import pandas as pd
+
+# core libraries
+import sqlite3
+import hashlib
+import time
+
+# OS related
+from os import listdir, makedirs, path
+
+# utility functions
+from .util import IntervalSet, _rawEventFileInterval
+
+
+##################################################################
+#                        Helper Functions                        #
+##################################################################
+
+# the name of the catalog file in the main dump directory (next to the events_* session folders)
+CATALOG_FILE = '_catalog.sqlite'
+
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,               -- absolute path of the file
+    folder TEXT NOT NULL,                -- absolute path of its folder (with a closing /)
+    kind TEXT NOT NULL,                  -- raw_event, monthly, ...
+    period_start INTEGER,                -- unix timestamp (raw_event) or yyyymm (monthly)
+    period_end INTEGER,
+    format TEXT,
+    nrows INTEGER,                       -- NULL: registered by a folder scan (not by the writer)
+    nbytes INTEGER,
+    checksum TEXT,                       -- NULL: registered by a folder scan (not by the writer)
+    created_at REAL,
+    stage_status TEXT NOT NULL DEFAULT 'new',  -- new, loaded, failed
+    stage_at REAL,
+    stage_error TEXT
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder, period_start);
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS imports (
+    source TEXT PRIMARY KEY,             -- the imported source (like the meta file of a loader)
+    imported_at REAL
+);
+"""
+
+def _folderKey(path_folder):
+    """
+    The normalized (absolute, closed with /) form of a folder, used as key in the catalog.
+    """
+    return path.abspath(path_folder) + '/'
+
+def _fileChecksum(path_file, _chunk_bytes=1 << 20):
+    """
+    Calculating the checksum (blake2b) of a file, reading it in chunks.
+    """
+
+    _hash = hashlib.blake2b(digest_size=16)
+    with open(path_file, 'rb') as _f:
+        for _chunk in iter(lambda: _f.read(_chunk_bytes), b''):
+            _hash.update(_chunk)
+    return _hash.hexdigest()
+
+def _fileInterval(filename):
+    """
+    Giving back the kind of a file and its period (like the raw event files: eventresponse_<start>_<end>.<format>,
+    or the monthly files: <name>_yyyymm.<format>) from its name. Gives back None, if the name is not known.
+    """
+
+    _interval = _rawEventFileInterval(filename)
+    if _interval is not None:
+        return 'raw_event', _interval[0], _interval[1], path.basename(filename).split('.', 1)[1]
+    _parts = path.basename(filename).split('.', 1)
+    _monat = _parts[0].split('_')[-1]
+    if (len(_parts) == 2) and (len(_monat) == 6) and _monat.isdigit():
+        return 'monthly', int(_monat), int(_monat), _parts[1]
+    return None
+
+def _catalogPath(path_folder):
+    """
+    The path of the catalog of a session folder (events_* folder): the catalog file of its parent folder
+    (the main dump directory).
+    """
+    return path.dirname(path.abspath(path_folder)) + '/' + CATALOG_FILE
+
+
+##################################################################
+#                            Catalog                             #
+##################################################################
+
+class FileCatalog:
+    """
+    Transactional catalog (SQLite) of the files of the NFT loaders: every raw event file is registered by the
+    downloader with its interval, row count, byte size and checksum (after the file is fully written), and
+    the stage loader records its processing state there. The loaders query the catalog instead of listing
+    the folders and parsing the filenames; a folder is listed only once (at its first use), to register the
+    files which were written before the catalog existed.
+
+    It can be opened from several processes at the same time (the writes are serialized by SQLite), but a
+    FileCatalog object should not be passed to another process: open a new one there from the same path.
+
+    Inputs:
+     * path_catalog: the path of the SQLite file (created at the first use)
+     * _timeout=60: the maximum waiting time in seconds for a lock held by another process
+    """
+
+    def __init__(self, path_catalog, _timeout=60):
+        self.path_catalog = path_catalog
+        self.conn = sqlite3.connect(path_catalog, timeout=_timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(_CATALOG_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ##############################################################
+    # Registering files                                          #
+    ##############################################################
+
+    def registerFile(self, path_file, _nrows=None, _checksum=True):
+        """
+        Registering a (fully written) file with its size and checksum (and row count, if given). The kind
+        and the period of the file are coming from its name. A registered file with the same path is
+        overwritten (and its stage state is reset).
+        """
+        _kind, _start, _end, _format = _fileInterval(path_file)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files (path, folder, kind, period_start, period_end, format, '
+                              'nrows, nbytes, checksum, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (path.abspath(path_file), _folderKey(path.dirname(path.abspath(path_file))), _kind,
+                               int(_start), int(_end), _format, _nrows, path.getsize(path_file),
+                               _fileChecksum(path_file) if _checksum else None, time.time()))
+
+    def scanFolder(self, path_folder, _rescan=False):
+        """
+        Registering the files of a folder, which are not in the catalog yet (written before the catalog
+        existed). The folder is listed only at the first call (or if _rescan=True). Gives back the number
+        of the new files.
+        """
+        _folder = _folderKey(path_folder)
+        if (not _rescan) and (self.conn.execute('SELECT 1 FROM folders WHERE folder = ?', (_folder,)).fetchone() is not None):
+            return 0
+
+        _rows = []
+        if path.exists(_folder):
+            _known = set([_r[0] for _r in self.conn.execute('SELECT path FROM files WHERE folder = ?', (_folder,))])
+            for _f in listdir(_folder):
+                _finfo = _fileInterval(_f)
+                if (_finfo is not None) and ((_folder + _f) not in _known):
+                    _rows = _rows + [(_folder + _f, _folder, _finfo[0], int(_finfo[1]), int(_finfo[2]), _finfo[3],
+                                      path.getsize(_folder + _f), time.time())]
+        with self.conn:
+            self.conn.executemany('INSERT INTO files (path, folder, kind, period_start, period_end, format, nbytes, '
+                                  'created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', _rows)
+            if path.exists(_folder):
+                self.conn.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)', (_folder, time.time()))
+        return len(_rows)
+
+    def removeFile(self, path_file):
+        """
+        Deleting a file from the catalog (not from the disk).
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE path = ?', (path.abspath(path_file),))
+
+    ##############################################################
+    # Queries                                                    #
+    ##############################################################
+
+    def listFiles(self, path_folder_list, _kind=None, _stage_status=None):
+        """
+        Giving back the registered files of the given folders (a folder, or a list of them) as a DataFrame,
+        ordered by the folder and the period. The folders not seen yet are scanned first.
+        """
+        if isinstance(path_folder_list, str):
+            path_folder_list = [path_folder_list]
+        for _folder in path_folder_list:
+            self.scanFolder(_folder)
+
+        _folders = [_folderKey(_f) for _f in path_folder_list]
+        _sql = 'SELECT * FROM files WHERE folder IN ({})'.format(', '.join(['?'] * len(_folders)))
+        _params = _folders
+        if _kind is not None:
+            _sql = _sql + ' AND kind = ?'
+            _params = _params + [_kind]
+        if _stage_status is not None:
+            _sql = _sql + ' AND stage_status = ?'
+            _params = _params + [_stage_status]
+        return pd.read_sql_query(_sql + ' ORDER BY folder, period_start, period_end', self.conn, params=_params)
+
+    def coverage(self, path_folder):
+        """
+        Giving back the intervals of the raw event files of a folder as an IntervalSet.
+        """
+        self.scanFolder(path_folder)
+        return IntervalSet(self.conn.execute("SELECT period_start, period_end FROM files WHERE folder = ? AND "
+                                             "kind = 'raw_event' ORDER BY period_start", (_folderKey(path_folder),)).fetchall())
+
+    def verify(self, path_folder_list, _checksum=True):
+        """
+        Checking the registered files of the given folders against the disk: a file is broken, if it is
+        missing, or its size (or its checksum, if _checksum=True and it is known) differs from the registered
+        one (partial or interrupted write). The files on the disk which are not registered are reported too
+        (folder rescan is not done, these are e.g. the files of a writer died before the registration).
+        Gives back a DataFrame of the problematic files with an issue column.
+        """
+        if isinstance(path_folder_list, str):
+            path_folder_list = [path_folder_list]
+
+        _rows = []
+        for _folder in [_folderKey(_f) for _f in path_folder_list]:
+            _registered = self.conn.execute('SELECT path, nbytes, checksum FROM files WHERE folder = ?', (_folder,)).fetchall()
+            for _path, _nbytes, _chksum in _registered:
+                if not path.exists(_path):
+                    _rows = _rows + [(_path, 'missing')]
+                elif path.getsize(_path) != _nbytes:
+                    _rows = _rows + [(_path, 'size_mismatch')]
+                elif _checksum and (_chksum is not None) and (_fileChecksum(_path) != _chksum):
+                    _rows = _rows + [(_path, 'checksum_mismatch')]
+            if path.exists(_folder):
+                _known = set([_r[0] for _r in _registered])
+                _rows = _rows + [(_folder + _f, 'not_registered') for _f in listdir(_folder)
+                                 if (_fileInterval(_f) is not None) and ((_folder + _f) not in _known)]
+
+        return pd.DataFrame(_rows, columns=['path', 'issue'])
+
+    ##############################################################
+    # Stage state                                                #
+    ##############################################################
+
+    def setStageStatus(self, path_file_list, _status, _error=None):
+        """
+        Setting the processing state (new, loaded, failed) of the given files.
+        """
+        with self.conn:
+            self.conn.executemany('UPDATE files SET stage_status = ?, stage_at = ?, stage_error = ? WHERE path = ?',
+                                  [(_status, time.time(), _error, path.abspath(_f)) for _f in path_file_list])
+
+    def isImported(self, source):
+        """
+        Checking if a source (like the meta file of a loader from the time before the catalog) is imported.
+        """
+        return self.conn.execute('SELECT 1 FROM imports WHERE source = ?', (source,)).fetchone() is not None
+
+    def setImported(self, source):
+        """
+        Recording a source as imported (so it is not imported again).
+        """
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO imports (source, imported_at) VALUES (?, ?)', (source, time.time()))
+
+    def resetStageStatus(self, path_folder_list):
+        """
+        Setting back all files of the given folders to unprocessed (new).
+        """
+        with self.conn:
+            self.conn.executemany("UPDATE files SET stage_status = 'new', stage_at = NULL, stage_error = NULL "
+                                  "WHERE folder = ?", [(_folderKey(_f),) for _f in path_folder_list])
+
+
+##################################################################
+#                      Stage Table Key Index                     #
+##################################################################
+
+class StageKeyIndex:
+    """
+    Key index of a stage table with one row per key (see the StageUpsertWriter of the util): the stored keys 
+    with the order value of their stored row, in an SQLite file (_keys.sqlite in the root folder of the 
+    table, which is skipped by the parquet readers).
+
+    Inputs:
+     * path_table_folder: the root folder of the stage table
+     * _timeout=60: the maximum waiting time in seconds for a lock held by another process
+    """
+
+    def __init__(self, path_table_folder, _timeout=60):
+        if not path.exists(path_table_folder):
+            makedirs(path_table_folder)
+        self.conn = sqlite3.connect(_folderKey(path_table_folder) + '_keys.sqlite', timeout=_timeout)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stage_keys (key TEXT PRIMARY KEY, order_value TEXT)')
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, in_list_keys, _batch=500):
+        """
+        Giving back the stored keys of the list with their order values ({key: order value}).
+        """
+        out_dict = {}
+        for _i in range(0, len(in_list_keys), _batch):
+            _batch_keys = in_list_keys[_i:_i + _batch]
+            out_dict.update(self.conn.execute('SELECT key, order_value FROM stage_keys WHERE key IN ({})'.format(
+                ', '.join(['?'] * len(_batch_keys))), _batch_keys).fetchall())
+        return out_dict
+
+    def update(self, in_dict_keys):
+        """
+        Storing the keys with their (new) order values.
+        """
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO stage_keys VALUES (?, ?)', list(in_dict_keys.items()))
+
@@ -8,11 +8,19 @@
 
 # API parameters
 PARAM_API_batch = 300             # load lines by API request (max possible is 300)
+PARAM_API_chains_per_key = 4      # intervals downloaded at the same time with one API key (threaded loader)
+PARAM_API_requests_per_sec = 2    # maximum request rate of one API key (threaded loader)
+PARAM_API_max_pages = 100         # longest cursor chain before an interval is split (adaptive mode)
+PARAM_API_connect_timeout = 5     # connect timeout of the API client (sec)
+PARAM_API_read_timeout = 60       # read timeout of the API client (sec)
 
 # ETL parameters
 PARAM_ETL_njobs = 2               # of processors used at parallel computation
 PARAM_ETL_raw_cleanup = False     # if True, delete all temp tables before start
 PARAM_ETL_raw_append = False      # if True, will not calculate the already existing tables (checing the rownums - not an active function as of now)
+PARAM_ETL_stage_flush_rows = 1000000    # stage tables are written out (one file per partition) after this many buffered rows
+PARAM_ETL_stage_row_group_rows = 250000 # maximum number of rows in a row group of the stage parquet files
+PARAM_ETL_stage_memory_mb = None       # memory budget of a stage worker (MB): the raw files are processed in chunks (None: full files)
 
 
 ##################################################################
@@ -34,6 +42,9 @@ PATH_01STAGE_tmp_main = './data/01_stage/'
 ##################################################################
 
 PATH_02NDS_main = './data/02_NDS/'
+PATH_02NDS_trx = PATH_02NDS_main + 'trx/'     # the NDS transaction table (with its event key index)
+PATH_02NDS_meta = PATH_02NDS_main + '_meta/'  # the list of the loaded stage files, commit journal
+PATH_02NDS_price_index = PATH_02NDS_main + 'price_index/' # the historical prices of the payment tokens (per symbol)
 
 
 ##################################################################
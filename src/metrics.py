@@ -0,0 +1,200 @@
+##################################################################
+#             Metrics: counters and timers of the runs           #
+##################################################################
+#                                                                #
+# Questions to marton.szel@lynxanalytics.com                     #
+# Version: 2022-01-31                                            #
+##################################################################
+
+##################################################################
+#                        Import libraries                        #
+##################################################################
+
+# data processing related
+import pandas as pd
+import json
+
+# core libraries
+from contextlib import contextmanager
+import threading
+import time
+
+# OS related
+from os import makedirs, path, replace
+
+
+##################################################################
+#                        Metrics Registry                        #
+##################################################################
+
+# the metrics of the process: {(name, labels): value} for the counters, {(name, labels): [count, total sec, max
+# sec]} for the timers, where the labels are a sorted tuple of (label, value) pairs
+_COUNTERS = {}
+_TIMERS = {}
+_LOCK = threading.Lock()
+
+def _metricKey(name, in_dict_labels):
+    return name, tuple(sorted([(_k, str(_v)) for _k, _v in in_dict_labels.items()]))
+
+def count(name, _value=1, **labels):
+    """
+    Increasing a counter (like count('api_requests', key='ab12', status=200)).
+    """
+    _key = _metricKey(name, labels)
+    with _LOCK:
+        _COUNTERS[_key] = _COUNTERS.get(_key, 0) + _value
+
+def addTime(name, _seconds, **labels):
+    """
+    Adding a measured time (in seconds) to a timer.
+    """
+    _key = _metricKey(name, labels)
+    with _LOCK:
+        _timer = _TIMERS.setdefault(_key, [0, 0.0, 0.0])
+        _timer[0] = _timer[0] + 1
+        _timer[1] = _timer[1] + _seconds
+        _timer[2] = max(_timer[2], _seconds)
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Measuring the time of a block to a timer (with timed('stage_flatten'): ...).
+    """
+    _start = time.perf_counter()
+    try:
+        yield
+    finally:
+        addTime(name, time.perf_counter() - _start, **labels)
+
+def reset():
+    """
+    Deleting all metrics of the process (like at the start of a run, or in a new pool worker, which would
+    inherit the metrics of the parent process).
+    """
+    with _LOCK:
+        _COUNTERS.clear()
+        _TIMERS.clear()
+
+
+##################################################################
+#                    Collecting across Processes                 #
+##################################################################
+
+def snapshot(_reset=False):
+    """
+    Giving back the metrics of the process as a (picklable, JSON serializable) dictionary. With _reset=True
+    the metrics are deleted at the same time, so a pool worker can give back its metrics with the result of
+    every task, and the main process merges them (see merge()) without counting anything twice.
+    """
+    with _LOCK:
+        out_dict = {'counters':[[_name, dict(_labels), _value] for (_name, _labels), _value in _COUNTERS.items()],
+                    'timers':[[_name, dict(_labels)] + list(_timer) for (_name, _labels), _timer in _TIMERS.items()]}
+        if _reset:
+            _COUNTERS.clear()
+            _TIMERS.clear()
+    return out_dict
+
+def merge(in_dict_snapshot):
+    """
+    Adding the metrics of a snapshot (like the one of a pool worker) to the metrics of the process.
+    """
+    if in_dict_snapshot is None:
+        return
+    with _LOCK:
+        for _name, _labels, _value in in_dict_snapshot['counters']:
+            _key = _metricKey(_name, _labels)
+            _COUNTERS[_key] = _COUNTERS.get(_key, 0) + _value
+        for _name, _labels, _count, _total, _max in in_dict_snapshot['timers']:
+            _timer = _TIMERS.setdefault(_metricKey(_name, _labels), [0, 0.0, 0.0])
+            _timer[0] = _timer[0] + _count
+            _timer[1] = _timer[1] + _total
+            _timer[2] = max(_timer[2], _max)
+
+
+##################################################################
+#                            Reports                             #
+##################################################################
+
+def metricsTable():
+    """
+    The metrics of the process as a DataFrame (one row per metric and label set): the kind (counter /
+    timer), the name, the labels (as JSON), the value (the counter value, or the total time of the timer in
+    seconds), and the count and the maximum (in seconds) of the timers.
+    """
+    _snapshot = snapshot()
+    _rows = [['counter', _name, json.dumps(_labels, sort_keys=True), _value, None, None]
+             for _name, _labels, _value in _snapshot['counters']]
+    _rows = _rows + [['timer', _name, json.dumps(_labels, sort_keys=True), _total, _count, _max]
+                     for _name, _labels, _count, _total, _max in _snapshot['timers']]
+    return pd.DataFrame(_rows, columns=['kind', 'name', 'labels', 'value', 'count', 'max_sec']).sort_values(
+        ['kind', 'name', 'labels']).reset_index(drop=True)
+
+def _prometheusLabels(in_dict_labels):
+    if len(in_dict_labels) == 0:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(_k, str(_v).replace('\\', '\\\\').replace('"', '\\"'))
+                           for _k, _v in sorted(in_dict_labels.items())]) + '}'
+
+def _writePrometheus(path_file, in_dict_snapshot, in_dict_run_labels, _prefix='nft_'):
+    """
+    Writing the metrics to a Prometheus textfile (for the textfile collector of the node exporter): the
+    counters as <prefix><name>_total, the timers as <prefix><name>_seconds_count / _sum (summary) and
+    <prefix><name>_seconds_max (gauge). The file is written to a temporary name first, and renamed (so the
+    collector never reads a partial file).
+    """
+
+    _lines = []
+    _names = set()
+    for _name, _labels, _value in sorted(in_dict_snapshot['counters'], key=lambda x: x[0]):
+        if _name not in _names:
+            _lines = _lines + ['# TYPE {}{}_total counter'.format(_prefix, _name)]
+            _names.add(_name)
+        _lines = _lines + ['{}{}_total{} {}'.format(_prefix, _name, _prometheusLabels(dict(in_dict_run_labels, **_labels)), _value)]
+    for _name, _labels, _count, _total, _max in sorted(in_dict_snapshot['timers'], key=lambda x: x[0]):
+        _plabels = _prometheusLabels(dict(in_dict_run_labels, **_labels))
+        if _name not in _names:
+            _lines = _lines + ['# TYPE {}{}_seconds summary'.format(_prefix, _name)]
+            _names.add(_name)
+        _lines = _lines + ['{}{}_seconds_count{} {}'.format(_prefix, _name, _plabels, _count),
+                           '{}{}_seconds_sum{} {:.6f}'.format(_prefix, _name, _plabels, _total)]
+    _names = set()
+    for _name, _labels, _count, _total, _max in sorted(in_dict_snapshot['timers'], key=lambda x: x[0]):
+        if _name not in _names:
+            _lines = _lines + ['# TYPE {}{}_seconds_max gauge'.format(_prefix, _name)]
+            _names.add(_name)
+        _lines = _lines + ['{}{}_seconds_max{} {:.6f}'.format(_prefix, _name, _prometheusLabels(dict(in_dict_run_labels, **_labels)), _max)]
+    with open(path_file + '.tmp', 'w') as _f:
+        _f.write('\n'.join(_lines) + '\n')
+    replace(path_file + '.tmp', path_file)
+
+
+def SaveMetricsReport(run_name, path_report_folder=None, _run_start=None, _prometheus_file=None):
+    """
+    Saving the metrics of the process (the metrics of a loader run, collected from its workers) as a run
+    report: <run_name>_<yyyymmdd_hhmmss>.json (run name, start / end time, elapsed time and all metrics) and
+    the same .csv (see metricsTable()) in the report folder, and/or as a Prometheus textfile (the run name
+    as the run label). Gives back the path of the JSON report (None, if there is no report folder).
+
+    Inputs:
+     * run_name: the name of the run (like event_dl, stage_loader)
+     * path_report_folder=None: the folder of the reports (created, if it does not exist). None: no report.
+     * _run_start=None: the start time of the run (unix timestamp, for the elapsed time)
+     * _prometheus_file=None: the path of the Prometheus textfile (None: not written)
+    """
+
+    _now = time.time()
+    _snapshot = snapshot()
+    if _prometheus_file is not None:
+        _writePrometheus(_prometheus_file, _snapshot, {'run':run_name})
+    if path_report_folder is None:
+        return None
+
+    if not path.exists(path_report_folder):
+        makedirs(path_report_folder)
+    _path_prefix = path_report_folder + '{}_{}'.format(run_name, time.strftime('%Y%m%d_%H%M%S', time.localtime(_now)))
+    with open(_path_prefix + '.json', 'w') as _f:
+        json.dump({'run':run_name, 'start':_run_start, 'end':_now,
+                   'elapsed_sec':None if _run_start is None else _now - _run_start, 'metrics':_snapshot}, _f, indent=1)
+    metricsTable().to_csv(_path_prefix + '.csv', index=False)
+
+    return _path_prefix + '.json'
@@ -0,0 +1,253 @@
+##################################################################
+#        Price Index: historical prices of payment tokens        #
+##################################################################
+#                                                                #
+# Questions to marton.szel@lynxanalytics.com                     #
+# Version: 2022-01-31                                            #
+##################################################################
+
+##################################################################
+#                        Import libraries                        #
+##################################################################
+
+# data processing related
+import pandas as pd
+import numpy as np
+import json
+
+# core libraries
+from urllib.parse import quote, unquote
+
+# OS related
+from os import listdir, makedirs, replace, path
+
+# loading some own libraries
+from . import metrics
+
+
+##################################################################
+#                          Price Index                           #
+##################################################################
+
+# the symbols priced by another symbol, if they have no own prices in the index (the wrapped ETH is ETH)
+_SYMBOL_ALIASES = {'WETH':'ETH'}
+
+class PriceIndex:
+    """
+    Local index of the historical prices of the payment tokens: one USD and ETH price per symbol and time
+    bucket (minute, hour, ... see _granularity), in one parquet file per symbol (<symbol>.parquet in the
+    index folder). The index is updated incrementally from price histories (see load()), and the prices
+    of the transactions are looked up by a vectorized as-of join (see lookup(), and EnrichTrxValues()):
+    every transaction gets the last price of its symbol before its time.
+
+    The missing ETH prices are calculated from the USD prices and the USD price of ETH (at the same time).
+
+    Inputs:
+     * path_index_folder: the folder of the index
+     * _granularity='1h': the time bucket of the prices (a pandas frequency, like '1min', '1h'); the last
+       price of a bucket is kept as the price of the bucket end, so it is used from the next bucket on (a
+       transaction is never valued by a price observed after its time). An existing index keeps its own
+       granularity.
+    """
+
+    def __init__(self, path_index_folder, _granularity='1h'):
+        self.path_index_folder = path_index_folder
+        if not path.exists(path_index_folder):
+            makedirs(path_index_folder)
+        if path.exists(path_index_folder + '_index.json'):
+            with open(path_index_folder + '_index.json') as _f:
+                _granularity = json.load(_f)['granularity']
+        else:
+            with open(path_index_folder + '_index.json', 'w') as _f:
+                json.dump({'granularity':_granularity}, _f)
+        self.granularity = _granularity
+        self.cache = {} # the loaded prices by symbol
+
+    def symbols(self):
+        """
+        The symbols of the index.
+        """
+        return sorted([unquote(_f[:-len('.parquet')]) for _f in listdir(self.path_index_folder)
+                       if _f.endswith('.parquet') and (not _f.startswith('_'))])
+
+    def prices(self, symbol):
+        """
+        The prices of a symbol (price_ts, usd_price, eth_price columns ordered by the time; empty if the
+        symbol is not in the index).
+        """
+        if symbol not in self.cache:
+            _path = self.path_index_folder + quote(symbol, safe='') + '.parquet'
+            if path.exists(_path):
+                self.cache[symbol] = pd.read_parquet(_path)
+            else:
+                self.cache[symbol] = pd.DataFrame({'price_ts':pd.Series([], dtype='datetime64[ns]'),
+                                                   'usd_price':pd.Series([], dtype='float64'),
+                                                   'eth_price':pd.Series([], dtype='float64')})
+        return self.cache[symbol]
+
+    def coverage(self):
+        """
+        The first and the last price time, and the number of prices by symbol.
+        """
+        return pd.DataFrame([[_s, self.prices(_s).price_ts.min(), self.prices(_s).price_ts.max(), self.prices(_s).shape[0]]
+                             for _s in self.symbols()], columns=['symbol', 'first_ts', 'last_ts', 'price_num'])
+
+    def update(self, in_pdf_prices):
+        """
+        Adding prices to the index (symbol, price_ts, usd_price, eth_price columns - the eth_price can be
+        missing): the prices are bucketed to the granularity of the index (the last price of a bucket, stamped
+        at the bucket end, so never before its observation), and the new prices replace the stored ones of
+        the same buckets. The file of a symbol is written to a temporary name first, and renamed (so a
+        reader never gets a partial file).
+        """
+
+        pdf_new = in_pdf_prices.copy()
+        if 'eth_price' not in pdf_new.columns:
+            pdf_new['eth_price'] = np.nan
+        pdf_new['price_ts'] = _toTimestamps(pdf_new['price_ts'])
+        pdf_new['usd_price'] = pd.to_numeric(pdf_new['usd_price'], errors='coerce').astype('float64')
+        pdf_new['eth_price'] = pd.to_numeric(pdf_new['eth_price'], errors='coerce').astype('float64')
+        pdf_new = pdf_new[pdf_new.price_ts.notnull() & pdf_new.symbol.notnull() &
+                          (pdf_new.usd_price.notnull() | pdf_new.eth_price.notnull())]
+        pdf_new = pdf_new.sort_values(by='price_ts', kind='mergesort')
+        pdf_new['price_ts'] = pdf_new['price_ts'].dt.ceil(self.granularity)
+        pdf_new = pdf_new.drop_duplicates(subset=['symbol', 'price_ts'], keep='last')
+
+        for _symbol, pdf_symbol in pdf_new.groupby('symbol', sort=False):
+            _symbol = str(_symbol)
+            pdf_out = pd.concat([self.prices(_symbol), pdf_symbol[['price_ts', 'usd_price', 'eth_price']]],
+                                axis=0, ignore_index=True)
+            pdf_out = pdf_out.drop_duplicates(subset=['price_ts'], keep='last').sort_values(by='price_ts', kind='mergesort')
+            pdf_out = pdf_out.reset_index(drop=True)
+            _path = self.path_index_folder + quote(_symbol, safe='') + '.parquet'
+            pdf_out.to_parquet('{}_{}.tmp'.format(self.path_index_folder, quote(_symbol, safe='')), index=False)
+            replace('{}_{}.tmp'.format(self.path_index_folder, quote(_symbol, safe='')), _path)
+            self.cache[_symbol] = pdf_out
+
+        pass
+
+    def load(self, path_file, symbol=None, _ts_col='timestamp', _usd_col='usd_price', _eth_col='eth_price',
+             _symbol_col='symbol'):
+        """
+        Loading a price history from a CSV or a parquet file (by its extension) to the index (see update()).
+
+        Inputs:
+         * path_file: the path of the file (.csv, .csv.gz or .parquet)
+         * symbol=None: the symbol of the prices (None: coming from the _symbol_col column)
+         * _ts_col='timestamp': the time column (dates, or unix timestamps in seconds)
+         * _usd_col='usd_price', _eth_col='eth_price': the price columns (the ETH price column can be missing)
+         * _symbol_col='symbol': the symbol column (if no symbol is given)
+
+        Gives back the number of the loaded price rows.
+        """
+
+        if path_file.endswith('.parquet'):
+            pdf_in = pd.read_parquet(path_file)
+        else:
+            pdf_in = pd.read_csv(path_file)
+        pdf_prices = pd.DataFrame({'symbol':symbol if symbol is not None else pdf_in[_symbol_col].astype('str'),
+                                   'price_ts':pdf_in[_ts_col], 'usd_price':pdf_in[_usd_col],
+                                   'eth_price':pdf_in[_eth_col] if _eth_col in pdf_in.columns else np.nan})
+        self.update(pdf_prices)
+        return pdf_prices.shape[0]
+
+    def _asof(self, in_pdf_left, _tolerance=None):
+        """
+        The as-of join of the rows (_row, symbol, price_ts columns, the time without empty values) to the
+        prices of their symbols: gives back the rows with their usd_price and eth_price (NaN, if there is
+        no price before the time, or it is older than the _tolerance).
+        """
+
+        _symbols = [_s for _s in in_pdf_left.symbol.unique() if self.prices(_s).shape[0] > 0]
+        if len(_symbols) == 0:
+            return in_pdf_left.assign(usd_price=np.nan, eth_price=np.nan)
+        pdf_right = pd.concat([self.prices(_s).assign(symbol=_s) for _s in _symbols], axis=0, ignore_index=True)
+        pdf_right = pdf_right.sort_values(by='price_ts', kind='mergesort')
+        return pd.merge_asof(in_pdf_left.sort_values(by='price_ts', kind='mergesort'), pdf_right, on='price_ts',
+                             by='symbol', direction='backward',
+                             tolerance=None if _tolerance is None else pd.Timedelta(_tolerance))
+
+    def lookup(self, in_timestamps, in_symbols, _tolerance='1D'):
+        """
+        Looking up the prices of transactions (vectorized as-of join): the last USD and ETH prices of the
+        symbols before the times, not older than the _tolerance (None: any older price). Gives back the USD
+        and the ETH prices as arrays (in the order of the inputs, NaN if there is no price).
+
+        The symbols without own prices are priced by their alias (see _SYMBOL_ALIASES), the missing ETH
+        prices are calculated from the USD price of ETH, and the ETH price of ETH is 1.
+        """
+
+        with metrics.timed('price_lookup'):
+            _symbols = pd.Series(np.asarray(in_symbols, dtype='object'))
+            _indexed = set(self.symbols())
+            _symbols = _symbols.map(dict([(_s, _s if _s in _indexed else _SYMBOL_ALIASES.get(_s, _s)) 
+                                          for _s in _symbols.dropna().unique()]))
+            pdf_left = pd.DataFrame({'_row':np.arange(len(_symbols)), 'symbol':_symbols.values,
+                                     'price_ts':_toTimestamps(pd.Series(in_timestamps)).values})
+            pdf_left = pdf_left[pdf_left.price_ts.notnull() & pdf_left.symbol.notnull()]
+
+            out_usd = np.full(len(_symbols), np.nan)
+            out_eth = np.full(len(_symbols), np.nan)
+            pdf_prices = self._asof(pdf_left, _tolerance)
+            out_usd[pdf_prices._row.values] = pdf_prices.usd_price.values
+            out_eth[pdf_prices._row.values] = pdf_prices.eth_price.values
+
+            # the ETH prices: 1 for ETH, the others from the USD price of ETH at the same time
+            _eth_flg = (_symbols == 'ETH').values
+            out_eth[_eth_flg & np.isnan(out_eth)] = 1.0
+            _missing = pdf_left[np.isnan(out_eth[pdf_left._row.values]) & (~np.isnan(out_usd[pdf_left._row.values]))]
+            if _missing.shape[0] > 0:
+                pdf_eth = self._asof(_missing.assign(symbol='ETH'), _tolerance)
+                out_eth[pdf_eth._row.values] = out_usd[pdf_eth._row.values] / pdf_eth.usd_price.values
+        metrics.count('price_lookup_rows', len(_symbols))
+
+        return out_usd, out_eth
+
+
+def _toTimestamps(in_series):
+    """
+    Converting a time column to timestamps without time zone (UTC): the numbers are unix timestamps in
+    seconds, the texts are parsed, and the time zone aware values are converted to UTC.
+    """
+
+    if str(in_series.dtype) == 'datetime64[ns]':
+        return in_series
+    if pd.api.types.is_numeric_dtype(in_series) and (not pd.api.types.is_bool_dtype(in_series)):
+        return pd.to_datetime(in_series, unit='s', errors='coerce')
+    out_series = pd.to_datetime(in_series, errors='coerce', utc=True)
+    return out_series.dt.tz_localize(None)
+
+
+##################################################################
+#                  Enriching the Transaction Values              #
+##################################################################
+
+# the historical values of the transactions: {new column: (value column, price)}
+_HIST_VALUE_COLS = {'trx_value_usd_hist':('trx_value_crypto', 'usd'), 'trx_value_eth_hist':('trx_value_crypto', 'eth'),
+                    'trx_value_usd_bundle_hist':('trx_value_crypto_bundle', 'usd'),
+                    'trx_value_eth_bundle_hist':('trx_value_crypto_bundle', 'eth')}
+
+def EnrichTrxValues(in_pdf_trx, price_index, _tolerance='1D'):
+    """
+    Adding the values of the transactions at the trade time to a stage / NDS trx table: the trx_value_crypto
+    (and the bundle value) multiplied by the USD / ETH price of the payment token at the time of the
+    transaction (see PriceIndex.lookup()), in the trx_value_usd_hist, trx_value_eth_hist,
+    trx_value_usd_bundle_hist and trx_value_eth_bundle_hist columns. The trx_value_usd / trx_value_eth
+    columns are not changed (those are calculated with the prices of the download time).
+
+    Inputs:
+     * in_pdf_trx: the trx table (trx_timestamp, trx_token_symbol, trx_value_crypto, trx_value_crypto_bundle
+       columns)
+     * price_index: the PriceIndex, or the folder of it
+     * _tolerance='1D': the maximum age of the used price (None: any older price); the transactions without
+       price get empty values
+    """
+
+    if not isinstance(price_index, PriceIndex):
+        price_index = PriceIndex(price_index)
+    _usd, _eth = price_index.lookup(in_pdf_trx['trx_timestamp'], in_pdf_trx['trx_token_symbol'], _tolerance)
+
+    out_pdf = in_pdf_trx.copy()
+    for _col, (_value_col, _price) in _HIST_VALUE_COLS.items():
+        out_pdf[_col] = out_pdf[_value_col].astype('float64').values * (_usd if _price == 'usd' else _eth)
+    return out_pdf
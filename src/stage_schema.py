@@ -0,0 +1,187 @@
+##################################################################
+#        Schema: the columns and data types of the stage         #
+##################################################################
+#                                                                #
+# Questions to marton.szel@lynxanalytics.com                     #
+# Version: 2022-01-31                                            #
+##################################################################
+
+##################################################################
+#                        Import libraries                        #
+##################################################################
+
+# loading ETL related libraries
+import pandas as pd
+
+
+##################################################################
+#                      Stage Table Schemas                       #
+##################################################################
+
+# the types of the stage columns:
+#  * string: text (the non-text values, like numbers, are converted to text)
+#  * category: text with a few distinct values (slugs, symbols, addresses, ...), stored with dictionary
+#    encoding in the parquet files, and read as pandas categorical
+#  * float, int: numbers (the non-numeric values are empty)
+#  * bool: true / false (the other values are empty)
+#  * timestamp, date: date and time / date
+_ADDRESS = 'category'
+
+# the columns of the stage tables in their order: {table: {column: type}}
+STAGE_SCHEMAS = {
+    'trx': dict([
+        ('collection_slug', 'category'), ('collection_name', 'string'), ('asset_id', 'string'),
+        ('asset_token_id', 'string'), ('asset_name', 'string'), ('asset_permalink', 'string'),
+        ('asset_symbol', 'string'), ('asset_contract_type', 'category'), ('asset_token_address', _ADDRESS),
+        ('seller_address', _ADDRESS), ('from_account_tr_address', _ADDRESS), ('buyer_address', _ADDRESS),
+        ('to_account_tr_address', _ADDRESS), ('trx_timestamp', 'timestamp'), ('trx_hash', 'string'), ('trx_asset_num', 'int'),
+        ('trx_quantity', 'float'), ('trx_auction_type', 'category'), ('trx_token_symbol', 'category'),
+        ('trx_value_crypto', 'float'), ('trx_value_usd', 'float'), ('trx_value_eth', 'float'),
+        ('trx_value_crypto_bundle', 'float'), ('trx_value_usd_bundle', 'float'), ('trx_value_eth_bundle', 'float'),
+        ('year', 'int'), ('month', 'int'), ('day', 'int')]),
+    'token': dict([
+        ('collection_slug', 'category'), ('collection_name', 'string'), ('asset_id', 'string'),
+        ('asset_token_id', 'string'), ('asset_name', 'string'), ('asset_permalink', 'string'),
+        ('assetdet_symbol', 'string'), ('assetdet_asset_contract_type', 'category'), ('assetdet_address', _ADDRESS),
+        ('asset_description', 'string'), ('assetdet_total_supply', 'string'), ('asset_token_metadata', 'string'),
+        ('asset_is_nsfw', 'bool'), ('asset_background_color', 'string'), ('asset_image_url', 'string'),
+        ('asset_image_original_url', 'string'), ('asset_animation_url', 'string'),
+        ('asset_animation_original_url', 'string'), ('assetdet_payout_address', _ADDRESS),
+        ('assetdet_description', 'string'), ('assetdet_external_link', 'string'), ('asset_first_trx_dt', 'date'),
+        ('collection_category', 'category')]),
+    'collection': dict([
+        ('collection_slug', 'category'), ('collection_name', 'string'), ('collection_created_date', 'date'),
+        ('collection_description', 'string'), ('collection_external_url', 'string'),
+        ('collection_twitter_username', 'string'), ('collection_instagram_username', 'string'),
+        ('collection_wiki_url', 'string'), ('collection_safelist_request_status', 'category'),
+        ('collection_image_url', 'string'), ('collection_banner_image_url', 'string'), ('collection_is_nsfw', 'bool'),
+        ('collection_require_email', 'bool'), ('collection_only_proxied_transfers', 'bool'),
+        ('collection_is_subject_to_whitelist', 'bool'), ('collection_hidden', 'bool'), ('collection_featured', 'bool'),
+        ('collection_default_to_fiat', 'bool'), ('collection_dev_buyer_fee_basis_points', 'string'),
+        ('collection_dev_seller_fee_basis_points', 'string'), ('collection_payout_address', _ADDRESS),
+        ('collection_opensea_buyer_fee_basis_points', 'string'), ('collection_opensea_seller_fee_basis_points', 'string'),
+        ('collection_discord_url', 'string'), ('collection_category', 'category')])}
+
+# the transaction table of the NDS (see ETL_01_stageToNDS): the stage trx columns with the hashed key of the
+# event, the number of its merged duplicates, the flags of its corrected addresses, and its values at the
+# trade time (see price_index)
+STAGE_SCHEMAS['nds_trx'] = dict([_item for _item in STAGE_SCHEMAS['trx'].items() if _item[0] not in ['year', 'month', 'day']] + 
+                                [('trx_event_key', 'string'), ('trx_duplicate_num', 'int'), ('trx_address_fix', 'int'), 
+                                 ('trx_value_usd_hist', 'float'), ('trx_value_eth_hist', 'float'), 
+                                 ('trx_value_usd_bundle_hist', 'float'), ('trx_value_eth_bundle_hist', 'float'), 
+                                 ('year', 'int'), ('month', 'int'), ('day', 'int')])
+
+# the partition columns of the stage tables (stored only in the folder names)
+STAGE_PARTITIONS = {'trx':['year', 'month', 'day'],
+                    'token':['collection_category', 'collection_slug'],
+                    'collection':['collection_category'],
+                    'nds_trx':['year', 'month', 'day']}
+
+
+def stageColumns(table, _partitions=True):
+    """
+    The columns of a stage table (trx, token, collection) in their order (without the partition columns,
+    if _partitions=False).
+    """
+    return [_c for _c in STAGE_SCHEMAS[table].keys() if _partitions or (_c not in STAGE_PARTITIONS[table])]
+
+
+##################################################################
+#                        Applying Schemas                        #
+##################################################################
+
+_BOOL_VALUES = {True:True, False:False, 'true':True, 'false':False, 'True':True, 'False':False, 1:True, 0:False}
+
+def _isEmpty(in_value):
+    """
+    Checking if a single value is empty (None, NaN, NaT or NA).
+    """
+    return (in_value is None) or (in_value is pd.NA) or (in_value is pd.NaT) or (isinstance(in_value, float) and in_value != in_value)
+
+def _convertColumn(in_series, _type, _categories=True):
+    """
+    Converting a column to the pandas type of a schema type (the category columns are kept as text, if
+    _categories=False).
+    """
+
+    if _type in ['string', 'category']:
+        out_series = pd.Series([None if _isEmpty(_v) else str(_v) for _v in in_series],
+                               index=in_series.index, dtype='object')
+        return out_series.astype('category') if (_type == 'category') and _categories else out_series
+    if _type == 'float':
+        return pd.to_numeric(in_series, errors='coerce').astype('float64')
+    if _type == 'int':
+        return pd.to_numeric(in_series, errors='coerce').astype('Int64')
+    if _type == 'bool':
+        if str(in_series.dtype) == 'bool':
+            return in_series.astype('boolean')
+        return pd.Series([_BOOL_VALUES.get(_v) if isinstance(_v, (bool, str, int)) else None for _v in in_series],
+                         index=in_series.index, dtype='boolean')
+    if _type == 'timestamp':
+        return pd.to_datetime(in_series, errors='coerce')
+    if _type == 'date':
+        return pd.to_datetime(in_series, errors='coerce').dt.date
+    raise ValueError('Unknown schema type: {}'.format(_type))
+
+
+def applySchema(in_pdf, table, _categories=True, _partitions=True, _columns=None):
+    """
+    Converting a DataFrame to the schema of a stage table: the declared columns in their order (the missing
+    ones are added as empty, the others are dropped) with the declared types. The columns already having
+    the right type are not converted again.
+
+    Inputs:
+     * in_pdf: the DataFrame
+     * table: the name of the stage table (trx, token, collection)
+     * _categories=True: converting the category columns to pandas categorical (False: kept as text, like
+       before the writing, where the parquet dictionary encoding is done by the arrow schema)
+     * _partitions=True: with the partition columns (False: the columns of the parquet files)
+     * _columns=None: only the given columns of the table (in the given order)
+    """
+
+    out_pdf = pd.DataFrame(index=in_pdf.index)
+    for _col in stageColumns(table, _partitions) if _columns is None else _columns:
+        _type = STAGE_SCHEMAS[table][_col]
+        if _col not in in_pdf.columns:
+            out_pdf[_col] = _convertColumn(pd.Series([None] * in_pdf.shape[0], index=in_pdf.index, dtype='object'),
+                                           _type, _categories)
+        elif _hasType(in_pdf[_col], _type, _categories):
+            out_pdf[_col] = in_pdf[_col]
+        else:
+            out_pdf[_col] = _convertColumn(in_pdf[_col], _type, _categories)
+    return out_pdf
+
+
+def _hasType(in_series, _type, _categories=True):
+    """
+    Checking if a column has the pandas type of a schema type already.
+    """
+
+    _dtype = str(in_series.dtype)
+    if (_type == 'category') and _categories:
+        return (_dtype == 'category') and (pd.api.types.infer_dtype(in_series.cat.categories) in ['string', 'empty'])
+    if _type in ['string', 'category', 'date']:
+        return (_dtype == 'object') and (pd.api.types.infer_dtype(in_series, skipna=True) in 
+                                         [{'date':'date'}.get(_type, 'string'), 'empty'])
+    return {'float':'float64', 'int':'Int64', 'bool':'boolean', 'timestamp':'datetime64[ns]'}.get(_type) == _dtype
+
+
+def arrowSchema(table, _partitions=True, _dictionary=True):
+    """
+    The arrow (parquet) schema of a stage table, with dictionary encoding of the category columns (without
+    the partition columns, if _partitions=False; the category columns are plain text, if _dictionary=False).
+    """
+    import pyarrow as pa
+
+    _types = {'string':pa.string(), 'category':pa.dictionary(pa.int32(), pa.string()) if _dictionary else pa.string(), 
+              'float':pa.float64(), 'int':pa.int64(), 'bool':pa.bool_(), 'timestamp':pa.timestamp('ns'), 'date':pa.date32()}
+    return pa.schema([(_col, _types[STAGE_SCHEMAS[table][_col]]) for _col in stageColumns(table, _partitions)])
+
+
+def partitionSchema(table):
+    """
+    The arrow schema of the partition columns of a stage table (for reading the folder names).
+    """
+    import pyarrow as pa
+
+    return pa.schema([_field for _field in arrowSchema(table, _dictionary=False) if _field.name in STAGE_PARTITIONS[table]])
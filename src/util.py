@@ -16,11 +16,22 @@ import numpy as np
 
 # core libraries
 from datetime import datetime, timedelta
+from bisect import bisect_left, bisect_right
+from urllib.parse import quote
+import json
+import uuid
 import imp
 import time
 
 # OS related
-from os import listdir, makedirs, remove, path
+from os import listdir, makedirs, remove, replace, path
+
+# parallel programming related
+from concurrent.futures import ThreadPoolExecutor
+
+# stage table schemas
+from .stage_schema import STAGE_PARTITIONS, STAGE_SCHEMAS, applySchema, arrowSchema, partitionSchema
+from . import metrics
 
 
 ##################################################################
@@ -38,72 +49,578 @@ def log(s):
 #            File handling related utility functions             #
 ##################################################################
 
+# the possible formats (file extensions) of the raw event files (eventresponse_<start>_<end>.<format>)
+RAW_EVENT_FORMATS = ['pickle', 'ndjson.gz', 'parquet']
+
+def _rawEventFileInterval(filename):
+    """
+    Giving back the [start, end] interval (unix timestamps) of a raw event file from its name (like 
+    eventresponse_1609459200_1609545600.parquet), or None if the file is not a (finished) raw event file.
+    """
+
+    _fn = path.basename(filename)
+    if not _fn.startswith('eventresponse_'):
+        return None
+    _fn_parts = _fn.split('.', 1)
+    if (len(_fn_parts) < 2) or (_fn_parts[1] not in RAW_EVENT_FORMATS):
+        return None
+    
+    return [int(_fn_parts[0].split('_')[1]), int(_fn_parts[0].split('_')[2])]
+
+def _rawEventFileExists(path_dumpdir, _start_dt, _end_dt):
+    """
+    Checking if the raw event file of the given interval exists in the folder (in any of the formats).
+    """
+
+    for _format in RAW_EVENT_FORMATS:
+        if path.exists(path_dumpdir + 'eventresponse_{}_{}.{}'.format(int(_start_dt), int(_end_dt), _format)):
+            return True
+    return False
+
+##################################################################
+#         Interval coverage related utility functions            #
+##################################################################
+
+class IntervalSet:
+    """
+    Sorted set of disjoint [x, y) intervals (closed from the bottom and opened from the top): the overlapping
+    and the touching intervals are merged at the insert. Both the insert and the coverage queries are binary
+    searches on the sorted interval starts/ends (O(log n) + the number of the affected intervals).
+
+    Inputs:
+     * in_list_intervals: list of tuples (or 2-size lists) of the start/end of the intervals (integers or
+       unix timestamps)
+    """
+
+    def __init__(self, in_list_intervals=[]):
+        self.starts = []
+        self.ends = []
+        for _interval in sorted([tuple(i) for i in in_list_intervals]):
+            self.add(_interval[0], _interval[1])
+
+    def add(self, _start, _end):
+        """
+        Adding an interval to the set (merging it with the overlapping / touching ones).
+        """
+        if _end <= _start:
+            return
+        _i = bisect_left(self.ends, _start)
+        _j = bisect_right(self.starts, _end)
+        if _i < _j:
+            _start = min(_start, self.starts[_i])
+            _end = max(_end, self.ends[_j - 1])
+        self.starts[_i:_j] = [_start]
+        self.ends[_i:_j] = [_end]
+
+    def missing(self, _start, _end):
+        """
+        Giving back the parts of the [_start, _end) interval which are not covered by the set (list of 
+        [start, end] lists, sorted).
+        """
+        _out = []
+        _ct = _start
+        _i = bisect_right(self.ends, _start)
+        while (_i < len(self.starts)) and (self.starts[_i] < _end):
+            if self.starts[_i] > _ct:
+                _out = _out + [[_ct, self.starts[_i]]]
+            _ct = max(_ct, self.ends[_i])
+            _i = _i + 1
+        if _ct < _end:
+            _out = _out + [[_ct, _end]]
+        return _out
+
+    def covers(self, _start, _end):
+        """
+        Checking if the [_start, _end) interval is fully covered by the set.
+        """
+        _i = bisect_right(self.starts, _start) - 1
+        return (_end <= _start) or ((_i >= 0) and (self.ends[_i] >= _end))
+
+    def intervals(self):
+        """
+        Giving back the (merged) intervals of the set as a list of [start, end] lists.
+        """
+        return [[_s, _e] for _s, _e in zip(self.starts, self.ends)]
+
+
 def _periodFilter(in_list_new_periods, in_list_existing_periods, _mode='cutter'):
     """
     Filters out from the list of new periods those items, which are covered by the list of existing periods. The
     funtion considers the those cases, when two (or more) items from the existing period covers some items from 
-    the new periods.
-
-    The implementation is a bit long, but scalable (does not contain full join of intervals, which would be the 
-    fast implementation). It does the calculation for [x, y) intervals (closed from the bottom and opened from the 
-    top). It can be modified later, but the NFT project requires only this.
+    the new periods. It does the calculation for [x, y) intervals (closed from the bottom and opened from the 
+    top), using the merged existing periods (IntervalSet).
 
     Inputs: 
      * in_list_new_periods: list of tuples (or 2-size lists) which represents the start/end date of a period we
                             would like to download. Period start/end should be integers (already converted from
                             date)
      * in_list_existing_periods: list of tuples (or 2-size lists) which represents the start/end date of the 
-                                 periods we have.
+                                 periods we have (or an IntervalSet of them).
      * _mode: the "cutter" mode cut out the existing periods fully (so if an existing period covers the half of
               a needed one, it "truncate" the tuple, and cut out the existing period from that). The "keep" mode
               keeps the full periods of the new_period list, if there is any part which is not covered.
     """
 
-    # Creating a base table with all the periods by creating sub intervals which are included by both lists
-    _full_list = np.array(list(set([tuple(i) for i in in_list_existing_periods] + [tuple(i) for i in in_list_new_periods])))
-    _full_list = _full_list.reshape(-1)
-    _full_list = list(set(_full_list))
-    _full_list.sort()
-    df_allperiods = pd.DataFrame({'period_start': _full_list})
-    df_allperiods['period_end'] = df_allperiods.period_start.shift(-1)
-    df_allperiods = df_allperiods[~df_allperiods.period_end.isnull()]
-    df_allperiods['period_end'] = df_allperiods.period_end.astype('int')
-
-
-    # Adding the existing periods to the table
-    df_exist = pd.DataFrame({'existing_periods': list(set([tuple(i) for i in in_list_existing_periods]))})
-    df_exist['period_start'] = df_exist.existing_periods.apply(lambda x: x[0])
-    df_exist['period_end'] = df_exist.existing_periods.apply(lambda x: x[1])
-    df_allperiods_20 = df_exist.append(df_allperiods).sort_values(by=['period_start', 'existing_periods', 'period_end'])
-    df_allperiods_20['existing_periods'] = df_allperiods_20.ffill()['existing_periods'].fillna("(-1, -1)")
-    df_allperiods_20['covered_existing_flg'] = np.select([df_allperiods_20.period_end <= df_allperiods_20.existing_periods.apply(lambda x: eval(str(x))[1])],
-                                                         [1], default=0)
+    if isinstance(in_list_existing_periods, IntervalSet):
+        _coverage = in_list_existing_periods
+    else:
+        _coverage = IntervalSet(in_list_existing_periods)
+
+    _returnval = []
+    for _period in sorted(set([tuple(i) for i in in_list_new_periods])):
+        if _mode=='cutter':
+            _returnval.extend([tuple(i) for i in _coverage.missing(_period[0], _period[1])])
+        elif not _coverage.covers(_period[0], _period[1]): # keep mode
+            _returnval.append(_period)
+
+    return sorted(set(_returnval))
+
+
+##################################################################
+#            Stage (parquet) related utility functions           #
+##################################################################
+
+# the name of the partition folder of the empty partition values (same as pyarrow / hive)
+_PARTITION_NULL = '__HIVE_DEFAULT_PARTITION__'
+
+def _partitionDir(partition_cols, in_values):
+    """
+    The relative folder of a partition (like year=2021/month=1/day=2/) from the values of the partition
+    columns (hive style, the values are URI encoded as pyarrow does).
+    """
+
+    _dirs = []
+    for _col, _value in zip(partition_cols, in_values):
+        if pd.isnull(_value):
+            _value = _PARTITION_NULL
+        elif isinstance(_value, float) and _value.is_integer():
+            _value = int(_value)
+        _dirs = _dirs + ['{}={}'.format(_col, quote(str(_value), safe=''))]
+    return '/'.join(_dirs) + '/'
+
+def _partitionGroups(in_pdf, partition_cols):
+    """
+    Splitting a DataFrame to its partitions, giving back a list of (tuple of the partition values, rows).
+    A single partition column is grouped by its name (grouping by a 1-element list is deprecated in pandas
+    and gives back 1-tuples only in the newer versions), so the values are always tuples.
+    """
+
+    if len(partition_cols) == 1:
+        return [((_value,), _pdf) for _value, _pdf in in_pdf.groupby(partition_cols[0], dropna=False, sort=False)]
+    return list(in_pdf.groupby(partition_cols, dropna=False, sort=False))
+
+
+class StageWriter:
+    """
+    Buffered writer of a partitioned parquet table of the stage area: the tables given to the write() function 
+    are collected (across input files), and at the flush every partition gets only one new parquet file with 
+    row groups of the target size. So the stage gets a file per partition per flush instead of a file per 
+    partition per input file. The files are readable by pd.read_parquet() / pyarrow (hive partitioning).
+
+    The files are written to temporary names first (starting with _, so the readers skip them), and renamed 
+    to their final names at the commit: a killed writer never leaves a truncated file behind. The flush can 
+    be done without the commit (_commit=False), so the caller can record the staged files (see the 
+    staged_files attribute) before they are committed by the commit() function. The partitions are written 
+    on _write_threads threads (the parquet encoding runs outside of the GIL).
+
+    Inputs:
+     * path_out_folder: the root folder of the table
+     * partition_cols: the list of the partition columns (like ['year', 'month', 'day']), these are not 
+       written to the files (only to the folder names)
+     * _flush_rows=1000000: the buffered tables are written out, when the buffer reaches this number of rows
+       (None: only by calling the flush() / close() functions)
+     * _row_group_rows=250000: the maximum number of rows in one row group of the parquet files
+     * _write_threads=4: the number of threads writing the partitions at the flush
+     * _table=None: the name of the stage table (trx, token, collection): the written tables are converted 
+       to its schema (see stage_schema), and the files are written with its arrow schema (None: the types 
+       are inferred from the data)
+    """
+
+    def __init__(self, path_out_folder, partition_cols, _flush_rows=1000000, _row_group_rows=250000, _write_threads=4, 
+                 _table=None):
+        self.path_out_folder = path_out_folder
+        self.partition_cols = partition_cols
+        self.table = _table
+        self.flush_rows = _flush_rows
+        self.row_group_rows = _row_group_rows
+        self.write_threads = _write_threads
+        self.buffer = []
+        self.buffer_rows = 0
+        self.staged_files = [] # [temporary path, final path] of the written, not committed files
+        self.replaced_files = [] # the files to be deleted at the commit (replaced by the staged files)
+        self.written_files = 0
+
+    def write(self, in_pdf):
+        """
+        Adding a table to the buffer (flushing it, if the buffer is full).
+        """
+        if in_pdf.shape[0] > 0:
+            if self.table is not None:
+                in_pdf = applySchema(in_pdf, self.table, _categories=False)
+            self.buffer = self.buffer + [in_pdf]
+            self.buffer_rows = self.buffer_rows + in_pdf.shape[0]
+        if (self.flush_rows is not None) and (self.buffer_rows >= self.flush_rows):
+            self.flush()
+
+    def _writePartition(self, in_values, in_pdf_part, _filename):
+        """
+        Writing the rows of one partition to a temporary file, giving back its temporary and final path.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        _dir = self.path_out_folder + _partitionDir(self.partition_cols, in_values)
+        makedirs(_dir, exist_ok=True)
+        _schema = None if self.table is None else arrowSchema(self.table, _partitions=False)
+        with metrics.timed('stage_write_parquet', table=self.table):
+            pq.write_table(pa.Table.from_pandas(in_pdf_part.drop(self.partition_cols, axis=1).reset_index(drop=True), 
+                                                schema=_schema, preserve_index=False), 
+                           _dir + '_' + _filename + '.tmp', row_group_size=self.row_group_rows)
+        metrics.count('stage_written_rows', in_pdf_part.shape[0], table=self.table)
+        return [_dir + '_' + _filename + '.tmp', _dir + _filename]
+
+    def flush(self, _commit=True):
+        """
+        Writing out the buffered tables: one new file to every partition (committed, if _commit=True).
+        """
+        if len(self.buffer) > 0:
+            pdf_out = pd.concat(self.buffer, axis=0, ignore_index=True)
+            self.buffer = []
+            self.buffer_rows = 0
+            
+            _filename = 'part-{}.parquet'.format(uuid.uuid4().hex)
+            _parts = _partitionGroups(pdf_out, self.partition_cols)
+            with ThreadPoolExecutor(max(1, min(self.write_threads, len(_parts)))) as _executor:
+                self.staged_files = self.staged_files + list(_executor.map(
+                    lambda x: self._writePartition(x[0], x[1], _filename), _parts))
+        if _commit:
+            self.commit()
+
+    def commit(self):
+        """
+        Renaming the staged (written) files to their final names (and deleting the replaced files).
+        """
+        _commitStagedFiles(self.staged_files, self.replaced_files)
+        self.written_files = self.written_files + len(self.staged_files)
+        self.staged_files = []
+        self.replaced_files = []
+
+    def close(self):
+        """
+        Flushing (and committing) the rest of the buffer.
+        """
+        self.flush()
+
+
+def _commitStagedFiles(in_list_staged_files, in_list_replaced_files=[]):
+    """
+    Renaming the [temporary path, final path] files, and deleting the replaced files after that (the already 
+    renamed / deleted ones are skipped, so an interrupted commit can be repeated).
+    """
+
+    for _tmp, _final in in_list_staged_files:
+        if path.exists(_tmp):
+            replace(_tmp, _final)
+    for _f in in_list_replaced_files:
+        if path.exists(_f):
+            remove(_f)
+    pass
+
+
+class StageUpsertWriter(StageWriter):
+    """
+    Buffered writer of a stage table with one row per key (like the token or the collection table): the 
+    written rows are merged into the existing partitions instead of appending them. At the flush, only the 
+    partitions with new or winning keys are rewritten (to one new file, replacing the earlier ones at the 
+    commit), so reloading the same files changes nothing (idempotent), and the table size is proportional 
+    to the number of the distinct keys.
+
+    The winning row of a key is the one with the highest _order_col value (the earlier stored row wins at 
+    equal values), or the first stored row, if _order_col is None. The key index (if given, see the 
+    StageKeyIndex of the catalog) holds the winning value of every stored key, so the incoming rows which 
+    cannot win are dropped without reading the partitions. The partition columns should not change within a
+    key (like the category of a collection), as only the partition of the incoming row is merged.
+
+    Inputs (besides the StageWriter inputs):
+     * key_cols: the list of the key columns
+     * _order_col=None: the column deciding the winning row of a key (None: the first stored row wins)
+     * _key_index=None: the key index of the table (catalog.StageKeyIndex)
+    """
+
+    def __init__(self, path_out_folder, partition_cols, key_cols, _order_col=None, _key_index=None, 
+                 _flush_rows=1000000, _row_group_rows=250000, _write_threads=4, _table=None):
+        StageWriter.__init__(self, path_out_folder, partition_cols, _flush_rows, _row_group_rows, _write_threads, _table)
+        self.key_cols = key_cols
+        self.order_col = _order_col
+        self.key_index = _key_index
+        self.index_updates = {}
+
+    def _keyStrings(self, in_pdf):
+        """
+        The keys of the rows as strings (the key of the index).
+        """
+        return [json.dumps(list(_k), default=str) for _k in zip(*[in_pdf[_c] for _c in self.key_cols])]
+
+    def _orderStrings(self, in_pdf):
+        """
+        The order values of the rows as (comparable) strings.
+        """
+        if self.order_col is None:
+            return [''] * in_pdf.shape[0]
+        return [None if pd.isnull(_v) else str(_v) for _v in in_pdf[self.order_col]]
+
+    def _wins(self, _order, _stored_order):
+        """
+        Checking if a row with the given order value wins against the stored row of its key.
+        """
+        if (self.order_col is None) or (_order is None):
+            return False
+        return (_stored_order is None) or (_order > _stored_order)
+
+    def _winners(self, in_pdf):
+        """
+        Keeping the winning row of every key (the earlier rows win at equal order values).
+        """
+        if self.order_col is not None:
+            in_pdf = in_pdf.sort_values(by=self.order_col, ascending=False, kind='mergesort', na_position='last')
+        return in_pdf.drop_duplicates(subset=self.key_cols, keep='first')
+
+    def _writePartition(self, in_values, in_pdf_part, _filename):
+        """
+        Merging the rows of one partition with its stored rows, and writing them to a temporary file. Gives
+        back its temporary and final path, and the list of the replaced files.
+        """
+        import pyarrow.parquet as pq
+
+        _dir = self.path_out_folder + _partitionDir(self.partition_cols, in_values)
+        _old_files = []
+        if path.exists(_dir):
+            _old_files = [_dir + _f for _f in sorted(listdir(_dir)) if _f.endswith('.parquet') and (not _f.startswith('_'))]
+        with metrics.timed('stage_upsert_merge', table=self.table):
+            _list_stored = [pq.read_table(_f).to_pandas() for _f in _old_files]
+            if self.table is not None:
+                _list_stored = [applySchema(_pdf, self.table, _categories=False, _partitions=False) for _pdf in _list_stored]
+            for pdf_stored in _list_stored:
+                for _col, _value in zip(self.partition_cols, in_values):
+                    pdf_stored[_col] = _value
+            pdf_merged = self._winners(pd.concat(_list_stored + [in_pdf_part], axis=0, ignore_index=True))
+        return StageWriter._writePartition(self, in_values, pdf_merged, _filename), _old_files
+
+    def flush(self, _commit=True):
+        """
+        Merging the buffered rows into their partitions (committed, if _commit=True).
+        """
+        if len(self.buffer) > 0:
+            pdf_out = self._winners(pd.concat(self.buffer, axis=0, ignore_index=True))
+            self.buffer = []
+            self.buffer_rows = 0
+
+            # dropping the rows which cannot win against the stored ones
+            _keys = self._keyStrings(pdf_out)
+            _orders = self._orderStrings(pdf_out)
+            if self.key_index is not None:
+                _stored = self.key_index.lookup(_keys)
+                _new_flg = np.array([(_k not in _stored) or self._wins(_o, _stored[_k]) for _k, _o in zip(_keys, _orders)], 
+                                    dtype='bool')
+                pdf_out = pdf_out[_new_flg]
+                _keys = [_k for _k, _flg in zip(_keys, _new_flg) if _flg]
+                _orders = [_o for _o, _flg in zip(_orders, _new_flg) if _flg]
+            self.index_updates.update(zip(_keys, _orders))
+            
+            if pdf_out.shape[0] > 0:
+                _filename = 'part-{}.parquet'.format(uuid.uuid4().hex)
+                _parts = _partitionGroups(pdf_out, self.partition_cols)
+                with ThreadPoolExecutor(max(1, min(self.write_threads, len(_parts)))) as _executor:
+                    for _staged, _old_files in _executor.map(lambda x: self._writePartition(x[0], x[1], _filename), _parts):
+                        self.staged_files = self.staged_files + [_staged]
+                        self.replaced_files = self.replaced_files + _old_files
+        if _commit:
+            self.commit()
+
+    def commit(self):
+        """
+        Committing the merged partitions, and updating the key index after that (so the index never holds 
+        keys which are not stored).
+        """
+        StageWriter.commit(self)
+        if (self.key_index is not None) and (len(self.index_updates) > 0):
+            self.key_index.update(self.index_updates)
+        self.index_updates = {}
+
+    def close(self):
+        """
+        Flushing (and committing) the rest of the buffer, and closing the key index.
+        """
+        self.flush()
+        if self.key_index is not None:
+            self.key_index.close()
+
+
+def _compactPartition(path_partition_dir, _row_group_rows=250000, _table=None):
+    """
+    Merging the parquet files of one partition folder to one file (converted to the schema of the stage 
+    table, if _table is given). The list of the merged files is saved to a journal file first, so an 
+    interrupted compaction is finished at the next run (the old files are deleted only after the new file 
+    is in place, and the journal is deleted last).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    _journal = path_partition_dir + '_compaction.json'
+    if path.exists(_journal):
+        # finishing an interrupted compaction (if its new file is in place) or dropping it (if not)
+        with open(_journal) as _f:
+            _jdict = json.load(_f)
+        if path.exists(path_partition_dir + _jdict['new_file']):
+            for _f in _jdict['old_files']:
+                if path.exists(path_partition_dir + _f):
+                    remove(path_partition_dir + _f)
+        remove(_journal)
+    
+    # the temporary files of the killed writers
+    for _f in listdir(path_partition_dir):
+        if _f.startswith('_part-') and _f.endswith('.tmp'):
+            remove(path_partition_dir + _f)
+
+    _files = sorted([_f for _f in listdir(path_partition_dir) if _f.endswith('.parquet')])
+    if len(_files) < 2:
+        return 0
+    
+    pdf_part = pd.concat([pq.read_table(path_partition_dir + _f).to_pandas() for _f in _files], axis=0, ignore_index=True)
+    _schema = None
+    if _table is not None:
+        pdf_part = applySchema(pdf_part, _table, _categories=False, _partitions=False)
+        _schema = arrowSchema(_table, _partitions=False)
+    _new_file = 'part-{}.parquet'.format(uuid.uuid4().hex)
+    pq.write_table(pa.Table.from_pandas(pdf_part, schema=_schema, preserve_index=False), path_partition_dir + '_' + _new_file + '.tmp', 
+                   row_group_size=_row_group_rows)
+    with open(_journal, 'w') as _f:
+        json.dump({'new_file':_new_file, 'old_files':_files}, _f)
+    replace(path_partition_dir + '_' + _new_file + '.tmp', path_partition_dir + _new_file)
+    for _f in _files:
+        remove(path_partition_dir + _f)
+    remove(_journal)
+
+    return len(_files)
+
+
+def CompactStage(path_stage_folder, _min_files=2, _row_group_rows=250000, _verbose=False, _table=None):
+    """
+    Compacting a partitioned parquet table of the stage area: the partitions with at least _min_files parquet 
+    files (small files of the earlier loads) are rewritten to one file with row groups of the target size.
+    The leftover temporary files of the killed writers are deleted as well. It can be run periodically (when 
+    no loader is writing the table, and the last StageLoader run is finished or recovered).
+
+    Inputs:
+     * path_stage_folder: the root folder of the table (like the trx folder of the stage)
+     * _min_files=2: the partitions with less files are not touched
+     * _row_group_rows=250000: the maximum number of rows in one row group of the new files
+     * _verbose=False: logging the progress
+     * _table=None: the name of the stage table (trx, token, collection): the compacted partitions are 
+       converted to its schema (so the files written before the schema get the same types)
+
+    Gives back the number of compacted partitions and the number of merged files.
+    """
+
+    _partitions = 0
+    _merged = 0
+    _dirs = [path_stage_folder if path_stage_folder.endswith('/') else path_stage_folder + '/']
+    while len(_dirs) > 0:
+        _dir = _dirs.pop()
+        _entries = listdir(_dir)
+        _dirs = _dirs + [_dir + _e + '/' for _e in _entries if path.isdir(_dir + _e)]
+        _parquets = [_e for _e in _entries if _e.endswith('.parquet')]
+        if (len(_parquets) >= _min_files) or ('_compaction.json' in _entries) or any([_e.endswith('.tmp') for _e in _entries]):
+            _n = _compactPartition(_dir, _row_group_rows, _table)
+            if _n > 0:
+                _partitions = _partitions + 1
+                _merged = _merged + _n
+                if _verbose and (_partitions % 100 == 0):
+                    log('Compacted {} partitions ({} files) so far'.format(_partitions, _merged))
     
-    # Adding the required periods to the table
-    df_req = pd.DataFrame({'required_periods': list(set([tuple(i) for i in in_list_new_periods]))})
-    df_req['period_start'] = df_req.required_periods.apply(lambda x: x[0])
-    df_req['period_end'] = df_req.required_periods.apply(lambda x: x[1])
-    df_allperiods_20b = df_req.append(df_allperiods).sort_values(by=['period_start', 'required_periods', 'period_end'])
-    df_allperiods_20b['required_periods'] = df_allperiods_20b.ffill()['required_periods'].fillna("(-1, -1)")
-    df_allperiods_20b['required_flg'] = np.select([df_allperiods_20b.period_end <= df_allperiods_20b.required_periods.apply(lambda x: eval(str(x))[1])],
-                                                  [1], default=0)
+    if _verbose:
+        log('Compaction finished: {} files are merged in {} partitions'.format(_merged, _partitions))
+
+    return _partitions, _merged
+
+
+# the date columns of the stage tables used by the date interval filter of readStageTable (the trx tables are
+# filtered by their year / month / day partitions)
+_STAGE_DATE_COLS = {'token':'asset_first_trx_dt', 'collection':'collection_created_date'}
+
+def _stageFilter(table, date_interval=[], filters={}):
+    """
+    The arrow filter expression of readStageTable (None: no filter). The conditions on the partition columns
+    are evaluated on the folder names (so the not matching partitions are not opened at all), the others on
+    the row group statistics first (so the not matching row groups are not read) and then on the rows.
+    """
+    import pyarrow.dataset as ds
+
+    _conditions = []
+    if len(date_interval) > 0:
+        if STAGE_PARTITIONS[table] == ['year', 'month', 'day']:
+            # the date of a partition as a yyyymmdd number (constant within a partition, so the pruning is done
+            # on the folder names)
+            _dt = ds.field('year') * 10000 + ds.field('month') * 100 + ds.field('day')
+            _conditions = [(_dt >= int(date_interval[0].strftime('%Y%m%d'))) & 
+                           (_dt <= int(date_interval[1].strftime('%Y%m%d')))]
+        else:
+            _conditions = [(ds.field(_STAGE_DATE_COLS[table]) >= date_interval[0]) & 
+                           (ds.field(_STAGE_DATE_COLS[table]) <= date_interval[1])]
+    for _col, _values in filters.items():
+        _conditions = _conditions + [ds.field(_col).isin(list(_values))]
     
-    df_allperiods = pd.merge(df_allperiods_20, df_allperiods_20b, on=['period_start', 'period_end']).drop_duplicates()
-    df_allperiods['to_dl_flg'] = np.select([df_allperiods.required_flg > df_allperiods.covered_existing_flg], [1], default=0)
-    df_allperiods['selected_period'] = list(zip(df_allperiods.period_start, df_allperiods.period_end))
-
-    if _mode=='cutter':
-        _tmp_df = df_allperiods[df_allperiods.to_dl_flg > 0].drop_duplicates(subset=['selected_period'])
-        _returnval = list(_tmp_df.selected_period.unique())
-    else: # keep mode
-        _tmp_df = df_allperiods[df_allperiods.to_dl_flg > 0].copy()
-        _tmp_df['required_periods'] = np.select([((_tmp_df.period_start >= _tmp_df.required_periods.apply(lambda x: x[0])) & 
-                                                  (_tmp_df.period_end <= _tmp_df.required_periods.apply(lambda x: x[1])))], 
-                                                [_tmp_df.required_periods], default=np.NaN)
-        _tmp_df = _tmp_df[~_tmp_df.required_periods.isnull()]
-        _returnval = list(_tmp_df.required_periods.unique())
-
-    return _returnval
+    if len(_conditions) == 0:
+        return None
+    out_filter = _conditions[0]
+    for _condition in _conditions[1:]:
+        out_filter = out_filter & _condition
+    return out_filter
+
+
+def readStageTable(path_stage_folder, table, columns=None, date_interval=[], filters={}, _categories=True, _arrow=False):
+    """
+    Reading a partitioned parquet table of the stage area with the schema of the table (see stage_schema): 
+    the files written with different (inferred) types are read with the same types, the partition columns 
+    get their declared types, and the category columns are pandas categorical. The files starting with _ or 
+    . (temporary files, journals, key indexes) are skipped.
+
+    Only the needed part of the table is read: the filters are pushed down to the partitions (folder names)
+    and the row groups (parquet statistics), and only the given columns are loaded.
+
+    Inputs:
+     * path_stage_folder: the root folder of the table (like the trx folder of the stage)
+     * table: the name of the stage table (trx, token, collection, or nds_trx for the NDS transactions)
+     * columns=None: the list of the columns to read (None: all)
+     * date_interval=[]: [first date, last date] (datetime.date, both included) of the trx dates (year / 
+       month / day partitions), the first transaction date of the tokens, or the creation date of the 
+       collections (empty: all dates)
+     * filters={}: {column: list of the accepted values}, like {'collection_slug': ['cryptopunks']}
+     * _categories=True: reading the category columns as pandas categorical (False: as text)
+     * _arrow=False: giving back an arrow Table instead of a DataFrame (without conversion to pandas; the 
+       category columns are dictionary encoded, if _categories=True)
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    _partition_schema = partitionSchema(table)
+    # the files are read as plain text in the category columns (the files written before the schema have no 
+    # dictionary encoding, and arrow cannot cast them), these are converted to categorical after the reading
+    _schema = pa.schema(list(arrowSchema(table, _partitions=False, _dictionary=False)) + list(_partition_schema))
+    _dataset = ds.dataset(path_stage_folder, schema=_schema, format='parquet',
+                          partitioning=ds.partitioning(_partition_schema, flavor='hive'))
+    _table = _dataset.to_table(columns=columns, filter=_stageFilter(table, date_interval, filters))
+
+    if _arrow:
+        if _categories:
+            for _i, _field in enumerate(_table.schema):
+                if STAGE_SCHEMAS[table].get(_field.name) == 'category':
+                    _table = _table.set_column(_i, _field.name, pc.dictionary_encode(_table.column(_i)))
+        return _table
+
+    return applySchema(_table.to_pandas(), table, _categories, _columns=columns)
+
 
 ###################################################################################
 # From this point, the earlier util functions can be found - some of them will be
@@ -111,10 +628,26 @@ def _periodFilter(in_list_new_periods, in_list_existing_periods, _mode='cutter')
 ###################################################################################
 
 
-def FileCollector(path_folder, date_interval=[], filters={}, _dtvar='report_dt'):
+def _folderFiles(path_folder, _catalog=None):
+    """
+    Giving back the names of the files in a folder: from the file catalog (catalog.FileCatalog) if it is 
+    given, otherwise by listing the folder.
+    """
+
+    if _catalog is not None:
+        return [path.basename(_f) for _f in _catalog.listFiles(path_folder).path]
+    return listdir(path_folder)
+
+
+def FileCollector(path_folder, date_interval=[], filters={}, _dtvar='report_dt', _catalog=None, columns=None):
     """
     Collecting and appending all files from a folder, which are in between the date interval. The code
-    also applies the filter for the given columns. If the date interval is empty, loading all files.
+    also applies the filter for the given columns. If the date interval is empty, loading all files. The
+    files of the folder are coming from the _catalog (catalog.FileCatalog), if it is given.
+
+    Only the monthly files overlapping with the date interval are read, the filters are applied before the 
+    date filter (so less rows are converted), and the dates are compared as timestamps. With columns, only
+    the given columns are kept (the stage parquet tables should be read by readStageTable instead).
     """
 
     if str(path_folder)[-1] == '/':
@@ -122,7 +655,7 @@ def FileCollector(path_folder, date_interval=[], filters={}, _dtvar='report_dt')
     else:
         _pf = path_folder + '/'
 
-    _monat_df = pd.DataFrame({'file_rel_path':listdir(_pf)})
+    _monat_df = pd.DataFrame({'file_rel_path':_folderFiles(_pf, _catalog)})
     _monat_df['file_path'] = _pf + _monat_df.file_rel_path
     _monat_df['monat'] = _monat_df.file_rel_path.apply(lambda x: int(x.split('.')[0].split('_')[-1]))
 
@@ -130,17 +663,21 @@ def FileCollector(path_folder, date_interval=[], filters={}, _dtvar='report_dt')
         _minmonat = date_interval[0].year * 100 + date_interval[0].month
         _maxmonat = date_interval[1].year * 100 + date_interval[1].month
         _monat_df = _monat_df[_monat_df.monat.between(_minmonat, _maxmonat)]
+        _min_ts = pd.Timestamp(date_interval[0])
+        _max_ts = pd.Timestamp(date_interval[1]) + timedelta(days=1)
     
     _filelist = list(_monat_df.file_path.tolist())
     _read_pdfs = []
 
     for _files in _filelist:
         _tmp_df = pd.read_pickle(_files)
-        _tmp_df[_dtvar] = pd.to_datetime(_tmp_df[_dtvar])
         for _cols in filters.keys():
             _tmp_df = _tmp_df[_tmp_df[_cols].isin(filters[_cols])]
-        _tmp_df = _tmp_df[(_tmp_df[_dtvar].dt.date >= date_interval[0]) & 
-                          (_tmp_df[_dtvar].dt.date <= date_interval[1])]
+        _tmp_df[_dtvar] = pd.to_datetime(_tmp_df[_dtvar])
+        if len(date_interval) > 0:
+            _tmp_df = _tmp_df[(_tmp_df[_dtvar] >= _min_ts) & (_tmp_df[_dtvar] < _max_ts)]
+        if columns is not None:
+            _tmp_df = _tmp_df[columns]
         _read_pdfs = _read_pdfs + [_tmp_df]
     
     return pd.concat(_read_pdfs, axis=0).reset_index(drop=True)
@@ -177,13 +714,13 @@ def _monat_list_creator(load_dt_list_str, monat_add=1):
         _start_monat = _monat_add(_start_monat, 1)
     return _out_list 
 
-def _collectMonatsFromFilenames(path_folder_chk, int_max_monat):
+def _collectMonatsFromFilenames(path_folder_chk, int_max_monat, _catalog=None):
     """
     Checking the files (trx pickle files) in a given folder, 
     and collects the available months (up to a monat, if it is given). 
     """
 
-    _monats = listdir(path_folder_chk)
+    _monats = _folderFiles(path_folder_chk, _catalog)
     _monats = [int(_item.split('.')[0].split('_')[-1]) for _item in _monats]
 
     if int_max_monat > 0:
@@ -214,7 +751,7 @@ def _colsimpler(colnames):
     
     return _newcol
 
-def _findingLatestFile(path_folder):
+def _findingLatestFile(path_folder, _catalog=None):
     """
     Finding the highest yyyymm postfix in a folder, and returns back with the full file path.
     """
@@ -224,19 +761,19 @@ def _findingLatestFile(path_folder):
     else:
         _pf = path_folder + '/'
 
-    _monat_df = pd.DataFrame({'file_rel_path':listdir(_pf)})
+    _monat_df = pd.DataFrame({'file_rel_path':_folderFiles(_pf, _catalog)})
     _monat_df['file_path'] = _pf + _monat_df.file_rel_path
     _monat_df['monat'] = _monat_df.file_rel_path.apply(lambda x: int(x.split('.')[0].split('_')[-1]))
 
     return _monat_df[_monat_df.monat == _monat_df.monat.max()].iloc[0].file_path
 
-def _firstNLastDt(path_folder):
+def _firstNLastDt(path_folder, _catalog=None):
     """
     Getting the first / last report dt from a given folder (usually time series).
     Not the exact one, just form the filenames (which are monthly)
     """
 
-    _monats = listdir(path_folder)
+    _monats = _folderFiles(path_folder, _catalog)
     _monats = [int(_item.split('.')[0].split('_')[-1]) for _item in _monats]
     _monats.sort()
 
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the tests import the package as src (like the notebooks of the repo root)
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
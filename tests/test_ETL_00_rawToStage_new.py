@@ -0,0 +1,29 @@
+from os import makedirs
+
+import pandas as pd
+
+from src import ETL_00_rawToStage_new as ers
+from src.bench import SyntheticEvents, _writeRawFiles
+from src.catalog import FileCatalog, CATALOG_FILE
+
+
+def test_legacy_loader_list_is_imported_only_once(tmp_path):
+    _dumpdir = str(tmp_path) + '/'
+    _events = SyntheticEvents(1622505600, 1622509200, _events_per_sec=0.02)
+    _writeRawFiles(_events, _dumpdir + 'events_a/')
+    # the file of events_a was loaded before the catalog (only its interval is in the legacy meta file)
+    makedirs(_dumpdir + 'stage/meta/')
+    with open(_dumpdir + 'stage/meta/01_stage_loader.csv', 'w') as _f:
+        _f.write('file_id\n1622505600_1622509200\n')
+    _outs = [_dumpdir + 'stage/trx/', _dumpdir + 'stage/token/', _dumpdir + 'stage/collection/', _dumpdir + 'stage/meta/']
+
+    ers.StageLoader([_dumpdir + 'events_a/'], *_outs, _njobs=1)
+    with FileCatalog(_dumpdir + CATALOG_FILE) as _catalog:
+        assert _catalog.listFiles([_dumpdir + 'events_a/']).stage_status.tolist() == ['loaded']
+
+    # a new session folder with the same interval is loaded at the next run (the legacy list is not used again)
+    _writeRawFiles(_events, _dumpdir + 'events_b/')
+    ers.StageLoader([_dumpdir + 'events_a/', _dumpdir + 'events_b/'], *_outs, _njobs=1)
+    with FileCatalog(_dumpdir + CATALOG_FILE) as _catalog:
+        assert _catalog.listFiles([_dumpdir + 'events_b/']).stage_status.tolist() == ['loaded']
+    assert pd.read_parquet(_dumpdir + 'stage/trx/').shape[0] >= len(_events)
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+from src.ETL_01_stageToNDS import _correctAddresses, _dedupEvents
+
+
+def _trxRows(in_list_rows, _quantity=1.0):
+    pdf_out = pd.DataFrame(in_list_rows, columns=['trx_hash', 'asset_token_address', 'asset_token_id', 'trx_timestamp',
+                                                  'asset_id', 'seller_address', 'buyer_address',
+                                                  'from_account_tr_address', 'trx_value_crypto'])
+    pdf_out['trx_quantity'] = _quantity
+    return pdf_out
+
+
+def test_sale_and_transfer_duplicates_correct_the_buyer():
+    # a sale to a marketplace contract, and its transfer to the real buyer in the same transaction
+    pdf_trx = _trxRows([['0xh1', '0xc', '1', pd.Timestamp('2022-01-01'), 'a1', '0xseller', '0xmarket', '0xbuyer', 2.0],
+                        ['0xh1', '0xc', '1', pd.Timestamp('2022-01-01'), 'a1', '0xmarket', '0xbuyer', '0xbuyer', 0.0],
+                        ['0xh2', '0xc', '2', pd.Timestamp('2022-01-01'), 'a2', '0xs2', '0xb2', '0xb2', 1.0]])
+
+    pdf_out = _correctAddresses(_dedupEvents(pdf_trx))
+
+    assert pdf_out.shape[0] == 2
+    _sale = pdf_out[pdf_out.trx_hash == '0xh1'].iloc[0]
+    assert (_sale.seller_address, _sale.buyer_address, _sale.trx_value_crypto) == ('0xseller', '0xbuyer', 2.0)
+    assert (_sale.trx_duplicate_num, _sale.trx_address_fix) == (1, 1)
+    assert pdf_out[pdf_out.trx_hash == '0xh2'].trx_address_fix.iloc[0] == 0
+
+
+def test_two_sales_of_an_asset_in_one_transaction_are_kept():
+    # two ERC-1155 sales of the same asset in one transaction (both through the marketplace contract)
+    pdf_trx = _trxRows([['0xh1', '0xc', '1', pd.Timestamp('2022-01-01'), 'a1', '0xs1', '0xmarket', '0xbuyer', 2.0],
+                        ['0xh1', '0xc', '1', pd.Timestamp('2022-01-01'), 'a1', '0xs2', '0xmarket', '0xbuyer', 3.0],
+                        ['0xh1', '0xc', '1', pd.Timestamp('2022-01-01'), 'a1', '0xmarket', '0xbuyer', '0xbuyer', 0.0]])
+
+    pdf_out = _correctAddresses(_dedupEvents(pdf_trx))
+
+    assert pdf_out.shape[0] == 2
+    assert sorted(pdf_out.seller_address) == ['0xs1', '0xs2']
+    assert pdf_out.trx_event_key.nunique() == 2
+    # the transfer is merged to the higher sale, the other one stays as it was
+    pdf_out = pdf_out.set_index('seller_address')
+    assert (pdf_out.loc['0xs2', 'trx_duplicate_num'], pdf_out.loc['0xs2', 'buyer_address']) == (1, '0xbuyer')
+    assert (pdf_out.loc['0xs1', 'trx_duplicate_num'], pdf_out.loc['0xs1', 'buyer_address']) == (0, '0xmarket')
+
+    # downloaded again, the sales get the same keys
+    assert set(_dedupEvents(pdf_trx.iloc[[1, 0]]).trx_event_key) == set(pdf_out.trx_event_key)
+
+
+def test_downloaded_again_duplicates_are_not_flagged():
+    _row = ['0xh1', '0xc', '1', pd.Timestamp('2022-01-01'), 'a1', '0xs', '0xb', '0xb', 2.0]
+    pdf_out = _correctAddresses(_dedupEvents(_trxRows([_row, _row])))
+
+    assert pdf_out.shape[0] == 1
+    assert (pdf_out.trx_duplicate_num.iloc[0], pdf_out.trx_address_fix.iloc[0]) == (1, 0)
+
+
+def test_missing_buyer_is_filled_from_the_transaction():
+    pdf_out = _correctAddresses(_dedupEvents(_trxRows([
+        ['0xh1', '0xc', '1', pd.Timestamp('2022-01-01'), 'a1', '0xs', None, '0xsender', 2.0]])))
+
+    assert pdf_out.buyer_address.iloc[0] == '0xsender'
+    assert pdf_out.trx_address_fix.iloc[0] == 1
+    assert np.issubdtype(pdf_out.trx_address_fix.dtype, np.integer)
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from src import api_client
+from src.api_client import OpenSeaClient, RetryPolicy, _parseRetryAfter
+
+
+class _Response:
+    """
+    Minimal response object of the requests library (status code, headers and a JSON body).
+    """
+
+    def __init__(self, status_code, headers={}, answer=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = b'{}'
+        self.answer = answer
+
+    def json(self):
+        return self.answer
+
+
+def _fakeClient(monkeypatch, in_list_responses):
+    """
+    Client answering the given responses one after the other, and recording the sleeps of the backoff.
+    """
+    _client = OpenSeaClient('test-key-1234')
+    _responses = list(in_list_responses)
+    _client.sleeps = []
+    monkeypatch.setattr(_client, 'get', lambda url, params=None: _responses.pop(0))
+    monkeypatch.setattr(api_client.time, 'sleep', lambda x: _client.sleeps.append(x))
+    return _client
+
+
+def test_retry_after_in_seconds_and_http_date():
+    assert _parseRetryAfter('7') == 7.0
+    assert _parseRetryAfter('-3') == 0.0
+    _date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= _parseRetryAfter(_date) <= 30
+    _past = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=30), usegmt=True)
+    assert _parseRetryAfter(_past) == 0.0
+    assert _parseRetryAfter(None) is None
+    assert _parseRetryAfter('soon') is None
+
+
+def test_throttled_request_waits_for_the_retry_after(monkeypatch):
+    _client = _fakeClient(monkeypatch, [_Response(429, {'Retry-After':'7'}), _Response(200, answer={'ok':1})])
+
+    assert _client.getJSONRetry('http://api/events') == (200, {'ok':1}, 1)
+    assert _client.sleeps == [7.0]
+
+
+def test_plain_client_error_is_not_retried(monkeypatch):
+    _client = _fakeClient(monkeypatch, [_Response(400), _Response(200, answer={'ok':1})])
+
+    assert _client.getJSONRetry('http://api/events') == (400, None, 0)
+    assert _client.sleeps == []
+
+
+def test_backoff_is_capped(monkeypatch):
+    _policy = RetryPolicy(_max_retries=3, _base_delay=10, _max_delay=15)
+    assert max([_policy.delay(10) for _ in range(200)]) <= 15
+    assert _policy.delay(0, retry_after=600) == 15
+
+    _client = _fakeClient(monkeypatch, [_Response(503, {'Retry-After':'600'})] * 4)
+    assert _client.getJSONRetry('http://api/events', _policy=_policy) == (503, None, 3)
+    assert _client.sleeps == [15, 15, 15]
+
+
+@pytest.mark.parametrize('status_code, retryable', [(None, True), (408, True), (429, True), (500, True),
+                                                    (503, True), (400, False), (401, False), (404, False)])
+def test_retryable_status_codes(status_code, retryable):
+    assert RetryPolicy().isRetryable(status_code) == retryable
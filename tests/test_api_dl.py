@@ -0,0 +1,163 @@
+import time
+from os import listdir, makedirs, path
+
+import pandas as pd
+import pytest
+
+from src import api_dl
+from src.catalog import FileCatalog, _catalogPath
+
+
+class _NoTimestampClient:
+    """
+    Client answering pages without transaction times (and always with a next cursor), slowly.
+    """
+
+    def getJSONRetry(self, url, params=None, _policy=None, _bucket=None):
+        time.sleep(0.02)
+        return 200, {'asset_events':[{'id':1, 'transaction':None}], 'next':'abc'}, 0
+
+
+def test_split_before_any_timestamped_page_reschedules_the_interval(tmp_path):
+    _dumpdir = str(tmp_path) + '/'
+    _todo = api_dl._timeInterval_eventDL_oneThread(None, {}, [], _dumpdir, time_interval_unixts=[1000, 2000],
+                                                   _timeout_limit=0.01, _max_pages=5, _client=_NoTimestampClient())
+
+    assert _todo == [[1000, 1500], [1500, 2000]]
+    assert [_f for _f in listdir(_dumpdir) if _f.startswith('eventresponse_')] == []
+    if path.exists(_catalogPath(_dumpdir)):
+        with FileCatalog(_catalogPath(_dumpdir)) as _catalog:
+            assert _catalog.listFiles([_dumpdir]).shape[0] == 0
+    assert listdir(_dumpdir + 'checkpoints/') == []
+
+
+def test_adaptive_mode_needs_a_page_limit(tmp_path):
+    with pytest.raises(ValueError):
+        api_dl._planEventRunList(['2021-06-01 00:00:00', '2021-06-01 01:00:00'], 900, str(tmp_path) + '/', {}, 300,
+                                 False, 0, True, True, 0, 0, 'pickle')
+
+
+def test_halve_interval():
+    assert api_dl._halveInterval([0, 10]) == [[0, 5], [5, 10]]
+    assert api_dl._halveInterval([0, 1]) == [[0, 1]]
+    assert api_dl._halveInterval([5, 5]) == []
+
+
+def test_parquet_output_unifies_the_schemas_of_the_chunks(tmp_path):
+    import pyarrow.parquet as pq
+
+    _sink = api_dl._EventPageSink(str(tmp_path) + '/checkpoints/part.ndjson')
+    # the nested field is empty in the whole first chunk, and set only in the second one
+    _sink.write([{'id':_i, 'transaction':None, 'total_price':'1'} for _i in range(10000)])
+    _sink.write([{'id':10000, 'transaction':{'timestamp':'2022-01-01T00:00:00', 'block':5}, 'total_price':'2'}])
+
+    _nrows, _path_out = _sink.finish(str(tmp_path) + '/eventresponse_1_2', _out_format='parquet')
+
+    _table = pq.read_table(_path_out)
+    assert _path_out.endswith('.parquet') and _nrows == _table.num_rows == 10001
+    assert _table.schema.field('transaction').type.num_fields == 2
+    assert _table.column('transaction').to_pylist()[-1]['block'] == 5
+    assert not path.exists(str(tmp_path) + '/checkpoints/part.ndjson')
+
+
+def test_threaded_engine_downloads_every_event_of_the_mock_api():
+    from src.bench import BenchDownloader
+
+    _result = BenchDownloader(_hours=1, _events_per_sec=0.2, _time_batch_sec=900, _threaded=True, _throttle_share=0.25)
+
+    assert _result['events_downloaded'] == _result['events_expected'] > 0
+    assert _result['throttled'] > 0
+
+
+@pytest.mark.parametrize('in_func', [api_dl.TimeIntervalEventDL, api_dl.ThreadedTimeIntervalEventDL])
+def test_download_needs_an_api_key(tmp_path, in_func):
+    with pytest.raises(ValueError, match='empty key list'):
+        in_func([], {}, ['2021-06-01 00:00:00', '2021-06-01 01:00:00'], 3600, str(tmp_path) + '/')
+
+
+def _workerKey(_):
+    return api_dl._WORKER_API_KEY
+
+
+def test_replaced_pool_worker_gets_the_key_of_the_dead_one():
+    from multiprocessing import Manager, Pool
+
+    with Manager() as _manager:
+        _key_owners = _manager.dict([('key_a', None)])
+        _key_lock = _manager.Lock()
+        # every worker is replaced after one task (like a worker dying after its task)
+        with Pool(1, initializer=api_dl._initKeyWorker, initargs=(_key_owners, _key_lock), maxtasksperchild=1) as p:
+            _keys = p.map_async(_workerKey, range(3), chunksize=1).get(timeout=60)
+
+    assert _keys == ['key_a', 'key_a', 'key_a']
+
+
+class _CursorClient:
+    """
+    Client answering 10 pages of 2 events (going back from 2000 by 10 seconds per page) with numeric cursors,
+    failing permanently (400) after _fail_after requests. The requested URLs are recorded.
+    """
+
+    def __init__(self, _fail_after=None):
+        self.fail_after = _fail_after
+        self.urls = []
+
+    def getJSONRetry(self, url, params=None, _policy=None, _bucket=None):
+        self.urls = self.urls + [url]
+        if (self.fail_after is not None) and (len(self.urls) > self.fail_after):
+            return 400, None, 0
+        _page = int(url.split('cursor=')[1]) if 'cursor=' in url else 0
+        _events = [{'id':10 * _page + _i, 'transaction':{'timestamp':pd.Timestamp(_ts, unit='s').isoformat()}}
+                   for _i, _ts in enumerate([1999 - 10 * _page, 1994 - 10 * _page])]
+        return 200, {'asset_events':_events, 'next':str(_page + 1) if _page < 9 else None}, 0
+
+
+def test_adaptive_rerun_resumes_an_interrupted_interval_from_its_cursor(tmp_path):
+    _dumpdir = str(tmp_path) + '/'
+    _interval = ['1970-01-01 00:16:40', '1970-01-01 00:33:20'] # [1000, 2000)
+    _sessiondir = _dumpdir + 'events_19700101_001640_19700101_003320/'
+    makedirs(_sessiondir)
+    # the first run fails after 3 pages (with a checkpoint after every page)
+    api_dl._timeInterval_eventDL_oneThread(None, {}, [], _sessiondir, time_interval_unixts=[1000, 2000],
+                                           _checkpoint_pages=1, _client=_CursorClient(_fail_after=3))
+    assert path.exists(_sessiondir + 'checkpoints/eventresponse_1000_2000.json')
+
+    # the density learnt meanwhile would split the interval to several parts
+    with open(_sessiondir + '_density.csv', 'w') as _f:
+        _f.write('0,1000,10000\n2000,3000,10000\n')
+    _, _rundictlist, _ = api_dl._planEventRunList(_interval, 1000, _dumpdir, {}, 300, False, 0, True, True, 5, 1, 'pickle')
+    assert [_d['time_interval_unixts'] for _d in _rundictlist] == [[1000, 2000]]
+
+    _client = _CursorClient()
+    api_dl._timeInterval_eventDL_oneThread(None, {}, [], _sessiondir, time_interval_unixts=[1000, 2000],
+                                           _checkpoint_pages=1, _client=_client)
+    assert _client.urls[0].endswith('cursor=3')
+    assert pd.read_pickle(_sessiondir + 'eventresponse_1000_2000.pickle').shape[0] == 20
+
+    # the checkpoint files of an interval downloaded since then are deleted at the next planning
+    for _ext in ['.json', '.ndjson.part']:
+        open(_sessiondir + 'checkpoints/eventresponse_1200_1300' + _ext, 'w').close()
+    api_dl._planEventRunList(_interval, 1000, _dumpdir, {}, 300, False, 0, True, True, 5, 1, 'pickle')
+    assert listdir(_sessiondir + 'checkpoints/') == []
+
+
+def test_token_bucket_throttle_and_recover_change_the_rate():
+    _bucket = api_dl._TokenBucket(4, _min_rate=0.5)
+
+    _bucket.throttle()
+    assert _bucket.rate == 2
+    for _ in range(5):
+        _bucket.throttle()
+    assert _bucket.rate == 0.5
+
+    _bucket.recover(_step=0.25)
+    assert _bucket.rate == 1.5
+    for _ in range(5):
+        _bucket.recover(_step=0.25)
+    assert _bucket.rate == 4
+
+    # the lowered rate makes the next token come later
+    _bucket = api_dl._TokenBucket(100)
+    _bucket.acquire()
+    _bucket.throttle(_factor=0.1)
+    assert _bucket.acquire() > 0.05
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from src.price_index import PriceIndex
+
+
+def test_no_look_ahead_price_within_a_bucket(tmp_path):
+    _index = PriceIndex(str(tmp_path) + '/', _granularity='1h')
+    _index.update(pd.DataFrame({'symbol':['USDC', 'USDC', 'USDC'],
+                                'price_ts':['2022-01-01 09:30:00', '2022-01-01 10:40:00', '2022-01-01 10:50:00'],
+                                'usd_price':[1.0, 2.0, 3.0]}))
+
+    _usd, _ = _index.lookup(pd.to_datetime(['2022-01-01 10:10:00', '2022-01-01 10:55:00',
+                                            '2022-01-01 11:00:00', '2022-01-01 09:10:00']), ['USDC'] * 4)
+
+    # the prices of 10:40 and 10:50 are unknown at 10:10 and 10:55 (the bucket of 10h is used from 11:00 on)
+    np.testing.assert_array_equal(_usd[:3], [1.0, 1.0, 3.0])
+    assert np.isnan(_usd[3])
+
+
+def test_price_observed_at_the_bucket_end_is_used_from_its_time(tmp_path):
+    _index = PriceIndex(str(tmp_path) + '/', _granularity='1h')
+    _index.update(pd.DataFrame({'symbol':['ETH'], 'price_ts':['2022-01-01 10:00:00'], 'usd_price':[3000.0]}))
+
+    _usd, _eth = _index.lookup(pd.to_datetime(['2022-01-01 09:59:59', '2022-01-01 10:00:00']), ['WETH', 'WETH'])
+
+    assert np.isnan(_usd[0])
+    assert _usd[1] == 3000.0
+    assert _eth[1] == 1.0